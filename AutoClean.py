@@ -0,0 +1,79 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Dict
+
+# Flags of ChatSettingsStore
+AUTOCLEAN = 1
+
+
+class ChatSettingsStore:
+    """ Settings of groups and channels which opted in to features like auto-cleaning: Chat ID -> bit flags.
+     Only chats with at least one flag are stored so looking up a chat which never opted in costs one dict lookup.
+     Changes are written to a JSON file right away as they only happen via admin commands.
+     """
+
+    def __init__(self, path: str = "chatsettings.json"):
+        self.path = path
+        self.flags: Dict[int, int] = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as infile:
+                self.flags = {int(chatid): flags for chatid, flags in json.load(infile).items()}
+
+    def isEnabled(self, chatid: int, flag: int = AUTOCLEAN) -> bool:
+        return self.flags.get(chatid, 0) & flag != 0
+
+    def setEnabled(self, chatid: int, enabled: bool, flag: int = AUTOCLEAN):
+        flags = self.flags.get(chatid, 0)
+        flags = flags | flag if enabled else flags & ~flag
+        if flags == self.flags.get(chatid, 0):
+            return
+        if flags == 0:
+            del self.flags[chatid]
+        else:
+            self.flags[chatid] = flags
+        self.save()
+
+    def save(self):
+        temppath = self.path + ".tmp"
+        with open(temppath, 'w', encoding='utf-8') as outfile:
+            json.dump({str(chatid): flags for chatid, flags in self.flags.items()}, outfile)
+        # Replace old file at once so a crash never leaves a half written file
+        os.replace(temppath, self.path)
+
+
+class RecentURLs:
+    """ URLs cleaned in one chat during the last window seconds so links which are posted again and again are only cleaned once.
+     Keeps at most maxentries URLs, the oldest ones are forgotten first.
+     """
+
+    def __init__(self, window: float = 3600, maxentries: int = 1000):
+        self.window = window
+        self.maxentries = maxentries
+        # URL -> time.monotonic() it was posted the last time, oldest first
+        self.entries: "OrderedDict[str, float]" = OrderedDict()
+
+    def removeExpired(self, now: float):
+        entries = self.entries
+        # Oldest entries are at the start
+        while len(entries) > 0:
+            oldesturl, postedtime = next(iter(entries.items()))
+            if now - postedtime < self.window:
+                break
+            del entries[oldesturl]
+
+    def isRecent(self, url: str) -> bool:
+        """ Returns True if given URL has been added during the window. """
+        self.removeExpired(time.monotonic())
+        return url in self.entries
+
+    def addURL(self, url: str):
+        """ Remembers given URL, should only be called once it has been cleaned so it is tried again if cleaning failed. """
+        now = time.monotonic()
+        self.removeExpired(now)
+        entries = self.entries
+        entries[url] = now
+        entries.move_to_end(url)
+        if len(entries) > self.maxentries:
+            entries.popitem(last=False)
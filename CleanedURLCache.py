@@ -0,0 +1,86 @@
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Tuple, Union, Hashable
+from urllib.parse import ParseResult
+
+
+class CleanedURLSnapshot(NamedTuple):
+    """ Immutable copy of the result of cleaning a single URL. """
+    cleanedurl: ParseResult
+    newurl: Union[str, None]
+    newurl_regex: Union[str, None]
+    newurl_urlparam: Union[str, None]
+    # Indices into CompiledRuleset.rules of the ruleset whose version is part of the key
+    appliedruleindices: Tuple[int, ...]
+    removedparams_affiliate: Tuple[str, ...]
+    removedparams_tracking: Tuple[str, ...]
+    isException: bool
+    # Approximated memory usage of this entry in bytes
+    size: int
+
+
+# Rough guess for the memory used by a cache entry apart from its strings
+ENTRY_OVERHEAD_BYTES = 400
+
+
+class CleanedURLCache:
+    """ Thread-safe LRU cache for results of URLCleaner.
+     Keys are expected to contain the version of the ruleset which was used so results of outdated rulesets are never returned.
+     The size limit in bytes is an approximation based on the length of the cached strings.
+     """
+
+    def __init__(self, maxentries: int = 10000, maxbytes: int = 16 * 1024 * 1024):
+        if maxentries < 1 or maxbytes < 1:
+            raise ValueError(f"Invalid cache limits: {maxentries=} {maxbytes=}")
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.entries: "OrderedDict[Hashable, CleanedURLSnapshot]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Union[CleanedURLSnapshot, None]:
+        with self.lock:
+            snapshot = self.entries.get(key)
+            if snapshot is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return snapshot
+
+    def put(self, key: Hashable, originalurl: str, cleanedurl) -> None:
+        """ Stores an immutable copy of given CleanedURL. """
+        removedparams_affiliate = cleanedurl.removedparams_affiliate
+        removedparams_tracking = cleanedurl.removedparams_tracking
+        size = ENTRY_OVERHEAD_BYTES + 2 * len(originalurl) + sum(len(part) for part in cleanedurl.cleanedurl) \
+            + sum(len(param) for param in removedparams_affiliate) + sum(len(param) for param in removedparams_tracking)
+        if size > self.maxbytes:
+            return
+        snapshot = CleanedURLSnapshot(cleanedurl=cleanedurl.cleanedurl, newurl=cleanedurl.newurl, newurl_regex=cleanedurl.newurl_regex,
+                                      newurl_urlparam=cleanedurl.newurl_urlparam, appliedruleindices=cleanedurl.appliedruleindices,
+                                      removedparams_affiliate=removedparams_affiliate, removedparams_tracking=removedparams_tracking,
+                                      isException=cleanedurl.isException, size=size)
+        with self.lock:
+            oldsnapshot = self.entries.pop(key, None)
+            if oldsnapshot is not None:
+                self.bytes -= oldsnapshot.size
+            self.entries[key] = snapshot
+            self.bytes += size
+            while len(self.entries) > self.maxentries or self.bytes > self.maxbytes:
+                _, evictedsnapshot = self.entries.popitem(last=False)
+                self.bytes -= evictedsnapshot.size
+                self.evictions += 1
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def getStats(self) -> dict:
+        """ Returns counters which can be used to find a good size for this cache. """
+        with self.lock:
+            return dict(entries=len(self.entries), bytes=self.bytes, maxentries=self.maxentries, maxbytes=self.maxbytes, hits=self.hits, misses=self.misses,
+                        evictions=self.evictions)
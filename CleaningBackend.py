@@ -0,0 +1,191 @@
+import asyncio
+import copy
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor, Future
+from typing import Union, List, Tuple, Callable, TypeVar
+
+from CleaningMetrics import CleaningMetrics
+from SharedRuleset import SharedRulesetPublisher, loadSharedRuleset
+from URLCleaner import URLCleaner, CleanResult
+
+ResultType = TypeVar("ResultType")
+
+# URLCleaner used inside worker processes
+workercleaner: Union[URLCleaner, None] = None
+# Name of the shared memory segment the ruleset of workercleaner was loaded from
+workerrulesetname: Union[str, None] = None
+
+
+def initWorker(cleaner: URLCleaner, collectMetrics: bool = False):
+    """ Worker processes get the settings of the URLCleaner of the main process, rules are loaded from shared memory, see useSharedRuleset.
+     collectMetrics: Collect metrics which are sent back with every result, see takeWorkerMetrics.
+     """
+    global workercleaner
+    workercleaner = cleaner
+    if collectMetrics:
+        workercleaner.metrics = CleaningMetrics()
+
+
+def useSharedRuleset(rulesetname: str):
+    """ Every task tells the worker which ruleset is current so workers switch to new rules without being restarted. """
+    global workerrulesetname
+    if rulesetname != workerrulesetname:
+        workercleaner.setRuleset(loadSharedRuleset(rulesetname))
+        workerrulesetname = rulesetname
+
+
+def takeWorkerMetrics() -> Union[CleaningMetrics, None]:
+    """ Returns metrics collected by this worker since the last task, they get merged into the metrics of the main process by CleaningBackend. """
+    if workercleaner.metrics is None:
+        return None
+    return workercleaner.metrics.takeCollected()
+
+
+def cleanTextInWorker(rulesetname: str, text: str, maxurls: Union[int, None], timebudget: Union[float, None],
+                      urlspans: Union[List[Tuple[int, int, str]], None] = None) -> Tuple[CleanResult, Union[CleaningMetrics, None]]:
+    useSharedRuleset(rulesetname)
+    return workercleaner.cleanText(text, maxurls=maxurls, timebudget=timebudget, urlspans=urlspans), takeWorkerMetrics()
+
+
+def cleanTexts(cleaner: URLCleaner, texts: List[str], maxurls: Union[int, None], timebudget: Union[float, None]) -> List[CleanResult]:
+    return [cleaner.cleanText(text, maxurls=maxurls, timebudget=timebudget) for text in texts]
+
+
+def runInWorker(rulesetname: str, function: Callable[..., ResultType], *args) -> Tuple[ResultType, Union[CleaningMetrics, None]]:
+    useSharedRuleset(rulesetname)
+    return function(workercleaner, *args), takeWorkerMetrics()
+
+
+def getWorkerSettings(urlcleaner: URLCleaner) -> URLCleaner:
+    """ Returns copy of given URLCleaner without any rules which is small enough to be passed to every worker process. """
+    settings = copy.copy(urlcleaner)
+    settings.cleaningrules = []
+    settings.ruleset = None
+    settings.cache = None
+    if urlcleaner.cache is not None:
+        # Every worker needs its own cache
+        settings.enableCache(maxentries=urlcleaner.cache.maxentries, maxbytes=urlcleaner.cache.maxbytes)
+    return settings
+
+
+class CleaningBackendBusyError(Exception):
+    """ Raised if too many texts are waiting to be cleaned. """
+    pass
+
+
+class CleaningBackend:
+    """ Runs URLCleaner.cleanText outside of the asyncio event loop so that one big message cannot block all other chats.
+
+     mode:
+     inline: Clean inside the event loop, only useful for debugging
+     thread: Clean inside a pool of threads
+     process: Clean inside a pool of processes which load the compiled ruleset from shared memory, see SharedRuleset
+
+     maxinflight: Max number of texts being cleaned at the same time
+     maxqueued: Max number of texts waiting for one of the above slots, further texts are rejected via CleaningBackendBusyError
+     maxurls, timebudget: See URLCleaner.cleanText
+     """
+
+    def __init__(self, urlcleaner: URLCleaner, mode: str = "thread", workers: int = 2, maxinflight: int = 8, maxqueued: int = 32,
+                 maxurls: Union[int, None] = None, timebudget: Union[float, None] = None):
+        self.urlcleaner = urlcleaner
+        self.mode = mode
+        self.workers = workers
+        self.maxqueued = maxqueued
+        self.maxurls = maxurls
+        self.timebudget = timebudget
+        self.inflight = asyncio.Semaphore(maxinflight)
+        self.numqueued = 0
+        self.executor: Union[Executor, None] = None
+        self.sharedrulesets: Union[SharedRulesetPublisher, None] = None
+        if mode == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="URLCleaner")
+        elif mode == "process":
+            # Compile rules once, workers only load the result
+            self.sharedrulesets = SharedRulesetPublisher()
+            self.sharedrulesets.publish(urlcleaner.getRuleset())
+            self.executor = ProcessPoolExecutor(max_workers=workers, initializer=initWorker,
+                                                initargs=(getWorkerSettings(urlcleaner), urlcleaner.metrics is not None))
+        elif mode != "inline":
+            raise ValueError(f"Unknown cleaning backend mode: {mode}")
+
+    async def cleanText(self, text: str, urlspans: Union[List[Tuple[int, int, str]], None] = None) -> CleanResult:
+        """ urlspans: See URLCleaner.cleanText """
+        await self.acquireSlot()
+        try:
+            if self.mode == "inline":
+                return self.urlcleaner.cleanText(text, maxurls=self.maxurls, timebudget=self.timebudget, urlspans=urlspans)
+            loop = asyncio.get_running_loop()
+            if self.mode == "process":
+                return await self.submitToWorker(cleanTextInWorker, text, self.maxurls, self.timebudget, urlspans)
+            else:
+                return await loop.run_in_executor(self.executor, self.urlcleaner.cleanText, text, self.maxurls, self.timebudget, urlspans)
+        finally:
+            self.inflight.release()
+
+    async def cleanTexts(self, texts: List[str]) -> List[CleanResult]:
+        """ Cleans multiple texts using only one slot which is a lot cheaper than calling cleanText for each of them if processes are used.
+         maxurls and timebudget apply to every single text.
+         """
+        return await self.run(cleanTexts, texts, self.maxurls, self.timebudget)
+
+    async def run(self, function: Callable[..., ResultType], *args) -> ResultType:
+        """ Calls function(urlcleaner, *args) using one slot. Function and arguments need to be picklable if processes are used. """
+        await self.acquireSlot()
+        try:
+            if self.mode == "inline":
+                return function(self.urlcleaner, *args)
+            loop = asyncio.get_running_loop()
+            if self.mode == "process":
+                return await self.submitToWorker(runInWorker, function, *args)
+            else:
+                return await loop.run_in_executor(self.executor, function, self.urlcleaner, *args)
+        finally:
+            self.inflight.release()
+
+    async def submitToWorker(self, workerfunction: Callable[..., Tuple[ResultType, Union[CleaningMetrics, None]]], *args) -> ResultType:
+        """ Runs workerfunction(rulesetname, *args) in a worker process. The shared ruleset stays available until the task has finished or was cancelled
+         even if the awaiting coroutine gets cancelled earlier e.g. by a newer inline query.
+         workerfunction returns its result together with the metrics collected while it ran, see takeWorkerMetrics.
+         """
+        sharedrulesets = self.sharedrulesets
+        rulesetname = sharedrulesets.acquire()
+        try:
+            future: Future = self.executor.submit(workerfunction, rulesetname, *args)
+        except BaseException:
+            sharedrulesets.release(rulesetname)
+            raise
+        # Called by the executor once the task has finished or was cancelled
+        future.add_done_callback(lambda finishedfuture: sharedrulesets.release(rulesetname))
+        result, workermetrics = await asyncio.wrap_future(future)
+        metrics = self.urlcleaner.metrics
+        if workermetrics is not None and metrics is not None:
+            metrics.merge(workermetrics)
+        return result
+
+    async def acquireSlot(self):
+        """ Waits until one of the maxinflight slots is free, raises CleaningBackendBusyError if too many others are already waiting. """
+        if self.inflight.locked():
+            if self.numqueued >= self.maxqueued:
+                raise CleaningBackendBusyError(f"Too many texts waiting to be cleaned: {self.numqueued}")
+        self.numqueued += 1
+        try:
+            await self.inflight.acquire()
+        finally:
+            self.numqueued -= 1
+
+    def onRulesetChanged(self):
+        """ Threads use the URLCleaner of the main process and get a new ruleset automatically.
+         Worker processes have their own copy: The new ruleset is published to shared memory and every worker switches to it with its next task.
+         Texts which are already queued or being cleaned finish with the old ruleset, its segment is removed afterwards.
+         """
+        if self.mode != "process" or self.sharedrulesets is None:
+            return
+        self.sharedrulesets.publish(self.urlcleaner.getRuleset())
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+        if self.sharedrulesets is not None:
+            self.sharedrulesets.close()
+            self.sharedrulesets = None
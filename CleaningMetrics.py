@@ -0,0 +1,246 @@
+import bisect
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import List, Dict, Tuple, Union
+
+# Upper bounds in seconds for the time spent applying a single rule to a single URL
+RULE_TIME_BUCKETS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.1)
+# Upper bounds in seconds for cleaning/sending a complete message
+MESSAGE_TIME_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10)
+MESSAGE_URL_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+# Name used for the time spent on URLCleaner.removeGlobalBlacklistedParameters
+MERGED_GLOBAL_BLACKLISTS_NAME = "[merged global blacklists]"
+
+
+class Histogram:
+    """ Histogram with fixed buckets like the ones of Prometheus. Not thread-safe, see CleaningMetrics. """
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # Last field counts values which are greater than the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def toPrometheus(self, name: str, labels: str = "") -> List[str]:
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bucket}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {self.count}')
+        labels = labels.rstrip(',')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}' if labels else f'{name}_sum {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}' if labels else f'{name}_count {self.count}')
+        return lines
+
+    def merge(self, other: "Histogram"):
+        self.counts = [count + othercount for count, othercount in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+
+class RuleMetrics:
+    def __init__(self):
+        self.evaluations = 0
+        self.matches = 0
+        self.exceptions = 0
+        self.invalidresults = 0
+        self.quarantined = 0
+        self.time = Histogram(RULE_TIME_BUCKETS)
+
+    def merge(self, other: "RuleMetrics"):
+        self.evaluations += other.evaluations
+        self.matches += other.matches
+        self.exceptions += other.exceptions
+        self.invalidresults += other.invalidresults
+        self.quarantined += other.quarantined
+        self.time.merge(other.time)
+
+
+def escapeLabelValue(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class CleaningMetrics:
+    """ Counters of URLCleaner (per rule) and URLCleanerBot (per message).
+     Rules are identified by their name so the numbers survive reloading of the rules.
+     Collecting is disabled as long as URLCleaner.metrics is None.
+     Worker processes collect URLCleaner metrics on their own and send them to the main process with every result, see takeCollected and merge.
+     """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rules: Dict[str, RuleMetrics] = {}
+        self.urls = 0
+        self.messages = 0
+        self.messagesrejected = 0
+        self.messagesincomplete = 0
+        self.messageurls = Histogram(MESSAGE_URL_BUCKETS)
+        self.messagecleaningtime = Histogram(MESSAGE_TIME_BUCKETS)
+        self.messagesendingtime = Histogram(MESSAGE_TIME_BUCKETS)
+        # Rules which were skipped while importing them because of invalid regular expressions or other invalid fields
+        self.invalidrules = 0
+
+    def __getstate__(self) -> dict:
+        # Locks cannot be pickled
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def takeCollected(self) -> Union["CleaningMetrics", None]:
+        """ Returns the URLCleaner metrics collected since the last call and starts from zero again. Returns None if nothing was collected.
+         Message metrics are left out as they are only recorded by the main process.
+         """
+        with self.lock:
+            if self.urls == 0 and len(self.rules) == 0 and self.invalidrules == 0:
+                return None
+            collected = CleaningMetrics()
+            collected.rules, self.rules = self.rules, {}
+            collected.urls, self.urls = self.urls, 0
+            collected.invalidrules, self.invalidrules = self.invalidrules, 0
+        return collected
+
+    def merge(self, other: "CleaningMetrics"):
+        """ Adds the URLCleaner metrics of other e.g. ones collected by a worker process. """
+        with self.lock:
+            self.urls += other.urls
+            self.invalidrules += other.invalidrules
+            for rulename, rulemetrics in other.rules.items():
+                self.getRuleMetrics(rulename).merge(rulemetrics)
+
+    def getRuleMetrics(self, rulename: str) -> RuleMetrics:
+        rulemetrics = self.rules.get(rulename)
+        if rulemetrics is None:
+            rulemetrics = RuleMetrics()
+            self.rules[rulename] = rulemetrics
+        return rulemetrics
+
+    def recordURL(self, evaluations: List[Tuple[str, float, bool]]):
+        """ Records all (rule name, seconds, rule applied) evaluations done while cleaning one URL at once so the lock is only taken once per URL. """
+        with self.lock:
+            self.urls += 1
+            for rulename, seconds, matched in evaluations:
+                rulemetrics = self.getRuleMetrics(rulename)
+                rulemetrics.evaluations += 1
+                rulemetrics.time.observe(seconds)
+                if matched:
+                    rulemetrics.matches += 1
+
+    def recordRuleException(self, rulename: str):
+        with self.lock:
+            self.getRuleMetrics(rulename).exceptions += 1
+
+    def recordInvalidResult(self, rulename: str):
+        """ Rule produced a URL which could not be parsed. """
+        with self.lock:
+            self.getRuleMetrics(rulename).invalidresults += 1
+
+    def recordQuarantinedRule(self, rulename: str):
+        """ Rule is not used anymore because of dangerous or slow regular expressions. """
+        with self.lock:
+            self.getRuleMetrics(rulename).quarantined += 1
+
+    def recordInvalidRule(self):
+        with self.lock:
+            self.invalidrules += 1
+
+    def recordMessage(self, numurls: int, cleaningtime: float, sendingtime: float, isIncomplete: bool = False):
+        with self.lock:
+            self.messages += 1
+            if isIncomplete:
+                self.messagesincomplete += 1
+            self.messageurls.observe(numurls)
+            self.messagecleaningtime.observe(cleaningtime)
+            self.messagesendingtime.observe(sendingtime)
+
+    def recordMessageRejected(self):
+        """ Message was not cleaned because the bot was busy. """
+        with self.lock:
+            self.messagesrejected += 1
+
+    def toPrometheus(self) -> str:
+        """ Returns all metrics in the Prometheus text exposition format. """
+        lines = []
+
+        def addMetric(name: str, metrictype: str, helptext: str):
+            lines.append(f"# HELP {name} {helptext}")
+            lines.append(f"# TYPE {name} {metrictype}")
+
+        with self.lock:
+            rules = sorted(self.rules.items())
+            addMetric("urlcleaner_urls_total", "counter", "URLs the rules were applied to, results taken from the cache are not included")
+            lines.append(f"urlcleaner_urls_total {self.urls}")
+            addMetric("urlcleaner_invalid_rules_total", "counter", "Rules skipped during import because they were invalid e.g. because of invalid regular expressions")
+            lines.append(f"urlcleaner_invalid_rules_total {self.invalidrules}")
+            for name, attribute, helptext in (("urlcleaner_rule_evaluations_total", "evaluations", "Number of URLs a rule was checked against"),
+                                              ("urlcleaner_rule_matches_total", "matches", "Number of URLs a rule was applied to"),
+                                              ("urlcleaner_rule_exceptions_total", "exceptions", "Number of exceptions raised while applying a rule"),
+                                              ("urlcleaner_rule_invalid_results_total", "invalidresults", "Number of invalid URLs produced by a rule"),
+                                              ("urlcleaner_rule_quarantined_total", "quarantined",
+                                               "Number of times a rule was disabled because of dangerous or slow regular expressions")):
+                addMetric(name, "counter", helptext)
+                for rulename, rulemetrics in rules:
+                    lines.append(f'{name}{{rule="{escapeLabelValue(rulename)}"}} {getattr(rulemetrics, attribute)}')
+            addMetric("urlcleaner_rule_seconds", "histogram", "Time spent applying a rule to a single URL")
+            for rulename, rulemetrics in rules:
+                lines += rulemetrics.time.toPrometheus("urlcleaner_rule_seconds", f'rule="{escapeLabelValue(rulename)}",')
+            addMetric("urlcleaner_messages_total", "counter", "Messages cleaned by the bot")
+            lines.append(f"urlcleaner_messages_total {self.messages}")
+            addMetric("urlcleaner_messages_rejected_total", "counter", "Messages rejected because the bot was busy")
+            lines.append(f"urlcleaner_messages_rejected_total {self.messagesrejected}")
+            addMetric("urlcleaner_messages_incomplete_total", "counter", "Messages with too many URLs or which exceeded the time budget")
+            lines.append(f"urlcleaner_messages_incomplete_total {self.messagesincomplete}")
+            addMetric("urlcleaner_message_urls", "histogram", "URLs per message")
+            lines += self.messageurls.toPrometheus("urlcleaner_message_urls")
+            addMetric("urlcleaner_message_cleaning_seconds", "histogram", "Time needed to clean all URLs of a message including waiting for a free worker")
+            lines += self.messagecleaningtime.toPrometheus("urlcleaner_message_cleaning_seconds")
+            addMetric("urlcleaner_message_sending_seconds", "histogram", "Time needed to send the reply to a message")
+            lines += self.messagesendingtime.toPrometheus("urlcleaner_message_sending_seconds")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """ Serves metrics in the Prometheus text format via http://host:port/metrics inside a background thread. """
+
+    def __init__(self, metrics: CleaningMetrics, host: str = "127.0.0.1", port: int = 9464):
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.toPrometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Do not print a line for every scrape
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.server.daemon_threads = True
+        self.thread: Union[threading.Thread, None] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="MetricsServer", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.thread = None
@@ -0,0 +1,151 @@
+import cProfile
+import contextlib
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from typing import List, Tuple, Union, Iterator
+from urllib.parse import urlparse
+
+# Environment variables which enable profiling of every URLCleaner without changing any code e.g. for URLCleanerCLI or URLCleanerService
+ENV_SLOW_URL_THRESHOLD = "URLCLEANER_SLOW_URL_THRESHOLD"
+ENV_SLOW_URL_LOG = "URLCLEANER_SLOW_URL_LOG"
+ENV_PROFILE_SAMPLE_RATE = "URLCLEANER_PROFILE_SAMPLE_RATE"
+ENV_PROFILE_DIR = "URLCLEANER_PROFILE_DIR"
+ENV_REDACT_URLS = "URLCLEANER_REDACT_URLS"
+SLOW_URL_LOG_MAX_BYTES = 10 * 1024 * 1024
+SLOW_URL_LOG_BACKUPS = 3
+
+
+def redactURL(url: str) -> str:
+    """ Removes everything from given URL which could identify a user but keeps what is needed to find out which rules are slow:
+     Scheme, domain, number and length of path segments and names of parameters e.g. 'https://example.com/user/max?id=5&utm_source=x' ->
+     'https://example.com/****/***?id=*&utm_source=*'.
+     """
+    try:
+        parsedurl = urlparse(url)
+    except ValueError:
+        return f"<invalid URL with {len(url)} characters>"
+    path = "/".join("*" * len(segment) for segment in parsedurl.path.split("/"))
+    # Query parts without '=' are treated as values e.g. 'https://example.com/?abc123'
+    query = "&".join(segment.split("=", 1)[0] + "=*" if "=" in segment else "*" * len(segment) for segment in parsedurl.query.split("&")) if parsedurl.query else ""
+    redactedurl = f"{parsedurl.scheme}://{parsedurl.hostname or ''}{path}"
+    if query:
+        redactedurl += "?" + query
+    if parsedurl.fragment:
+        redactedurl += "#" + "*" * len(parsedurl.fragment)
+    return redactedurl
+
+
+class CleaningProfiler:
+    """ Opt-in tracing of URLCleaner.
+     Slow URL log: URLs which take longer than slowurlthreshold seconds are written to a rotating log file together with the time spent on every rule.
+     Only active if alwaysTrace is set or while tracing has been enabled for a limited time via traceFor e.g. by an admin command.
+     Sampled profiles: samplerate of all URLCleaner.cleanText calls are run with cProfile, results are written to profiledir which keeps the newest maxprofiles files.
+     URLs are redacted via redactURL unless redactURLs is disabled as the bot promises not to store any user data.
+     """
+
+    def __init__(self, slowurlthreshold: float = 0.05, slowurllogpath: str = "slowurls.log", alwaysTrace: bool = False, redactURLs: bool = True,
+                 samplerate: float = 0.0, profiledir: str = "profiles", maxprofiles: int = 20):
+        self.slowurlthreshold = slowurlthreshold
+        self.slowurllogpath = slowurllogpath
+        self.alwaysTrace = alwaysTrace
+        self.redactURLs = redactURLs
+        self.samplerate = samplerate
+        self.profiledir = profiledir
+        self.maxprofiles = maxprofiles
+        # time.monotonic() until which tracing is enabled, see traceFor
+        self.tracinguntil = 0.0
+        # Own random generator so sampling does not influence rules using '<randomchar>'
+        self.randomizer = random.Random()
+        self.profilelock = threading.Lock()
+        self.logger: Union[logging.Logger, None] = None
+
+    @classmethod
+    def fromEnvironment(cls) -> Union["CleaningProfiler", None]:
+        """ Returns profiler configured via environment variables or None if none of them is set. """
+        threshold = os.environ.get(ENV_SLOW_URL_THRESHOLD)
+        samplerate = os.environ.get(ENV_PROFILE_SAMPLE_RATE)
+        if threshold is None and samplerate is None:
+            return None
+        return cls(slowurlthreshold=float(threshold) if threshold is not None else 0.05, slowurllogpath=os.environ.get(ENV_SLOW_URL_LOG, "slowurls.log"),
+                   alwaysTrace=threshold is not None, redactURLs=os.environ.get(ENV_REDACT_URLS, "1") != "0",
+                   samplerate=float(samplerate) if samplerate is not None else 0.0, profiledir=os.environ.get(ENV_PROFILE_DIR, "profiles"))
+
+    def __getstate__(self) -> dict:
+        # Worker processes open their own log file
+        state = self.__dict__.copy()
+        del state['profilelock']
+        state['logger'] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.profilelock = threading.Lock()
+
+    def traceFor(self, seconds: float):
+        """ Enables the slow URL log for given number of seconds, 0 = Disable it again. """
+        self.tracinguntil = time.monotonic() + seconds if seconds > 0 else 0.0
+
+    def isTracing(self) -> bool:
+        return self.alwaysTrace or time.monotonic() < self.tracinguntil
+
+    def getTracingSecondsLeft(self) -> float:
+        return max(0.0, self.tracinguntil - time.monotonic())
+
+    def getLogger(self) -> logging.Logger:
+        if self.logger is None:
+            logger = logging.getLogger(f"URLCleaner.slowurls.{os.path.abspath(self.slowurllogpath)}")
+            if len(logger.handlers) == 0:
+                handler = logging.handlers.RotatingFileHandler(self.slowurllogpath, maxBytes=SLOW_URL_LOG_MAX_BYTES, backupCount=SLOW_URL_LOG_BACKUPS,
+                                                               encoding='utf-8')
+                handler.setFormatter(logging.Formatter("%(message)s"))
+                logger.addHandler(handler)
+                logger.setLevel(logging.INFO)
+                # Keep URLs out of the normal log output
+                logger.propagate = False
+            self.logger = logger
+        return self.logger
+
+    def logSlowURL(self, url: str, cleanedurl: str, evaluations: List[Tuple[str, float, bool]], totaltime: float):
+        """ Writes one JSON object per line: Original and cleaned URL, total time and (rule name, milliseconds, rule applied) of every evaluated rule. """
+        if self.redactURLs:
+            url = redactURL(url)
+            cleanedurl = redactURL(cleanedurl)
+        entry = dict(time=datetime.now().isoformat(timespec='seconds'), url=url, cleanedurl=cleanedurl, totalms=round(totaltime * 1000, 3),
+                     rules=[dict(rule=rulename, ms=round(seconds * 1000, 3), applied=matched) for rulename, seconds, matched in evaluations])
+        self.getLogger().info(json.dumps(entry, ensure_ascii=False))
+
+    def shouldProfile(self) -> bool:
+        return self.samplerate > 0 and self.randomizer.random() < self.samplerate
+
+    @contextlib.contextmanager
+    def profile(self) -> Iterator[None]:
+        """ Profiles the code inside the with-block and writes the stats to a new file inside profiledir. """
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.saveProfile(profiler)
+
+    def saveProfile(self, profiler: cProfile.Profile):
+        """ Stores given profile, can be viewed via 'python3 -m pstats <file>' or e.g. snakeviz. Oldest files get removed. """
+        with self.profilelock:
+            os.makedirs(self.profiledir, exist_ok=True)
+            profiler.dump_stats(os.path.join(self.profiledir, f"cleantext-{time.time_ns()}-{os.getpid()}.prof"))
+            profiles = sorted(filename for filename in os.listdir(self.profiledir) if filename.startswith("cleantext-") and filename.endswith(".prof"))
+            for filename in profiles[:max(0, len(profiles) - self.maxprofiles)]:
+                try:
+                    os.remove(os.path.join(self.profiledir, filename))
+                except OSError:
+                    pass
+
+
+# Created once so every URLCleaner shares the same log file
+environmentprofiler = CleaningProfiler.fromEnvironment()
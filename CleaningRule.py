@@ -1,7 +1,22 @@
+import hashlib
+import operator
 import re
 from typing import Union, List, Optional
 
 from pydantic import BaseModel, root_validator, validator
+from pydantic.json import custom_pydantic_encoder
+
+from RegexSafety import LinearPattern, makePatternSafe
+
+
+def compilePattern(pattern: Union[str, re.Pattern]) -> re.Pattern:
+    """ Compiles given regular expression so invalid patterns are rejected when a rule is loaded and not when it is used. """
+    if isinstance(pattern, re.Pattern):
+        return pattern
+    try:
+        return re.compile(pattern)
+    except re.error as error:
+        raise ValueError(f"Invalid regular expression {pattern!r}: {error}")
 
 
 class CleaningRule(BaseModel):
@@ -32,16 +47,16 @@ class CleaningRule(BaseModel):
     name: str
     description: Optional[str]
     enabled: Optional[bool] = True
-    urlPattern: Optional[str]
+    urlPattern: Optional[Union[str, re.Pattern, None]]
     paramsblacklist: Optional[List[str]]
-    paramsblacklist_regex: Optional[List[str]]
+    paramsblacklist_regex: Optional[List[Union[str, re.Pattern]]]
     paramsblacklist_affiliate: Optional[List[str]]
     paramswhitelist: Optional[List[str]]
     domainwhitelist: Optional[List[str]] = []
     domainwhitelistIgnoreWWW: Optional[bool] = True
     domainwhitelistIgnoreSubdomains: Optional[bool] = True
-    exceptionsregexlist: Optional[List[str]] = []
-    redirectsregexlist: Optional[List[str]] = []
+    exceptionsregexlist: Optional[List[Union[str, re.Pattern]]] = []
+    redirectsregexlist: Optional[List[Union[str, re.Pattern]]] = []
     redirectparameterlist: Optional[List[str]] = []
     removeAllParameters: Optional[bool] = False
     stopAfterThisRule: Optional[bool] = True
@@ -50,6 +65,10 @@ class CleaningRule(BaseModel):
     forceRedirection: Optional[bool]
     testurls: Optional[List[str]]
 
+    class Config:
+        # Rules containing patterns of the linear time engine are stored the same way as rules containing patterns of the re module
+        json_encoders = {LinearPattern: operator.attrgetter('pattern')}
+
     @validator("domainwhitelist")
     def verify_domainwhitelist(cls, value):
         if value is None:
@@ -57,15 +76,26 @@ class CleaningRule(BaseModel):
         else:
             return value
 
-    @validator("rewriteURLSourcePattern")
-    def verify_rewriteURLSourcePattern(cls, value):
+    @validator("rewriteURLSourcePattern", "urlPattern")
+    def verify_pattern(cls, value):
         if value is None:
             return None
-        elif isinstance(value, re.Pattern):
-            return value
         else:
-            value = re.compile(value)
-            return value
+            return compilePattern(value)
+
+    @validator("exceptionsregexlist", "redirectsregexlist")
+    def verify_patternlist(cls, value):
+        if value is None:
+            return []
+        else:
+            return [compilePattern(pattern) for pattern in value]
+
+    @validator("paramsblacklist_regex")
+    def verify_paramsblacklist_regex(cls, value):
+        if value is None:
+            return None
+        else:
+            return [compilePattern(pattern) for pattern in value]
 
     @root_validator()
     def verify_rest(cls, values):
@@ -89,6 +119,31 @@ class CleaningRule(BaseModel):
             raise ValueError(f"{rewriteURLSourcePattern=} is not None while {rewriteURLScheme=} is None")
         return values
 
+    def getSafeCopy(self) -> "CleaningRule":
+        """ Returns copy of this rule whose regular expressions can't cause catastrophic backtracking, see RegexSafety.
+         Raises ValueError if that is not possible.
+         """
+        update = {}
+        for field in ("urlPattern", "rewriteURLSourcePattern"):
+            pattern = getattr(self, field)
+            if pattern is not None:
+                safepattern = makePatternSafe(pattern)
+                if safepattern is not pattern:
+                    update[field] = safepattern
+        for field in ("exceptionsregexlist", "redirectsregexlist", "paramsblacklist_regex"):
+            patterns = getattr(self, field)
+            if patterns:
+                safepatterns = [makePatternSafe(pattern) for pattern in patterns]
+                if any(safepattern is not pattern for safepattern, pattern in zip(safepatterns, patterns)):
+                    update[field] = safepatterns
+        if len(update) == 0:
+            return self
+        return self.copy(update=update)
+
+    def getContentHash(self) -> str:
+        """ Returns hash over all fields of this rule. Rules with the same hash are equal. """
+        return hashlib.sha256(self.json(sort_keys=True).encode('utf-8')).hexdigest()
+
     # def stopAfterThisRule(self) -> bool:
     #     """ If this returns True and the rule was executed successfully on a URL, no further rules need to be processed. """
     #     if len(self.domainwhitelist) > 0:
@@ -97,3 +152,8 @@ class CleaningRule(BaseModel):
     #         return True
     #     else:
     #         return self.forceStopAfterThisRule
+
+
+def encodeCleaningRules(obj):
+    """ Use as default of json.dump(s) to store CleaningRules. """
+    return custom_pydantic_encoder(CleaningRule.__config__.json_encoders, obj)
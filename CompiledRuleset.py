@@ -0,0 +1,271 @@
+import heapq
+import re
+from typing import List, Union, Iterator, Dict, Tuple, Set, Iterable
+
+from CleaningRule import CleaningRule
+
+
+def getDomainSuffixes(domain: str) -> Iterator[str]:
+    """ Returns the given domain and all of its parent domains e.g. 'a.b.example.com' -> 'a.b.example.com', 'b.example.com', 'example.com', 'com'. """
+    yield domain
+    position = domain.find('.')
+    while position != -1:
+        yield domain[position + 1:]
+        position = domain.find('.', position + 1)
+
+
+class RuntimeRule:
+    """ Immutable copy of a CleaningRule which is used while cleaning URLs.
+     CleaningRule stays the format rules are validated, imported and exported with. All fields of a RuntimeRule are normalized once when the ruleset gets compiled:
+     Empty tuples instead of None, frozensets for whitelists, compiled patterns, so applying a rule needs neither None checks nor pydantic attribute access.
+     index: Position of this rule inside CompiledRuleset.rules, CleanedURL refers to applied rules via this index.
+     """
+    __slots__ = ("index", "name", "enabled", "urlPattern", "paramsblacklist", "paramsblacklist_regex", "paramsblacklist_affiliate", "paramswhitelist",
+                 "domainwhitelist", "domainwhitelistIgnoreWWW", "domainwhitelistIgnoreSubdomains", "exceptionsregexlist", "redirectsregexlist",
+                 "redirectparameterlist", "removeAllParameters", "stopAfterThisRule", "rewriteURLSourcePattern", "rewriteURLScheme", "hasRandomChar", "source")
+
+    def __init__(self, rule: CleaningRule, index: int):
+        values = dict(index=index, name=rule.name, enabled=rule.enabled is not False, urlPattern=rule.urlPattern,
+                      paramsblacklist=tuple(rule.paramsblacklist or ()), paramsblacklist_regex=tuple(rule.paramsblacklist_regex or ()),
+                      paramsblacklist_affiliate=tuple(rule.paramsblacklist_affiliate or ()),
+                      # None = No whitelist, empty whitelist = Remove all parameters
+                      paramswhitelist=frozenset(rule.paramswhitelist) if rule.paramswhitelist is not None else None,
+                      domainwhitelist=frozenset(rule.domainwhitelist or ()), domainwhitelistIgnoreWWW=bool(rule.domainwhitelistIgnoreWWW),
+                      domainwhitelistIgnoreSubdomains=bool(rule.domainwhitelistIgnoreSubdomains), exceptionsregexlist=tuple(rule.exceptionsregexlist or ()),
+                      redirectsregexlist=tuple(rule.redirectsregexlist or ()), redirectparameterlist=tuple(rule.redirectparameterlist or ()),
+                      removeAllParameters=bool(rule.removeAllParameters), stopAfterThisRule=bool(rule.stopAfterThisRule),
+                      rewriteURLSourcePattern=rule.rewriteURLSourcePattern, rewriteURLScheme=rule.rewriteURLScheme,
+                      # Results of such rules must not be cached
+                      hasRandomChar=rule.rewriteURLScheme is not None and '<randomchar>' in rule.rewriteURLScheme, source=rule)
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("RuntimeRule is immutable, modify the CleaningRule and compile the ruleset again")
+
+    def __reduce__(self):
+        # All fields are derived from the CleaningRule so only that needs to be stored e.g. in ruleset snapshots
+        return RuntimeRule, (self.source, self.index)
+
+    def __repr__(self) -> str:
+        return f"RuntimeRule({self.index}, {self.name!r})"
+
+
+def isDomainWhitelisted(rule: Union[CleaningRule, RuntimeRule], domain: Union[str, None]) -> bool:
+    """ Returns True if the given domain is allowed by the domainwhitelist of the given rule.
+     Subdomain matching is done on label boundaries: 'ebay.de' allows 'www.ebay.de' but not 'notebay.de'.
+     """
+    if len(rule.domainwhitelist) == 0:
+        return True
+    elif domain is None:
+        return False
+    elif rule.domainwhitelistIgnoreSubdomains:
+        for suffix in getDomainSuffixes(domain):
+            if suffix in rule.domainwhitelist:
+                return True
+        return False
+    else:
+        domainToCompare = domain
+        if rule.domainwhitelistIgnoreWWW:
+            domainToCompare = domain.replace('www.', '')
+        return domainToCompare in rule.domainwhitelist
+
+
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    # Python < 3.11
+    import sre_parse
+
+# Length of the snippets used to look up required literals of urlPatterns
+LITERAL_INDEX_KEY_LENGTH = 4
+# Snippets of this are part of most URLs and thus bad keys for the literal index
+COMMON_URL_TEXT = "https://www."
+# Below this number of patterns with literals, checking all literals is faster than looking up all snippets of a URL
+LITERAL_INDEX_MIN_PATTERNS = 64
+
+
+def getRequiredLiteral(pattern: re.Pattern) -> Union[str, None]:
+    """ Returns the longest text which must be part of every string matched by the given pattern or None if there is no such text.
+     Only looks at literals which are not part of any group, repetition or alternative e.g. '^https?://(?:[a-z0-9-]+\\.)*?amazon(?:\\.[a-z]{2,}){1,}' -> 'amazon'.
+     """
+    if pattern.flags & (re.IGNORECASE | re.VERBOSE):
+        return None
+    try:
+        parsedpattern = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return None
+    longestliteral = ""
+    currentliteral = []
+    for opcode, argument in list(parsedpattern) + [(None, None)]:
+        if opcode == sre_parse.LITERAL:
+            currentliteral.append(chr(argument))
+            continue
+        if len(currentliteral) > len(longestliteral):
+            longestliteral = "".join(currentliteral)
+        currentliteral = []
+    if len(longestliteral) == 0:
+        return None
+    return longestliteral
+
+
+def getSnippets(text: str) -> List[str]:
+    """ Returns all substrings of given text with length LITERAL_INDEX_KEY_LENGTH. """
+    return [text[position:position + LITERAL_INDEX_KEY_LENGTH] for position in range(len(text) - LITERAL_INDEX_KEY_LENGTH + 1)]
+
+
+class URLPatternMatcher:
+    """ Finds all urlPatterns which match a URL without running every single pattern.
+     Most urlPatterns contain a required literal e.g. the name of the website. Such patterns are indexed by the rarest snippet of that literal and
+     are only searched if the URL contains the complete literal so the costs of a lookup mostly depend on the length of the URL and not on the number of patterns.
+     Patterns without usable literal are checked one by one.
+     Merging all patterns into one big regular expression of lookaheads was tried before, but with Pythons re module that was slower than searching the patterns one by one.
+     """
+
+    def __init__(self, patterns: List[Tuple[int, re.Pattern]]):
+        # Snippet of required literal -> (required literal, rule index, pattern)
+        self.literalindex: Dict[str, List[Tuple[str, int, re.Pattern]]] = {}
+        # Patterns which need to be checked separately: (rule index, pattern)
+        self.separatepatterns: List[Tuple[int, re.Pattern]] = []
+        # (required literal, rule index, pattern)
+        self.literalpatterns: List[Tuple[str, int, re.Pattern]] = []
+        # Snippet -> Number of literals containing it
+        snippetcounts: Dict[str, int] = {}
+        for ruleindex, pattern in patterns:
+            literal = getRequiredLiteral(pattern)
+            if literal is None or len(literal) < LITERAL_INDEX_KEY_LENGTH:
+                self.separatepatterns.append((ruleindex, pattern))
+                continue
+            self.literalpatterns.append((literal, ruleindex, pattern))
+            for snippet in set(getSnippets(literal)):
+                snippetcounts[snippet] = snippetcounts.get(snippet, 0) + 1
+        for literal, ruleindex, pattern in self.literalpatterns:
+            # Use rarest snippet so that as few patterns as possible share the same key e.g. 'amaz' instead of 'http'
+            snippet = min(getSnippets(literal), key=lambda item: (snippetcounts[item], item in COMMON_URL_TEXT))
+            self.literalindex.setdefault(snippet, []).append((literal, ruleindex, pattern))
+
+    def getMatchingRuleIndices(self, url: str) -> Set[int]:
+        """ Returns indices of all rules whose urlPattern matches the given URL. """
+        matchingindices = set()
+        if len(self.literalpatterns) < LITERAL_INDEX_MIN_PATTERNS:
+            for literal, ruleindex, pattern in self.literalpatterns:
+                if literal in url and pattern.search(url) is not None:
+                    matchingindices.add(ruleindex)
+        else:
+            for snippet in set(getSnippets(url)):
+                entries = self.literalindex.get(snippet)
+                if entries is None:
+                    continue
+                for literal, ruleindex, pattern in entries:
+                    if literal in url and pattern.search(url) is not None:
+                        matchingindices.add(ruleindex)
+        for ruleindex, pattern in self.separatepatterns:
+            if pattern.search(url) is not None:
+                matchingindices.add(ruleindex)
+        return matchingindices
+
+
+def isGlobalBlacklistRule(rule: CleaningRule) -> bool:
+    """ Returns True if the only thing the given rule does is removing a fixed list of parameters from any URL. """
+    return rule.enabled is not False and len(rule.domainwhitelist) == 0 and rule.urlPattern is None and len(rule.exceptionsregexlist) == 0 \
+        and len(rule.redirectsregexlist) == 0 and len(rule.redirectparameterlist) == 0 and rule.rewriteURLSourcePattern is None \
+        and not rule.removeAllParameters and rule.paramswhitelist is None and not rule.paramsblacklist_regex \
+        and not rule.paramsblacklist_affiliate and bool(rule.paramsblacklist)
+
+
+class CompiledRuleset:
+    """ Indexed view on a list of CleaningRules.
+     Allows to only evaluate the rules which can match a given URL instead of walking through the complete list of rules for every URL.
+     Rules returned by getCandidateRules are always returned in their original order so the behavior of stopAfterThisRule stays the same.
+     """
+
+    def __init__(self, rules: List[CleaningRule], version: int = 0):
+        self.rules = tuple(rules)
+        # What URLCleaner actually uses, same order as self.rules
+        self.runtimerules = tuple(RuntimeRule(rule, index) for index, rule in enumerate(self.rules))
+        self.version = version
+        # Indices of rules without domain restriction and urlPattern -> Need to be evaluated for every URL
+        self.globalrules: List[int] = []
+        # Indices of rules without domain restriction but with urlPattern -> Only need to be evaluated if their pattern matches
+        self.globalpatternrules: Set[int] = set()
+        # Indices of all rules with urlPattern
+        self.patternrules: Set[int] = set()
+        # Indices of rules which only remove a fixed list of parameters from any URL, see isGlobalBlacklistRule
+        self.globalblacklistrules: List[int] = []
+        # Parameter -> (index of first rule which removes it, position inside blacklist of that rule)
+        self.globalblacklistowners: Dict[str, Tuple[int, int]] = {}
+        # Domain -> Indices of rules which are allowed to run on this domain and all of its subdomains
+        self.domainsuffixmap: Dict[str, List[int]] = {}
+        # Domain -> Indices of rules which are only allowed to run on exactly this domain
+        self.domainexactmap: Dict[str, List[int]] = {}
+        # Same as above but for rules which ignore 'www.' in domain matching
+        self.domainexactmap_ignorewww: Dict[str, List[int]] = {}
+        patterns = []
+        for index, rule in enumerate(self.runtimerules):
+            if rule.urlPattern is not None:
+                self.patternrules.add(index)
+                patterns.append((index, rule.urlPattern))
+            if len(rule.domainwhitelist) == 0:
+                if rule.urlPattern is not None:
+                    self.globalpatternrules.add(index)
+                else:
+                    self.globalrules.append(index)
+                    if isGlobalBlacklistRule(rule.source):
+                        self.globalblacklistrules.append(index)
+                        for position, param in enumerate(rule.paramsblacklist):
+                            self.globalblacklistowners.setdefault(param, (index, position))
+                continue
+            if rule.domainwhitelistIgnoreSubdomains:
+                targetmap = self.domainsuffixmap
+            elif rule.domainwhitelistIgnoreWWW:
+                targetmap = self.domainexactmap_ignorewww
+            else:
+                targetmap = self.domainexactmap
+            for domain in rule.domainwhitelist:
+                indices = targetmap.setdefault(domain.lower(), [])
+                # Do not add the same rule twice if its whitelist contains duplicates
+                if len(indices) == 0 or indices[-1] != index:
+                    indices.append(index)
+        self.urlpatternmatcher = URLPatternMatcher(patterns)
+        # All parameters removed by global blacklist rules
+        self.globalblacklist = frozenset(self.globalblacklistowners.keys())
+        # Global rules with all global blacklist rules being replaced by the first of them which stands for all of them, see getCandidateRuleIndices
+        globalblacklistrules = set(self.globalblacklistrules[1:])
+        self.globalrules_merged = [index for index in self.globalrules if index not in globalblacklistrules]
+
+    def getCandidateRules(self, url: str, domain: Union[str, None]) -> Iterator[CleaningRule]:
+        """ Returns all rules which are allowed to run on the given domain and whose urlPattern matches the given URL in their original order. """
+        for index in self.getCandidateRuleIndices(url, domain):
+            yield self.rules[index]
+
+    def getCandidateRuleIndices(self, url: str, domain: Union[str, None], mergeGlobalBlacklists: bool = False) -> Iterable[int]:
+        """ Returns indices of all rules which are allowed to run on the given domain and whose urlPattern matches the given URL in ascending order.
+         mergeGlobalBlacklists: Only return the index of the first global blacklist rule instead of all of them.
+         The caller is expected to apply all global blacklist rules at once when it reaches that index.
+         """
+        globalrules = self.globalrules_merged if mergeGlobalBlacklists else self.globalrules
+        if len(self.patternrules) > 0:
+            matchingpatternrules = self.urlpatternmatcher.getMatchingRuleIndices(url)
+        else:
+            matchingpatternrules = set()
+        # Global rules with urlPattern are treated like domain specific rules
+        matchedindices = self.globalpatternrules & matchingpatternrules
+        if domain is not None:
+            if len(self.domainsuffixmap) > 0:
+                for suffix in getDomainSuffixes(domain):
+                    indices = self.domainsuffixmap.get(suffix)
+                    if indices is not None:
+                        matchedindices.update(indices)
+            indices = self.domainexactmap.get(domain)
+            if indices is not None:
+                matchedindices.update(indices)
+            indices = self.domainexactmap_ignorewww.get(domain.replace('www.', ''))
+            if indices is not None:
+                matchedindices.update(indices)
+            # Remove domain specific rules whose urlPattern does not match
+            matchedindices = {index for index in matchedindices if index not in self.patternrules or index in matchingpatternrules}
+        if len(matchedindices) == 0:
+            # Most common case: No special rules for this domain
+            return globalrules
+        else:
+            return heapq.merge(globalrules, sorted(matchedindices))
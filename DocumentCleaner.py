@@ -0,0 +1,166 @@
+import codecs
+import html
+import re
+import time
+from typing import List, Dict, Tuple, AsyncIterator, Iterable, Union
+
+from URLCleaner import URLCleaner, findURLs, URL_REGEX
+
+# Finds URLs inside documents of the given formats. URLs inside HTML attributes and unquoted CSV fields end at the quote/separator, see findCSVURLs.
+DOCUMENT_URL_REGEXES = {
+    "txt": URL_REGEX,
+    "csv": re.compile(r'(?i)(https?://[^\s",;]+)'),
+    "html": re.compile(r'(?i)(https?://[^\s"\'<>]+)'),
+}
+DOCUMENT_FORMATS = {"txt": "txt", "csv": "csv", "html": "html", "htm": "html"}
+# Single CSV field: Quoted field with "" as escaped quote, quoted field which continues on the next line or unquoted field
+CSV_FIELD_REGEX = re.compile(r'"(?:[^"]|"")*"?|[^,;]*')
+# URLs inside quoted CSV fields may contain separators
+CSV_QUOTED_URL_REGEX = re.compile(r'(?i)(https?://[^\s"]+)')
+
+
+class DocumentTooLargeError(Exception):
+    pass
+
+
+class DocumentStats:
+    """ Summary of a cleaned document. """
+
+    def __init__(self):
+        self.lines = 0
+        self.urls = 0
+        self.cleanedurls = 0
+        # Rule name -> Number of URLs it was applied to
+        self.rules: Dict[str, int] = {}
+        # Parameter -> Number of times it was removed
+        self.removedparams: Dict[str, int] = {}
+        # CPU time in seconds spent on cleaning
+        self.cputime = 0.0
+        # True if cleaning stopped because the URL or time budget was used up, the rest of the document is unchanged
+        self.isIncomplete = False
+
+    def update(self, other: "DocumentStats"):
+        self.lines += other.lines
+        self.urls += other.urls
+        self.cleanedurls += other.cleanedurls
+        self.cputime += other.cputime
+        self.isIncomplete = self.isIncomplete or other.isIncomplete
+        for rulename, count in other.rules.items():
+            self.rules[rulename] = self.rules.get(rulename, 0) + count
+        for param, count in other.removedparams.items():
+            self.removedparams[param] = self.removedparams.get(param, 0) + count
+
+
+def getDocumentFormat(filename: str) -> str:
+    """ Returns format of the file with given name, see DOCUMENT_FORMATS. Raises ValueError for unsupported files. """
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    documentformat = DOCUMENT_FORMATS.get(extension)
+    if documentformat is None:
+        raise ValueError(f"Unsupported document type: {filename}")
+    return documentformat
+
+
+def findCSVURLs(line: str) -> List[Tuple[int, int]]:
+    """ Returns (start, end) positions of all URLs inside a line of a CSV file separated by ',' or ';'.
+     URLs inside unquoted fields end at the next separator, URLs inside quoted fields only end at whitespace or the closing quote
+     e.g. '"https://example.com/?ids=1,2"'. Fields are split per line so quoted fields spanning multiple lines are treated like unquoted ones after the first line.
+     """
+    urlregex = DOCUMENT_URL_REGEXES["csv"]
+    if '"' not in line:
+        # Most lines: No need to split them into fields
+        return findURLs(line, urlregex)
+    spans = []
+    position = 0
+    while position <= len(line):
+        start, end = CSV_FIELD_REGEX.match(line, position).span()
+        if end > start:
+            fieldregex = CSV_QUOTED_URL_REGEX if line[start] == '"' else urlregex
+            spans.extend((start + urlstart, start + urlend) for urlstart, urlend in findURLs(line[start:end], fieldregex))
+        # Skip separator
+        position = end + 1
+    return spans
+
+
+def cleanDocumentLines(cleaner: URLCleaner, lines: List[str], documentformat: str, maxurls: Union[int, None] = None,
+                       timebudget: Union[float, None] = None) -> Tuple[List[str], DocumentStats]:
+    """ Cleans all URLs inside given lines of a document. Everything except the URLs stays untouched.
+     URLs inside HTML are unescaped before and escaped again after cleaning e.g. 'a=1&amp;utm_source=x'.
+     maxurls, timebudget: Stop cleaning after this many URLs or once this much CPU time in seconds has been used, see DocumentStats.isIncomplete.
+     """
+    urlregex = DOCUMENT_URL_REGEXES[documentformat]
+    isHTML = documentformat == "html"
+    isCSV = documentformat == "csv"
+    ruleset = cleaner.getRuleset()
+    stats = DocumentStats()
+    timestart = time.thread_time()
+    if timebudget is not None:
+        deadline = timestart + timebudget
+    cleanedlines = []
+    for line in lines:
+        stats.lines += 1
+        if stats.isIncomplete:
+            cleanedlines.append(line)
+            continue
+        spans = findCSVURLs(line) if isCSV else findURLs(line, urlregex)
+        if len(spans) == 0:
+            cleanedlines.append(line)
+            continue
+        parts = []
+        position = 0
+        for start, end in spans:
+            if (maxurls is not None and stats.urls >= maxurls) or (timebudget is not None and time.thread_time() > deadline):
+                stats.isIncomplete = True
+                break
+            url = line[start:end]
+            if isHTML and '&' in url:
+                url = html.unescape(url)
+            cleanedurl = cleaner.cleanSingleURL(url, ruleset)
+            if cleanedurl is None:
+                continue
+            stats.urls += 1
+            if len(cleanedurl.appliedruleindices) == 0:
+                continue
+            stats.cleanedurls += 1
+            for rule in cleanedurl.appliedrules:
+                stats.rules[rule.name] = stats.rules.get(rule.name, 0) + 1
+            for param in cleanedurl.removedparams_tracking + cleanedurl.removedparams_affiliate:
+                stats.removedparams[param] = stats.removedparams.get(param, 0) + 1
+            result = cleanedurl.getURL()
+            parts.append(line[position:start])
+            parts.append(html.escape(result) if isHTML else result)
+            position = end
+        parts.append(line[position:])
+        cleanedlines.append("".join(parts))
+    stats.cputime = time.thread_time() - timestart
+    return cleanedlines, stats
+
+
+async def iterLineBatches(chunks: AsyncIterator[bytes], batchsize: int, maxsize: int) -> AsyncIterator[List[str]]:
+    """ Decodes a document which is received in chunks and returns it in batches of lines so it never has to be in memory completely.
+     Lines keep their line break except for the last one so joining all lines restores the document. Invalid UTF-8 gets replaced.
+     Raises DocumentTooLargeError as soon as more than maxsize bytes have been received.
+     """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    size = 0
+    pending = ""
+    batch = []
+    async for chunk in chunks:
+        size += len(chunk)
+        if size > maxsize:
+            raise DocumentTooLargeError(f"Document is larger than {maxsize} bytes")
+        pending += decoder.decode(chunk)
+        lines = pending.split('\n')
+        pending = lines.pop()
+        batch.extend(line + '\n' for line in lines)
+        if len(batch) >= batchsize:
+            yield batch
+            batch = []
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        batch.append(pending)
+    if batch:
+        yield batch
+
+
+def getTopEntries(counts: Dict[str, int], limit: int) -> Iterable[Tuple[str, int]]:
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
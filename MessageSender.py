@@ -0,0 +1,130 @@
+import asyncio
+import time
+from typing import Dict, List, Union, Callable, Awaitable, Any
+
+from telegram import Bot, Message
+from telegram.error import RetryAfter
+
+# Max length of a text message after entities have been parsed, see https://core.telegram.org/bots/api#sendmessage
+MAX_MESSAGE_LENGTH = 4096
+# Per chat buckets which are full again get removed once there are more than this
+MAX_IDLE_BUCKETS = 10000
+
+
+class TokenBucket:
+    """ Allows rate actions per second on average and bursts of up to capacity actions. Waiting callers are served in order. """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        # time.monotonic() until which nothing may be sent e.g. after Telegram answered with 'retry after'
+        self.blockeduntil = 0.0
+        # asyncio.Lock wakes up waiters in FIFO order
+        self.lock = asyncio.Lock()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                waittime = max(self.blockeduntil - now, (1 - self.tokens) / self.rate)
+                if waittime <= 0:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(waittime)
+
+    def block(self, seconds: float):
+        self.blockeduntil = max(self.blockeduntil, time.monotonic() + seconds)
+
+    def isIdle(self) -> bool:
+        now = time.monotonic()
+        self.refill(now)
+        return self.tokens >= self.capacity and now >= self.blockeduntil and not self.lock.locked()
+
+
+def splitMessage(blocks: List[str], separator: str = "\n", maxlength: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """ Joins blocks to as few messages as possible without splitting any block e.g. the HTML of one URL.
+     Blocks longer than maxlength need to be shortened by the caller.
+     """
+    messages = []
+    current = None
+    for block in blocks:
+        if current is None:
+            current = block
+        elif len(current) + len(separator) + len(block) <= maxlength:
+            current += separator + block
+        else:
+            messages.append(current)
+            current = block
+    if current is not None:
+        messages.append(current)
+    return messages
+
+
+class MessageSender:
+    """ Sends all messages of the bot so it stays within the limits of Telegram (https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this):
+     About 30 messages per second overall, one message per second per chat and 20 messages per minute per group.
+     Every chat has its own token bucket followed by a global one so bursts are queued and sent as fast as allowed instead of failing.
+     If Telegram still answers with 'retry after', the chat is paused for that time and the message is sent again.
+     """
+
+    def __init__(self, bot: Bot, globalrate: float = 30, chatrate: float = 1, chatburst: float = 3, grouprate: float = 20 / 60, groupburst: float = 5,
+                 maxretries: int = 3):
+        self.bot = bot
+        self.globalbucket = TokenBucket(globalrate, globalrate)
+        self.chatrate = chatrate
+        self.chatburst = chatburst
+        self.grouprate = grouprate
+        self.groupburst = groupburst
+        self.maxretries = maxretries
+        self.chatbuckets: Dict[int, TokenBucket] = {}
+
+    def getChatBucket(self, chatid: int) -> TokenBucket:
+        bucket = self.chatbuckets.get(chatid)
+        if bucket is None:
+            if len(self.chatbuckets) >= MAX_IDLE_BUCKETS:
+                self.chatbuckets = {otherchatid: otherbucket for otherchatid, otherbucket in self.chatbuckets.items() if not otherbucket.isIdle()}
+            # Groups and channels have negative IDs
+            if chatid < 0:
+                bucket = TokenBucket(self.grouprate, self.groupburst)
+            else:
+                bucket = TokenBucket(self.chatrate, self.chatburst)
+            self.chatbuckets[chatid] = bucket
+        return bucket
+
+    async def send(self, chatid: int, method: Callable[..., Awaitable[Any]], **kwargs) -> Any:
+        """ Calls method(chat_id=chatid, **kwargs) e.g. Bot.send_document as soon as the limits allow it. """
+        bucket = self.getChatBucket(chatid)
+        for attempt in range(self.maxretries + 1):
+            await bucket.acquire()
+            await self.globalbucket.acquire()
+            try:
+                return await method(chat_id=chatid, **kwargs)
+            except RetryAfter as error:
+                if attempt == self.maxretries:
+                    raise
+                print(f"Telegram asked to wait {error.retry_after} seconds before sending messages to chat {chatid}")
+                bucket.block(error.retry_after)
+                document = kwargs.get("document")
+                if hasattr(document, "seek"):
+                    # File has already been read for the failed request
+                    document.seek(0)
+
+    async def sendMessage(self, chatid: int, text: str, **kwargs) -> Message:
+        return await self.send(chatid, self.bot.send_message, text=text, **kwargs)
+
+    async def sendMessages(self, chatid: int, texts: List[str], **kwargs) -> Union[Message, None]:
+        """ Sends given texts one after another e.g. parts of a long reply. Returns the last message. """
+        message = None
+        for text in texts:
+            message = await self.sendMessage(chatid, text, **kwargs)
+        return message
+
+    async def sendDocument(self, chatid: int, **kwargs) -> Message:
+        return await self.send(chatid, self.bot.send_document, **kwargs)
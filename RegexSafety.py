@@ -0,0 +1,315 @@
+import re
+from typing import List, Set, Union, Iterator, Tuple
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:
+    # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+try:
+    # Optional linear time regex engine: pip install -r requirements-optional.txt
+    import re2
+except ImportError:
+    re2 = None
+
+# Characters are modelled as ASCII codes plus this value for all other characters
+OTHER_CHARS = -1
+ALL_CHARS = frozenset(range(128)) | {OTHER_CHARS}
+CATEGORY_CHARS = {
+    sre_constants.CATEGORY_DIGIT: frozenset(ord(char) for char in "0123456789"),
+    sre_constants.CATEGORY_SPACE: frozenset(ord(char) for char in " \t\n\r\f\v") | {OTHER_CHARS},
+    sre_constants.CATEGORY_WORD: frozenset(ord(char) for char in "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_") | {OTHER_CHARS},
+}
+CATEGORY_CHARS[sre_constants.CATEGORY_NOT_DIGIT] = ALL_CHARS - CATEGORY_CHARS[sre_constants.CATEGORY_DIGIT]
+CATEGORY_CHARS[sre_constants.CATEGORY_NOT_SPACE] = ALL_CHARS - CATEGORY_CHARS[sre_constants.CATEGORY_SPACE] | {OTHER_CHARS}
+CATEGORY_CHARS[sre_constants.CATEGORY_NOT_WORD] = ALL_CHARS - CATEGORY_CHARS[sre_constants.CATEGORY_WORD] | {OTHER_CHARS}
+REPEAT_OPCODES = (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT)
+# Repetitions with a lower max count can only cause polynomial backtracking
+MAX_HARMLESS_REPETITIONS = 10
+# Flags of the re module -> Inline flag supported by re2
+RE2_INLINE_FLAGS = {re.IGNORECASE: "i", re.MULTILINE: "m", re.DOTALL: "s"}
+# Flags without effect on str patterns, re.UNICODE is set for all of them
+RE2_IGNORED_FLAGS = re.UNICODE | re.ASCII
+
+
+def getRE2Pattern(pattern: re.Pattern) -> str:
+    """ Returns the pattern string of given compiled pattern including its flags as re2 does not know the flags of the re module.
+     Raises ValueError for flags re2 does not support e.g. re.VERBOSE.
+     """
+    flags = pattern.flags & ~RE2_IGNORED_FLAGS
+    inlineflags = ""
+    for flag, inlineflag in RE2_INLINE_FLAGS.items():
+        if flags & flag:
+            inlineflags += inlineflag
+            flags &= ~flag
+    if flags != 0:
+        raise ValueError(f"Flags not supported by re2: {re.RegexFlag(flags)!r}")
+    if len(inlineflags) == 0:
+        return pattern.pattern
+    return f"(?{inlineflags}){pattern.pattern}"
+
+
+class LinearPattern:
+    """ Pattern which gets executed by the linear time engine re2 but can be used like a compiled pattern of the re module. """
+
+    def __init__(self, pattern: re.Pattern):
+        self.pattern = pattern.pattern
+        self.flags = pattern.flags
+        self.compiledpattern = re2.compile(getRE2Pattern(pattern))
+
+    def search(self, string: str, *args):
+        return self.compiledpattern.search(string, *args)
+
+    def match(self, string: str, *args):
+        return self.compiledpattern.match(string, *args)
+
+    def fullmatch(self, string: str, *args):
+        return self.compiledpattern.fullmatch(string, *args)
+
+    def finditer(self, string: str, *args) -> Iterator:
+        return self.compiledpattern.finditer(string, *args)
+
+    def __reduce__(self):
+        # re2 patterns can't be pickled -> Compile again after loading
+        return LinearPattern, (re.compile(self.pattern, self.flags),)
+
+    def __repr__(self) -> str:
+        return f"LinearPattern({self.pattern!r})"
+
+
+def addCaseVariants(chars: Set[int]) -> Set[int]:
+    return chars | {ord(chr(char).swapcase()) for char in chars if char != OTHER_CHARS and chr(char).isalpha()}
+
+
+def getSetChars(items: list) -> Set[int]:
+    """ Returns characters matched by the content of a character set e.g. [^a-z0-9]. """
+    chars = set()
+    negate = False
+    for opcode, argument in items:
+        if opcode == sre_constants.NEGATE:
+            negate = True
+        elif opcode == sre_constants.LITERAL:
+            chars.add(argument if argument < 128 else OTHER_CHARS)
+        elif opcode == sre_constants.RANGE:
+            low, high = argument
+            chars.update(range(low, min(high, 127) + 1))
+            if high >= 128:
+                chars.add(OTHER_CHARS)
+        elif opcode == sre_constants.CATEGORY:
+            chars.update(CATEGORY_CHARS.get(argument, ALL_CHARS))
+        else:
+            chars.update(ALL_CHARS)
+    if negate:
+        # Non-ASCII characters are both inside and outside of most sets
+        chars = (ALL_CHARS - chars) | {OTHER_CHARS}
+    return chars
+
+
+def getItemChars(opcode, argument, ignorecase: bool, firstonly: bool) -> Set[int]:
+    """ Returns all characters which can be part of a match of the given item, only the possible first characters if firstonly is True. """
+    if opcode == sre_constants.LITERAL:
+        chars = {argument if argument < 128 else OTHER_CHARS}
+    elif opcode == sre_constants.NOT_LITERAL:
+        chars = set(ALL_CHARS - {argument}) | {OTHER_CHARS}
+    elif opcode == sre_constants.ANY:
+        chars = set(ALL_CHARS)
+    elif opcode == sre_constants.IN:
+        chars = getSetChars(argument)
+    elif opcode == sre_constants.CATEGORY:
+        chars = set(CATEGORY_CHARS.get(argument, ALL_CHARS))
+    elif opcode in REPEAT_OPCODES or opcode == getattr(sre_constants, "POSSESSIVE_REPEAT", None):
+        chars = getSequenceChars(argument[2], ignorecase, firstonly)
+    elif opcode == sre_constants.SUBPATTERN:
+        chars = getSequenceChars(argument[3], ignorecase, firstonly)
+    elif opcode == getattr(sre_constants, "ATOMIC_GROUP", None):
+        chars = getSequenceChars(argument, ignorecase, firstonly)
+    elif opcode == sre_constants.BRANCH:
+        chars = set()
+        for alternative in argument[1]:
+            chars |= getSequenceChars(alternative, ignorecase, firstonly)
+    elif opcode in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+        # Zero width
+        chars = set()
+    else:
+        chars = set(ALL_CHARS)
+    return addCaseVariants(chars) if ignorecase else chars
+
+
+def canBeEmpty(opcode, argument) -> bool:
+    if opcode in REPEAT_OPCODES or opcode == getattr(sre_constants, "POSSESSIVE_REPEAT", None):
+        return argument[0] == 0 or all(canBeEmpty(*item) for item in argument[2])
+    elif opcode == sre_constants.SUBPATTERN:
+        return all(canBeEmpty(*item) for item in argument[3])
+    elif opcode == sre_constants.BRANCH:
+        return any(all(canBeEmpty(*item) for item in alternative) for alternative in argument[1])
+    return opcode in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT)
+
+
+def getSequenceChars(items, ignorecase: bool, firstonly: bool) -> Set[int]:
+    chars = set()
+    for opcode, argument in items:
+        chars |= getItemChars(opcode, argument, ignorecase, firstonly)
+        if firstonly and not canBeEmpty(opcode, argument):
+            break
+    return chars
+
+
+def getWidth(items) -> Tuple[int, Union[int, None]]:
+    """ Returns min and max length of the text matched by the given sequence, None = unlimited. """
+    minwidth = 0
+    maxwidth = 0
+    for opcode, argument in items:
+        if opcode in (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.ANY, sre_constants.IN, sre_constants.CATEGORY):
+            itemmin, itemmax = 1, 1
+        elif opcode in REPEAT_OPCODES or opcode == getattr(sre_constants, "POSSESSIVE_REPEAT", None):
+            bodymin, bodymax = getWidth(argument[2])
+            itemmin = argument[0] * bodymin
+            itemmax = None if argument[1] == sre_constants.MAXREPEAT or bodymax is None else argument[1] * bodymax
+        elif opcode == sre_constants.SUBPATTERN:
+            itemmin, itemmax = getWidth(argument[3])
+        elif opcode == getattr(sre_constants, "ATOMIC_GROUP", None):
+            itemmin, itemmax = getWidth(argument)
+        elif opcode == sre_constants.BRANCH:
+            widths = [getWidth(alternative) for alternative in argument[1]]
+            itemmin = min(width[0] for width in widths)
+            itemmax = None if any(width[1] is None for width in widths) else max(width[1] for width in widths)
+        elif opcode in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            itemmin, itemmax = 0, 0
+        else:
+            itemmin, itemmax = 0, None
+        minwidth += itemmin
+        maxwidth = None if maxwidth is None or itemmax is None else maxwidth + itemmax
+    return minwidth, maxwidth
+
+
+def flattenGroups(items) -> list:
+    """ Returns given sequence with the content of all groups inserted at their position. """
+    flatitems = []
+    for opcode, argument in items:
+        if opcode == sre_constants.SUBPATTERN:
+            flatitems += flattenGroups(argument[3])
+        else:
+            flatitems.append((opcode, argument))
+    return flatitems
+
+
+def getCatastrophicConstructs(pattern: re.Pattern) -> List[str]:
+    """ Returns descriptions of all parts of the given pattern which can lead to exponential backtracking, empty list = pattern is safe.
+     Finds repetitions of parts which can match the same text in more than one way:
+     Repetitions of variable length parts without a separator which can't be matched by those parts e.g. '(a+)+' or '(\\w+\\s?)*' but not '([a-z]+\\.)*'.
+     Repeated alternatives which can start with the same character e.g. '(ab|a.)*' or which are the same after sre_parse moved their common prefix out of
+     the group e.g. '(a|a)*' which gets parsed as 'a(?:|)'.
+     Unbounded repetitions next to each other which can match the same characters inside of another repetition e.g. '(\\d*\\w*x)*'.
+     The same outside of repetitions e.g. '.*.*=.*' only causes polynomial backtracking and is not reported.
+     """
+    try:
+        parsedpattern = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return []
+    ignorecase = bool(pattern.flags & re.IGNORECASE)
+    problems = []
+
+    def isDeterministicBranch(alternatives) -> bool:
+        seenchars = set()
+        for alternative in alternatives:
+            minwidth, maxwidth = getWidth(alternative)
+            firstchars = getSequenceChars(alternative, ignorecase, firstonly=True)
+            if minwidth == 0 or minwidth != maxwidth or not seenchars.isdisjoint(firstchars):
+                return False
+            seenchars |= firstchars
+        return True
+
+    def checkAdjacentRepetitions(items):
+        # Unbounded repetitions which are only separated by optional parts can split the same text in many ways e.g. '[a-z]*[a-z/]*x'
+        previouschars = None
+        for opcode, argument in flattenGroups(items):
+            if opcode in REPEAT_OPCODES and argument[1] == sre_constants.MAXREPEAT:
+                chars = getSequenceChars(argument[2], ignorecase, firstonly=False)
+                if previouschars is not None and not previouschars.isdisjoint(chars):
+                    problems.append("Adjacent repetitions which can match the same text")
+                    return
+                previouschars = chars
+            elif not canBeEmpty(opcode, argument):
+                previouschars = None
+
+    def checkSequence(items, isRepeated: bool):
+        if isRepeated:
+            checkAdjacentRepetitions(items)
+        for opcode, argument in items:
+            if opcode in REPEAT_OPCODES:
+                body = argument[2]
+                isUnbounded = argument[1] == sre_constants.MAXREPEAT or argument[1] > MAX_HARMLESS_REPETITIONS
+                if isUnbounded:
+                    checkRepeatedBody(flattenGroups(body))
+                checkSequence(body, isRepeated or isUnbounded)
+            elif opcode == sre_constants.SUBPATTERN:
+                checkSequence(argument[3], isRepeated)
+            elif opcode == sre_constants.BRANCH:
+                for alternative in argument[1]:
+                    checkSequence(alternative, isRepeated)
+            elif opcode in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+                checkSequence(argument[1], isRepeated)
+
+    def checkRepeatedBody(body):
+        # Parts which can match texts of different lengths are the ones which allow to split a text into iterations in more than one way
+        variablechars = set()
+        fixeditems = []
+        for opcode, argument in body:
+            if opcode == getattr(sre_constants, "POSSESSIVE_REPEAT", None) or opcode == getattr(sre_constants, "ATOMIC_GROUP", None):
+                # Never backtracks
+                continue
+            if opcode == sre_constants.BRANCH and isDeterministicBranch(argument[1]):
+                # e.g. '(?:www\\.|m\\.)': Only one alternative can match at any position
+                continue
+            minwidth, maxwidth = getWidth([(opcode, argument)])
+            if minwidth != maxwidth:
+                variablechars |= getItemChars(opcode, argument, ignorecase, firstonly=False)
+            elif minwidth > 0:
+                fixeditems.append((opcode, argument))
+        if len(variablechars) > 0:
+            # Safe if a mandatory part of the body can't be matched by any of the variable parts: It marks the end of every iteration
+            if not any(getItemChars(opcode, argument, ignorecase, firstonly=False).isdisjoint(variablechars) for opcode, argument in fixeditems):
+                problems.append("Nested repetition without separator")
+        for opcode, argument in body:
+            if opcode != sre_constants.BRANCH:
+                continue
+            seenchars = set()
+            numemptyalternatives = 0
+            for alternative in argument[1]:
+                # Identical alternatives are left over after sre_parse moved their common prefix out of the group e.g. '(a|a)*' -> 'a(?:|)'
+                if all(canBeEmpty(*item) for item in alternative):
+                    numemptyalternatives += 1
+                firstchars = getSequenceChars(alternative, ignorecase, firstonly=True)
+                if not seenchars.isdisjoint(firstchars) or numemptyalternatives > 1:
+                    problems.append("Repeated alternatives which can match the same text")
+                    break
+                seenchars |= firstchars
+
+    checkSequence(parsedpattern, False)
+    # Nested groups get checked more than once
+    return list(dict.fromkeys(problems))
+
+
+def makePatternSafe(pattern: Union[re.Pattern, LinearPattern]) -> Union[re.Pattern, LinearPattern]:
+    """ Returns given pattern if it is safe or its linear time version. Raises ValueError if the pattern is unsafe and can't be executed in linear time. """
+    if isinstance(pattern, LinearPattern):
+        return pattern
+    problems = getCatastrophicConstructs(pattern)
+    if len(problems) == 0:
+        return pattern
+    linearpattern = compileLinear(pattern)
+    if linearpattern is None:
+        raise ValueError(f"Regular expression can cause catastrophic backtracking: {pattern.pattern!r} | {', '.join(problems)}")
+    return linearpattern
+
+
+def compileLinear(pattern: re.Pattern) -> Union[LinearPattern, None]:
+    """ Returns given pattern compiled by the linear time engine or None if it is not available or does not support the pattern e.g. because of back references. """
+    if re2 is None:
+        return None
+    try:
+        return LinearPattern(pattern)
+    except Exception:
+        return None
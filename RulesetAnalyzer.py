@@ -0,0 +1,457 @@
+import argparse
+import json
+import random
+import re
+import sys
+from typing import List, NamedTuple, Union, Tuple, Iterable, Dict
+
+from CleaningRule import CleaningRule, encodeCleaningRules
+from CompiledRuleset import isGlobalBlacklistRule, sre_parse
+from URLCleaner import URLCleaner, findURLs
+
+# Checks a list of rules for rules and parameters which can never have any effect and builds a smaller list of rules which cleans every URL the same way.
+# Example: python3 RulesetAnalyzer.py --rules data.minify.json --fix -o cleaningrules_minimized.json
+# All checks assume the default mode of URLCleaner (mergeGlobalBlacklists disabled) and URLs found via findURLs.
+
+# Same parameter listed multiple times inside one rule
+FINDING_DUPLICATE_PARAMETER = "duplicate_parameter"
+# Parameter which is always removed by an earlier rule before this rule gets to see it
+FINDING_REDUNDANT_PARAMETER = "redundant_parameter"
+# Rule which can never change anything because an earlier rule always handles all URLs it could handle
+FINDING_SHADOWED_RULE = "shadowed_rule"
+# urlPattern which cannot match any URL found by findURLs
+FINDING_UNREACHABLE_PATTERN = "unreachable_pattern"
+FINDING_DISABLED_RULE = "disabled_rule"
+# Adjacent rules removing fixed lists of parameters from all URLs which can be replaced by a single rule
+FINDING_MERGEABLE_BLACKLISTS = "mergeable_blacklists"
+# Rule whose urlPattern matches domains an earlier domain-scoped rule also handles e.g. imported ClearURLs rules overlapping with the default rules
+# Can't be fixed automatically as the urlPattern also matches other domains e.g. 'techcrunch.de' for an earlier rule on 'techcrunch.com'
+FINDING_OVERLAPPING_RULE = "overlapping_rule"
+# Entry of a domainwhitelist which is most likely a typo, can't be fixed automatically as fixing it changes the behavior
+FINDING_SUSPICIOUS_DOMAIN = "suspicious_domain"
+
+# Every URL found via findURLs starts with one of these, case-insensitive
+URL_PREFIXES = ("http://", "https://")
+DOMAIN_REGEX = re.compile(r'[a-z0-9.-]+')
+# Characters which end the host of a URL without any userinfo or port in front of them
+HOST_TERMINATORS = frozenset(ord(char) for char in "/?#")
+# Fields which may contain duplicate entries without any effect
+DEDUPLICATABLE_FIELDS = ("paramsblacklist", "paramsblacklist_affiliate", "paramswhitelist", "domainwhitelist", "redirectparameterlist")
+
+
+class RulesetFinding(NamedTuple):
+    kind: str
+    rulename: str
+    message: str
+    # True = minimizeRuleset removes this problem without changing the result of any URL
+    isFixable: bool
+
+
+def isRewritingRule(rule: CleaningRule) -> bool:
+    """ Returns True if the given rule can replace the complete URL which means that parameters can appear which were not there before. """
+    return rule.rewriteURLSourcePattern is not None or len(rule.redirectsregexlist) > 0 or len(rule.redirectparameterlist) > 0
+
+
+def isUnconditionalParameterRule(rule: CleaningRule) -> bool:
+    """ Returns True if the given rule only removes parameters and does so on every URL it is allowed to run on. """
+    return rule.enabled is not False and not isRewritingRule(rule) and len(rule.exceptionsregexlist) == 0
+
+
+class HostScope(NamedTuple):
+    """ Hosts a urlPattern can match: The given domain, with or without subdomains in front of it. """
+    domain: str
+    includesSubdomains: bool
+    # False = The domain can be followed by more characters of the host e.g. 'github.com' also matches 'github.com.example.org'
+    isExact: bool
+
+
+def isHostTerminator(items) -> bool:
+    """ Returns True if the given parsed sequence can only match at the end of a host, see HOST_TERMINATORS. """
+    if len(items) == 0:
+        return False
+    opcode, argument = items[0]
+    if opcode == sre_parse.LITERAL:
+        return argument in HOST_TERMINATORS
+    elif opcode == sre_parse.IN:
+        return all(itemopcode == sre_parse.LITERAL and itemargument in HOST_TERMINATORS for itemopcode, itemargument in argument)
+    elif opcode == sre_parse.AT:
+        return argument in (sre_parse.AT_END, sre_parse.AT_END_STRING)
+    elif opcode == sre_parse.SUBPATTERN:
+        return isHostTerminator(list(argument[3]) + list(items[1:]))
+    elif opcode == sre_parse.BRANCH:
+        return all(isHostTerminator(list(alternative) + list(items[1:])) for alternative in argument[1])
+    return False
+
+
+def getPatternHostScope(pattern: re.Pattern) -> Union[HostScope, None]:
+    """ Returns the hosts the given urlPattern is limited to or None if it is not limited to a single domain.
+     Understands the usual form of ClearURLs patterns: '^https?:\\/\\/(?:[a-z0-9-]+\\.)*?github\\.com' and variants with a fixed subdomain or a terminator like '/'.
+     """
+    prefix = getAnchoredPrefix(pattern)
+    if prefix is None or prefix.lower() not in ("http", "https", "http://", "https://"):
+        return None
+    parsedpattern = list(sre_parse.parse(pattern.pattern, pattern.flags))
+    # Skip '^', scheme and '://'
+    position = 1
+    scheme = ""
+    while position < len(parsedpattern) and not scheme.endswith("://"):
+        opcode, argument = parsedpattern[position]
+        if opcode == sre_parse.LITERAL:
+            scheme += chr(argument)
+        elif not (opcode == sre_parse.MAX_REPEAT and argument[0] == 0 and argument[1] == 1 and list(argument[2]) == [(sre_parse.LITERAL, ord('s'))]):
+            return None
+        position += 1
+    if scheme.lower() not in ("http://", "https://"):
+        return None
+    includesSubdomains = False
+    while position < len(parsedpattern) and parsedpattern[position][0] in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+        # Optional subdomains e.g. '(?:[a-z0-9-]+\\.)*?' or '(?:www\\.)?': Must end with a dot and must not be able to leave the host
+        minrepetitions, _, body = parsedpattern[position][1]
+        body = list(body)
+        if len(body) == 1 and body[0][0] == sre_parse.SUBPATTERN:
+            body = list(body[0][1][3])
+        if minrepetitions != 0 or len(body) == 0 or body[-1] != (sre_parse.LITERAL, ord('.')):
+            return None
+        for opcode, argument in body:
+            if opcode == sre_parse.IN:
+                if any(itemopcode == sre_parse.NEGATE or itemopcode == sre_parse.CATEGORY for itemopcode, _ in argument):
+                    return None
+                for itemopcode, itemargument in argument:
+                    if itemopcode == sre_parse.LITERAL and chr(itemargument) in "/?#@:":
+                        return None
+                    if itemopcode == sre_parse.RANGE and any(itemargument[0] <= ord(char) <= itemargument[1] for char in "/?#@:"):
+                        return None
+            elif opcode in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                if any(not (itemopcode == sre_parse.IN or (itemopcode == sre_parse.LITERAL and chr(itemargument) not in "/?#@:"))
+                       for itemopcode, itemargument in argument[2]):
+                    return None
+            elif opcode != sre_parse.LITERAL or chr(argument) in "/?#@:":
+                return None
+        includesSubdomains = True
+        position += 1
+    domain = []
+    while position < len(parsedpattern) and parsedpattern[position][0] == sre_parse.LITERAL:
+        char = chr(parsedpattern[position][1])
+        if char in "/?#@:":
+            break
+        domain.append(char)
+        position += 1
+    domain = "".join(domain).lower()
+    if len(domain) == 0 or DOMAIN_REGEX.fullmatch(domain) is None:
+        return None
+    return HostScope(domain, includesSubdomains, isHostTerminator(parsedpattern[position:]))
+
+
+def getEffectiveScope(rule: CleaningRule) -> CleaningRule:
+    """ Returns the given rule with a domainwhitelist derived from its urlPattern if it has none but its urlPattern only matches a single domain. """
+    if rule.urlPattern is None or len(rule.domainwhitelist) > 0:
+        return rule
+    hostscope = getPatternHostScope(rule.urlPattern)
+    if hostscope is None or not hostscope.isExact:
+        return rule
+    return rule.copy(update=dict(domainwhitelist=[hostscope.domain], domainwhitelistIgnoreSubdomains=hostscope.includesSubdomains,
+                                 domainwhitelistIgnoreWWW=False))
+
+
+def isScopeOverlapping(rule: CleaningRule, earlierrule: CleaningRule) -> bool:
+    """ Returns True if the urlPattern of rule matches hosts earlierrule is limited to via its domainwhitelist. """
+    if rule.urlPattern is None or len(rule.domainwhitelist) > 0 or earlierrule.urlPattern is not None or len(earlierrule.domainwhitelist) == 0:
+        return False
+    hostscope = getPatternHostScope(rule.urlPattern)
+    if hostscope is None:
+        return False
+    for domain in earlierrule.domainwhitelist:
+        if domain == hostscope.domain or (not hostscope.isExact and domain.startswith(hostscope.domain + '.')):
+            return True
+        if hostscope.includesSubdomains and domain.endswith('.' + hostscope.domain):
+            return True
+        if earlierrule.domainwhitelistIgnoreSubdomains and hostscope.domain.endswith('.' + domain):
+            return True
+    return False
+
+
+def isScopeContained(inner: CleaningRule, outer: CleaningRule) -> bool:
+    """ Returns True if outer is allowed to run on every URL inner is allowed to run on, see CompiledRuleset.isDomainWhitelisted. """
+    if outer.urlPattern is not None:
+        if inner.urlPattern is None or inner.urlPattern.pattern != outer.urlPattern.pattern or inner.urlPattern.flags != outer.urlPattern.flags:
+            return False
+    if len(outer.domainwhitelist) == 0:
+        return True
+    # urlPatterns like the ones of imported ClearURLs rules limit the rule to a domain too
+    inner = getEffectiveScope(inner)
+    if len(inner.domainwhitelist) == 0:
+        return False
+    if outer.domainwhitelistIgnoreSubdomains:
+        if not inner.domainwhitelistIgnoreSubdomains and inner.domainwhitelistIgnoreWWW:
+            # 'www.' gets removed anywhere inside the domain in this case so matched domains are not necessarily subdomains of the listed ones
+            return False
+        for domain in inner.domainwhitelist:
+            if not any(domain == outerdomain or domain.endswith('.' + outerdomain) for outerdomain in outer.domainwhitelist):
+                return False
+        return True
+    if inner.domainwhitelistIgnoreSubdomains or (inner.domainwhitelistIgnoreWWW and not outer.domainwhitelistIgnoreWWW):
+        return False
+    for domain in inner.domainwhitelist:
+        if outer.domainwhitelistIgnoreWWW:
+            domain = domain.replace('www.', '')
+        if domain not in outer.domainwhitelist:
+            return False
+    return True
+
+
+def getAnchoredPrefix(pattern: re.Pattern) -> Union[str, None]:
+    """ Returns the literal text a pattern requires at the beginning of the string or None if the pattern is not anchored or can't be parsed. """
+    if pattern.flags & re.VERBOSE:
+        return None
+    try:
+        parsedpattern = list(sre_parse.parse(pattern.pattern, pattern.flags))
+    except Exception:
+        return None
+    if len(parsedpattern) == 0 or parsedpattern[0][0] != sre_parse.AT or parsedpattern[0][1] not in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING):
+        return None
+    prefix = []
+    for opcode, argument in parsedpattern[1:]:
+        if opcode != sre_parse.LITERAL:
+            break
+        prefix.append(chr(argument))
+    return "".join(prefix)
+
+
+def isPatternReachable(pattern: re.Pattern) -> bool:
+    """ Returns False if the given urlPattern can't match any URL found via findURLs. """
+    prefix = getAnchoredPrefix(pattern)
+    if prefix is not None:
+        # Scheme of found URLs can be written in upper case
+        prefix = prefix.lower()
+        if not any(urlprefix.startswith(prefix) or prefix.startswith(urlprefix) for urlprefix in URL_PREFIXES):
+            return False
+    try:
+        parsedpattern = sre_parse.parse(pattern.pattern, pattern.flags)
+    except Exception:
+        return True
+    for opcode, argument in parsedpattern:
+        if opcode == sre_parse.LITERAL and chr(argument).isspace():
+            # Found URLs never contain whitespace
+            return False
+    return True
+
+
+def getSuspiciousDomains(rule: CleaningRule) -> List[str]:
+    """ Returns entries of the domainwhitelist which are most likely typos e.g. two domains glued together like 'amazon.esamazon.fr'. """
+    suspiciousdomains = []
+    for domain in rule.domainwhitelist:
+        if DOMAIN_REGEX.fullmatch(domain) is None:
+            suspiciousdomains.append(domain)
+            continue
+        labels = domain.split('.')
+        for label in labels[1:-1]:
+            if label != labels[0] and label.endswith(labels[0]):
+                suspiciousdomains.append(domain)
+                break
+    return suspiciousdomains
+
+
+def removeDuplicates(items: Iterable[str]) -> List[str]:
+    return list(dict.fromkeys(items))
+
+
+def getRemovedParameters(rule: CleaningRule) -> set:
+    """ Returns parameters which the given unconditional rule always removes no matter if affiliate parameters are removed or not. """
+    if rule.removeAllParameters or rule.paramswhitelist is not None or rule.paramsblacklist is None:
+        # paramsblacklist is ignored if one of the others is set
+        return set()
+    return set(rule.paramsblacklist)
+
+
+def isRuleEmpty(rule: CleaningRule) -> bool:
+    """ Returns True if the given rule does not do anything at all. """
+    return not rule.paramsblacklist and not rule.paramsblacklist_affiliate and not rule.paramsblacklist_regex and rule.paramswhitelist is None \
+        and not rule.removeAllParameters and not isRewritingRule(rule)
+
+
+def isShadowedBy(rule: CleaningRule, earlierrule: CleaningRule) -> bool:
+    """ Returns True if the given rule can't change any URL because earlierrule runs before it.
+     Both rules must be unconditional parameter rules and there must not be any rewriting rule between them.
+     """
+    if not isScopeContained(rule, earlierrule):
+        return False
+    if earlierrule.removeAllParameters:
+        # No parameters left afterwards
+        return True
+    if not earlierrule.stopAfterThisRule or earlierrule.paramsblacklist_regex or earlierrule.paramswhitelist is not None:
+        return False
+    if rule.removeAllParameters or rule.paramsblacklist_regex or rule.paramswhitelist is not None:
+        return False
+    # Whenever the given rule finds any of its parameters, the earlier rule finds it too and stops the processing
+    return set(rule.paramsblacklist or []) | set(rule.paramsblacklist_affiliate or []) <= getRemovedParameters(earlierrule)
+
+
+def minimizeRuleset(rules: List[CleaningRule]) -> Tuple[List[CleaningRule], List[RulesetFinding], Dict[str, str]]:
+    """ Returns the smallest list of rules this analyzer can prove to clean every URL the same way as the given rules plus all problems found and the
+     names of rules which got merged into another rule: Old name -> New name. Users see the new names as applied rules.
+     Given rules are not modified.
+     """
+    findings = []
+    newrules = []
+    # Index inside newrules of the last rule which can bring back parameters -> Earlier rules can't shadow anything after it
+    lastrewritingindex = -1
+    for rule in rules:
+        for domain in getSuspiciousDomains(rule):
+            findings.append(RulesetFinding(FINDING_SUSPICIOUS_DOMAIN, rule.name, f"Suspicious domain in domainwhitelist: {domain!r}", False))
+        if rule.enabled is False:
+            findings.append(RulesetFinding(FINDING_DISABLED_RULE, rule.name, "Rule is disabled", True))
+            continue
+        if rule.urlPattern is not None and not isPatternReachable(rule.urlPattern):
+            findings.append(RulesetFinding(FINDING_UNREACHABLE_PATTERN, rule.name, f"urlPattern can't match any URL: {rule.urlPattern.pattern}", True))
+            continue
+        update = {}
+        for field in DEDUPLICATABLE_FIELDS:
+            values = getattr(rule, field)
+            if values is None:
+                continue
+            uniquevalues = removeDuplicates(values)
+            if len(uniquevalues) != len(values):
+                duplicates = removeDuplicates(value for position, value in enumerate(values) if value in values[:position])
+                findings.append(RulesetFinding(FINDING_DUPLICATE_PARAMETER, rule.name, f"Duplicate entries in {field}: {', '.join(duplicates)}", True))
+                update[field] = uniquevalues
+        if update:
+            rule = rule.copy(update=update)
+        for earlierrule in newrules:
+            if isScopeOverlapping(rule, earlierrule) and not isScopeContained(rule, earlierrule):
+                findings.append(RulesetFinding(FINDING_OVERLAPPING_RULE, rule.name, f"urlPattern also matches domains of earlier rule {earlierrule.name!r}: "
+                                                                                   f"{', '.join(earlierrule.domainwhitelist)}", False))
+                break
+        if isUnconditionalParameterRule(rule):
+            shadowingrule = None
+            redundantparams = set()
+            for earlierrule in newrules[lastrewritingindex + 1:]:
+                if not isUnconditionalParameterRule(earlierrule) or not isScopeContained(rule, earlierrule):
+                    continue
+                if isShadowedBy(rule, earlierrule):
+                    shadowingrule = earlierrule
+                    break
+                redundantparams |= getRemovedParameters(earlierrule)
+            if shadowingrule is not None:
+                findings.append(RulesetFinding(FINDING_SHADOWED_RULE, rule.name, f"Rule is shadowed by earlier rule {shadowingrule.name!r}", True))
+                continue
+            update = {}
+            for field in ("paramsblacklist", "paramsblacklist_affiliate"):
+                values = getattr(rule, field)
+                if values and not redundantparams.isdisjoint(values):
+                    removedvalues = [value for value in values if value in redundantparams]
+                    findings.append(RulesetFinding(FINDING_REDUNDANT_PARAMETER, rule.name,
+                                                   f"Parameters in {field} are always removed by earlier rules: {', '.join(removedvalues)}", True))
+                    update[field] = [value for value in values if value not in redundantparams]
+            if update:
+                rule = rule.copy(update=update)
+                if isRuleEmpty(rule):
+                    findings.append(RulesetFinding(FINDING_SHADOWED_RULE, rule.name, "All parameters of this rule are removed by earlier rules", True))
+                    continue
+        newrules.append(rule)
+        if isRewritingRule(rule):
+            lastrewritingindex = len(newrules) - 1
+    renamedrules = {}
+    return mergeAdjacentGlobalBlacklists(newrules, findings, renamedrules), findings, renamedrules
+
+
+def mergeAdjacentGlobalBlacklists(rules: List[CleaningRule], findings: List[RulesetFinding], renamedrules: Dict[str, str]) -> List[CleaningRule]:
+    """ Replaces runs of adjacent global blacklist rules without stopAfterThisRule by one rule each.
+     Applying such rules one after another removes exactly the same parameters in the same order as a single rule with all of their parameters.
+     """
+    newrules = []
+    run = []
+    for rule in rules + [None]:
+        if rule is not None and isGlobalBlacklistRule(rule) and not rule.stopAfterThisRule:
+            run.append(rule)
+            continue
+        if len(run) > 1:
+            names = [runrule.name for runrule in run]
+            findings.append(RulesetFinding(FINDING_MERGEABLE_BLACKLISTS, names[0], f"Rules can be merged into one: {', '.join(names)}", True))
+            paramsblacklist = removeDuplicates(param for runrule in run for param in runrule.paramsblacklist)
+            for name in names:
+                renamedrules[name] = " + ".join(names)
+            newrules.append(run[0].copy(update=dict(name=" + ".join(names), description=f"Merged rules: {', '.join(names)}", paramsblacklist=paramsblacklist,
+                                                    testurls=[testurl for runrule in run for testurl in runrule.testurls or []] or None)))
+        else:
+            newrules += run
+        run = []
+        if rule is not None:
+            newrules.append(rule)
+    return newrules
+
+
+def getReplayURLs(rules: List[CleaningRule], testlinkspaths: List[str]) -> List[str]:
+    """ Returns testurls of all given rules plus all URLs found in the given files. """
+    urls = [testurl for rule in rules for testurl in rule.testurls or []]
+    for path in testlinkspaths:
+        with open(path, encoding='utf-8') as infile:
+            for line in infile:
+                urls += [line[start:end] for start, end in findURLs(line)]
+    return removeDuplicates(urls)
+
+
+def replayRulesets(oldrules: List[CleaningRule], newrules: List[CleaningRule], urls: List[str], renamedrules: Union[Dict[str, str], None] = None) -> List[str]:
+    """ Cleans given URLs with both lists of rules and returns a description of every difference. Empty list = both lists of rules are equivalent for those URLs.
+     Names of the applied rules are compared too, renamedrules: Names of rules which were merged into another rule, see minimizeRuleset.
+     """
+    renamedrules = renamedrules or {}
+    differences = []
+    for removeAffiliate in (False, True):
+        results = []
+        for isOld, rules in ((True, oldrules), (False, newrules)):
+            cleaner = URLCleaner(cleaningrules=list(rules))
+            cleaner.removeAffiliate = removeAffiliate
+            ruleset = cleaner.getRuleset()
+            rulesresults = []
+            for url in urls:
+                # Rules using '<randomchar>' must produce the same result for both lists of rules
+                random.seed(url)
+                cleanedurl = cleaner.cleanSingleURL(url, ruleset)
+                if cleanedurl is None:
+                    rulesresults.append(None)
+                else:
+                    appliedrules = [rule.name for rule in cleanedurl.appliedrules]
+                    if isOld:
+                        appliedrules = removeDuplicates(renamedrules.get(name, name) for name in appliedrules)
+                    rulesresults.append((cleanedurl.getURL(), cleanedurl.removedparams_tracking, cleanedurl.removedparams_affiliate, appliedrules))
+            results.append(rulesresults)
+        for url, oldresult, newresult in zip(urls, results[0], results[1]):
+            if oldresult != newresult:
+                differences.append(f"{url} | removeAffiliate={removeAffiliate} | Before: {oldresult} | After: {newresult}")
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Finds rules and parameters which never have any effect and builds a smaller, equivalent list of rules.")
+    parser.add_argument("--rules", action='append', default=[], help="Additional rules to import e.g. data.minify.json, can be used multiple times")
+    parser.add_argument("--testlinks", action='append', default=None, help="Files whose URLs are used to verify the minimized rules, default: Testlinks.txt")
+    parser.add_argument("--fix", action='store_true', help="Write minimized rules to the output file")
+    parser.add_argument("-o", "--output", default="cleaningrules_minimized.json",
+                        help="Output file for --fix, load it via URLCleaner(cleaningrules=[]).importCleaningRules as it contains the default rules too")
+    args = parser.parse_args()
+    cleaner = URLCleaner()
+    for path in args.rules:
+        cleaner.importCleaningRules(path)
+    rules = cleaner.cleaningrules
+    newrules, findings, renamedrules = minimizeRuleset(rules)
+    for finding in findings:
+        print(f"[{finding.kind}] {finding.rulename}: {finding.message}{'' if finding.isFixable else ' (not fixable automatically)'}")
+    print(f"Rules: {len(rules)} -> {len(newrules)} | Parameters: {sum(len(rule.paramsblacklist or []) for rule in rules)} -> {sum(len(rule.paramsblacklist or []) for rule in newrules)}")
+    urls = getReplayURLs(rules, ["Testlinks.txt"] if args.testlinks is None else args.testlinks)
+    for newname in removeDuplicates(renamedrules.values()):
+        print(f"Renamed: Applied rule shown to users changes from {' / '.join(name for name in renamedrules if renamedrules[name] == newname)} to {newname!r}")
+    differences = replayRulesets(rules, newrules, urls, renamedrules)
+    for difference in differences:
+        print(f"Difference: {difference}")
+    if len(differences) > 0:
+        print(f"Minimized rules are NOT equivalent for {len(differences)} of {len(urls)} URLs")
+        sys.exit(1)
+    print(f"Minimized rules are equivalent for all {len(urls)} replayed URLs")
+    if args.fix:
+        with open(args.output, 'w', encoding='utf-8') as outfile:
+            json.dump(newrules, outfile, default=encodeCleaningRules)
+        print(f"Wrote {len(newrules)} rules to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import os.path
+import threading
+import time
+from typing import List, Union, Callable, Dict
+from urllib.parse import urlparse
+
+from CompiledRuleset import CompiledRuleset
+from RulesetSnapshot import getSourceChecksum, saveSnapshot
+from URLCleaner import URLCleaner
+
+
+def validateRuleset(ruleset: CompiledRuleset) -> List[str]:
+    """ Cleans the testurls of all rules of given ruleset and returns a list of errors, empty list = ruleset can be used.
+     A rule which does not change any of its own testurls is only reported via print as some rules e.g. only remove affiliate parameters.
+     """
+    cleaner = URLCleaner(cleaningrules=[])
+    cleaner.setRuleset(ruleset)
+    errors = []
+    for rule in ruleset.rules:
+        if not rule.testurls:
+            continue
+        ruleapplied = False
+        for testurl in rule.testurls:
+            try:
+                cleanedurl = cleaner.cleanSingleURL(testurl, ruleset)
+                result = cleanedurl.getURL()
+            except Exception as error:
+                errors.append(f"{rule.name}: Failed to clean testurl {testurl}: {error!r}")
+                continue
+            parsedresult = urlparse(result)
+            if len(parsedresult.scheme) == 0 or len(parsedresult.netloc) == 0:
+                errors.append(f"{rule.name}: Cleaning testurl {testurl} resulted in invalid URL {result}")
+            if rule in cleanedurl.appliedrules:
+                ruleapplied = True
+        if not ruleapplied:
+            print(f"Warning: Rule {rule.name} does not apply to any of its testurls")
+    return errors
+
+
+class RulesetReloader:
+    """ Re-builds the rules of an URLCleaner whenever one of the rule files changes or reload() is called e.g. via an admin command.
+     The new ruleset is built and validated in the calling thread while the old one continues to be used.
+     Only a ruleset which passed validateRuleset gets swapped in, otherwise the old ruleset stays active.
+     File changes are detected via polling of the modification times so no additional dependencies are needed.
+     """
+
+    def __init__(self, urlcleaner: URLCleaner, importpaths: List[str], snapshotpath: Union[str, None] = "cleaningrules.snapshot", interval: float = 60,
+                 onReload: Union[Callable[[CompiledRuleset], None], None] = None):
+        self.urlcleaner = urlcleaner
+        self.importpaths = importpaths
+        self.snapshotpath = snapshotpath
+        self.interval = interval
+        # Called after a new ruleset has been swapped in
+        self.onReload = onReload
+        self.mtimes = self.getModificationTimes()
+        self.reloadlock = threading.Lock()
+        self.stopevent = threading.Event()
+        self.watcher: Union[threading.Thread, None] = None
+        self.lastError: Union[str, None] = None
+
+    def getModificationTimes(self) -> Dict[str, Union[float, None]]:
+        mtimes = {}
+        for path in self.importpaths:
+            try:
+                mtimes[path] = os.path.getmtime(path)
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def buildRuleset(self) -> CompiledRuleset:
+        """ Returns new ruleset with default rules plus rules of all given files which exist. Does not modify the URLCleaner. """
+        importpaths = [path for path in self.importpaths if os.path.exists(path)]
+        cleaner = URLCleaner()
+        # Count rules which get skipped during import
+        cleaner.metrics = self.urlcleaner.metrics
+        # Slow rules get another chance as their timings may have been disturbed e.g. by a busy machine, rules with unsafe patterns stay quarantined
+        self.urlcleaner.clearSlowRuleQuarantines()
+        cleaner.quarantinedrules = self.urlcleaner.quarantinedrules
+        for path in importpaths:
+            cleaner.importCleaningRules(path)
+        cleaner.cleaningrules = [rule for rule in cleaner.cleaningrules if rule.name not in cleaner.quarantinedrules]
+        return cleaner.getRuleset()
+
+    def reload(self) -> bool:
+        """ Builds, validates and swaps in a new ruleset. Returns False if the old ruleset is still active. """
+        with self.reloadlock:
+            self.mtimes = self.getModificationTimes()
+            timestart = time.perf_counter()
+            try:
+                ruleset = self.buildRuleset()
+            except Exception as error:
+                self.lastError = f"Failed to build ruleset: {error!r}"
+                print(self.lastError)
+                return False
+            errors = validateRuleset(ruleset)
+            if len(errors) > 0:
+                self.lastError = f"Ruleset has {len(errors)} errors, keeping old ruleset | First error: {errors[0]}"
+                print(self.lastError)
+                return False
+            self.urlcleaner.setRuleset(ruleset)
+            self.lastError = None
+            print(f"Reloaded {len(ruleset.rules)} rules in {time.perf_counter() - timestart:.2f}s | Ruleset version: {ruleset.version}")
+            if self.snapshotpath is not None:
+                # Next startup can load the new rules without building them again
+                importpaths = [path for path in self.importpaths if os.path.exists(path)]
+                try:
+                    saveSnapshot(self.snapshotpath, getSourceChecksum(importpaths), ruleset)
+                except OSError as error:
+                    print(f"Failed to save ruleset snapshot {self.snapshotpath}: {error}")
+            if self.onReload is not None:
+                self.onReload(ruleset)
+            return True
+
+    def reloadIfModified(self) -> bool:
+        """ Returns True if any of the rule files was modified and the new rules have been swapped in. """
+        if self.getModificationTimes() == self.mtimes:
+            return False
+        return self.reload()
+
+    def watch(self):
+        while not self.stopevent.wait(self.interval):
+            try:
+                self.reloadIfModified()
+            except Exception as error:
+                # The watcher must survive any problem with a single reload
+                print(f"Ruleset watcher failed: {error!r}")
+
+    def start(self):
+        """ Starts background thread which checks the rule files for modifications every self.interval seconds. """
+        if self.watcher is not None:
+            return
+        self.stopevent.clear()
+        self.watcher = threading.Thread(target=self.watch, name="RulesetReloader", daemon=True)
+        self.watcher.start()
+
+    def stop(self):
+        if self.watcher is None:
+            return
+        self.stopevent.set()
+        self.watcher.join()
+        self.watcher = None
@@ -0,0 +1,80 @@
+import hashlib
+import os.path
+import pickle
+from typing import List, Union
+
+import RegexSafety
+from CleaningMetrics import CleaningMetrics
+from CompiledRuleset import CompiledRuleset
+from URLCleaner import URLCleaner
+
+# Needs to be increased whenever the structure of pickled objects changes in an incompatible way
+SNAPSHOT_FORMAT_VERSION = 2
+# Source code files which define default rules or the compiled structures -> Changes to them invalidate snapshots
+SNAPSHOT_CODE_FILES = ["CleaningRule.py", "CompiledRuleset.py", "RegexSafety.py", "URLCleaner.py"]
+
+
+def getSourceChecksum(importpaths: List[str]) -> str:
+    """ Returns checksum over all inputs of a compiled ruleset: Rule files to import and the code which defines the default rules. """
+    # Unsafe patterns are only kept if the linear time regex engine is available
+    checksum = hashlib.sha256(f"format={SNAPSHOT_FORMAT_VERSION} re2={RegexSafety.re2 is not None}".encode('utf-8'))
+    codedir = os.path.dirname(os.path.abspath(__file__))
+    for path in [os.path.join(codedir, filename) for filename in SNAPSHOT_CODE_FILES] + importpaths:
+        checksum.update(f"\n{path}\n".encode('utf-8'))
+        if os.path.exists(path):
+            with open(path, 'rb') as infile:
+                checksum.update(infile.read())
+        else:
+            checksum.update(b"<missing>")
+    return checksum.hexdigest()
+
+
+def saveSnapshot(path: str, checksum: str, ruleset: CompiledRuleset):
+    """ Stores given compiled ruleset so it can be loaded without validating and compiling every single rule again. """
+    temppath = path + ".tmp"
+    with open(temppath, 'wb') as outfile:
+        pickle.dump(dict(format=SNAPSHOT_FORMAT_VERSION, checksum=checksum, ruleset=ruleset), outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    # Replace old snapshot at once so other processes never see a half written file
+    os.replace(temppath, path)
+
+
+def loadSnapshot(path: str, checksum: str) -> Union[CompiledRuleset, None]:
+    """ Returns the compiled ruleset stored in given file or None if it does not exist or was built from other sources. """
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as infile:
+            snapshot = pickle.load(infile)
+    except Exception as error:
+        print(f"Failed to load ruleset snapshot {path}: {error}")
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("format") != SNAPSHOT_FORMAT_VERSION or snapshot.get("checksum") != checksum:
+        return None
+    return snapshot["ruleset"]
+
+
+def loadURLCleaner(importpaths: List[str], snapshotpath: Union[str, None] = "cleaningrules.snapshot", metrics: Union[CleaningMetrics, None] = None) -> URLCleaner:
+    """ Returns URLCleaner with default rules plus rules of all given files which exist.
+     If the snapshot file was built from the same files, rules are loaded from it without any validation via pydantic.
+     Otherwise, rules are loaded the normal way and the snapshot gets re-built.
+     """
+    importpaths = [path for path in importpaths if os.path.exists(path)]
+    checksum = getSourceChecksum(importpaths)
+    if snapshotpath is not None:
+        ruleset = loadSnapshot(snapshotpath, checksum)
+        if ruleset is not None:
+            cleaner = URLCleaner(cleaningrules=[])
+            cleaner.metrics = metrics
+            cleaner.setRuleset(ruleset)
+            print(f"Loaded {len(ruleset.rules)} rules from snapshot {snapshotpath}")
+            return cleaner
+    cleaner = URLCleaner()
+    cleaner.metrics = metrics
+    for path in importpaths:
+        cleaner.importCleaningRules(path)
+    if snapshotpath is not None:
+        try:
+            saveSnapshot(snapshotpath, checksum, cleaner.getRuleset())
+        except OSError as error:
+            print(f"Failed to save ruleset snapshot {snapshotpath}: {error}")
+    return cleaner
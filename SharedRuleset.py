@@ -0,0 +1,130 @@
+import io
+import pickle
+import re
+import struct
+import threading
+from typing import Dict, Union
+from multiprocessing import shared_memory
+
+from CompiledRuleset import CompiledRuleset
+
+# Magic + length of the pickled ruleset, the segment itself can be bigger than requested
+HEADER = struct.Struct("<8sQ")
+HEADER_MAGIC = b"URLRULES"
+# Attributes of re.Pattern which are looked up by the cleaning code, pattern and flags are stored directly
+COMPILED_PATTERN_ATTRIBUTES = ("search", "match", "fullmatch", "finditer")
+
+
+class LazyPattern:
+    """ Stand-in for a re.Pattern inside worker processes which compiles the pattern the first time it gets used.
+     Most URLs only reach a few rules so most patterns of a ruleset are never compiled by a worker at all.
+     Once compiled, the methods of the compiled pattern are stored in the slots of this object so later calls cost the same as calls on the re.Pattern itself.
+     """
+    __slots__ = ("pattern", "flags") + COMPILED_PATTERN_ATTRIBUTES
+
+    def __init__(self, pattern: str, flags: int):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name: str):
+        # Only called for slots which are not set yet
+        if name not in COMPILED_PATTERN_ATTRIBUTES:
+            raise AttributeError(name)
+        compiledpattern = re.compile(self.pattern, self.flags)
+        for attribute in COMPILED_PATTERN_ATTRIBUTES:
+            setattr(self, attribute, getattr(compiledpattern, attribute))
+        return getattr(compiledpattern, name)
+
+    def __reduce__(self):
+        # E.g. rules of results sent back to the main process
+        return re.compile, (self.pattern, self.flags)
+
+    def __repr__(self) -> str:
+        return f"LazyPattern({self.pattern!r})"
+
+
+class RulesetPickler(pickle.Pickler):
+    """ Stores regular expressions as LazyPattern so workers do not compile the whole ruleset while loading it. """
+
+    def reducer_override(self, obj):
+        if type(obj) is re.Pattern:
+            return LazyPattern, (obj.pattern, obj.flags)
+        return NotImplemented
+
+
+def loadSharedRuleset(name: str) -> CompiledRuleset:
+    """ Returns the compiled ruleset stored in the shared memory segment with given name without building or validating any rule.
+     Regular expressions of the returned ruleset are LazyPatterns.
+     """
+    segment = shared_memory.SharedMemory(name=name)
+    try:
+        magic, length = HEADER.unpack_from(segment.buf)
+        if magic != HEADER_MAGIC:
+            raise ValueError(f"Shared memory segment {name} does not contain a ruleset")
+        return pickle.loads(segment.buf[HEADER.size:HEADER.size + length])
+    finally:
+        segment.close()
+
+
+class SharedRulesetPublisher:
+    """ Stores compiled rulesets in shared memory so worker processes can load them without importing and compiling the rules themselves.
+     Every ruleset gets its own segment so workers can switch to a new ruleset whenever they see a new segment name, see CleaningBackend.
+     Workers hold their own unpickled copy as Python objects can't be shared between processes: Rule objects and indexes are copied into every worker,
+     only regular expressions are compiled lazily, see LazyPattern.
+     Tasks reference the segment they were submitted with via acquire/release so an old segment is only removed once no queued or running task needs it.
+     publish is called by the thread reloading the rules, acquire/release by the event loop and the executor.
+     """
+
+    def __init__(self):
+        self.segments: Dict[str, shared_memory.SharedMemory] = {}
+        # Segment name -> Number of queued and running tasks using it
+        self.references: Dict[str, int] = {}
+        self.currentname: Union[str, None] = None
+        self.lock = threading.Lock()
+
+    def publish(self, ruleset: CompiledRuleset) -> str:
+        """ Returns name of the new segment containing given ruleset which is used by all tasks acquiring a segment from now on. """
+        buffer = io.BytesIO()
+        RulesetPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(ruleset)
+        data = buffer.getvalue()
+        segment = shared_memory.SharedMemory(create=True, size=HEADER.size + len(data))
+        HEADER.pack_into(segment.buf, 0, HEADER_MAGIC, len(data))
+        segment.buf[HEADER.size:HEADER.size + len(data)] = data
+        with self.lock:
+            previousname = self.currentname
+            self.segments[segment.name] = segment
+            self.references[segment.name] = 0
+            self.currentname = segment.name
+            if previousname is not None and self.references[previousname] == 0:
+                self.removeSegment(previousname)
+        return segment.name
+
+    def acquire(self) -> str:
+        """ Returns name of the current segment which stays available until release gets called with it. """
+        with self.lock:
+            self.references[self.currentname] += 1
+            return self.currentname
+
+    def release(self, name: str):
+        with self.lock:
+            if name not in self.references:
+                # Already removed by close
+                return
+            self.references[name] -= 1
+            if self.references[name] == 0 and name != self.currentname:
+                self.removeSegment(name)
+
+    def removeSegment(self, name: str):
+        segment = self.segments.pop(name)
+        del self.references[name]
+        segment.close()
+        try:
+            segment.unlink()
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        with self.lock:
+            for name in list(self.segments):
+                self.removeSegment(name)
+            self.currentname = None
@@ -0,0 +1,205 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from typing import List, Union, Tuple, Iterable, Dict
+from urllib.parse import urlparse, urljoin
+
+import httpx
+
+from URLCleaner import addMissingScheme
+
+# Well known URL shorteners which only redirect to the real URL, other hosts are never contacted
+DEFAULT_SHORTENER_HOSTS = ["a.co", "amzn.to", "amzn.eu", "bit.ly", "buff.ly", "cutt.ly", "is.gd", "lnkd.in", "ow.ly", "rebrand.ly", "t.co", "t.ly",
+                           "tinyurl.com"]
+REDIRECT_STATUS_CODES = {301, 302, 303, 307, 308}
+# Some shorteners do not support HEAD requests
+HEAD_NOT_SUPPORTED_STATUS_CODES = {403, 405, 501}
+USER_AGENT = "Mozilla/5.0 (compatible; URLCleanerBot; +https://github.com/farOverNinethousand/URL-Tracking-remover-Telegram-bot)"
+
+
+class ShortlinkCache:
+    """ Persistent cache of expanded shortlinks stored in SQLite.
+     Positive entries (shortlink -> target) are kept for positivettl seconds, failed expansions for negativettl seconds so broken shortlinks are not
+     requested again for every message.
+     """
+
+    def __init__(self, path: str = "shortlinks.sqlite", positivettl: float = 30 * 24 * 3600, negativettl: float = 3600):
+        self.positivettl = positivettl
+        self.negativettl = negativettl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS shortlinks (url TEXT PRIMARY KEY, expandedurl TEXT, expires REAL NOT NULL)")
+        self.removeExpired()
+
+    def get(self, url: str) -> Tuple[bool, Union[str, None]]:
+        """ Returns (found, expanded URL). The expanded URL is None if the shortlink could not be expanded. """
+        entries = self.getMany([url])
+        if url not in entries:
+            return False, None
+        return True, entries[url]
+
+    def getMany(self, urls: List[str]) -> Dict[str, Union[str, None]]:
+        """ Returns shortlink -> expanded URL for all given shortlinks which are cached, see get. """
+        now = time.time()
+        entries = {}
+        with self.lock:
+            for url in urls:
+                row = self.connection.execute("SELECT expandedurl, expires FROM shortlinks WHERE url = ?", (url,)).fetchone()
+                if row is not None and row[1] >= now:
+                    entries[url] = row[0]
+        return entries
+
+    def put(self, url: str, expandedurl: Union[str, None]):
+        ttl = self.positivettl if expandedurl is not None else self.negativettl
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO shortlinks (url, expandedurl, expires) VALUES (?, ?, ?)", (url, expandedurl, time.time() + ttl))
+
+    def removeExpired(self) -> int:
+        with self.lock:
+            return self.connection.execute("DELETE FROM shortlinks WHERE expires < ?", (time.time(),)).rowcount
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class ShortlinkExpander:
+    """ Resolves shortlinks like t.co or amzn.to to the URL they redirect to so the cleaning rules can remove the tracking parameters hidden behind them.
+     Redirects are followed one by one via HEAD requests as long as they point to another shortener so the target website itself is never contacted
+     and nothing is downloaded. Only hosts inside shortenerhosts are requested at all.
+     Expanding one URL stops after maxhops redirects. Requests to the same host are limited to perhostlimit at the same time via a shared connection pool.
+     URLs which are expanded by multiple messages at the same time are only requested once.
+     The cache is accessed from a worker thread so SQLite never blocks the event loop.
+     """
+
+    def __init__(self, shortenerhosts: Iterable[str] = DEFAULT_SHORTENER_HOSTS, maxhops: int = 5, requesttimeout: float = 3.0, perhostlimit: int = 4,
+                 maxconnections: int = 32, cache: Union[ShortlinkCache, None] = None, transport: Union[httpx.AsyncBaseTransport, None] = None):
+        self.shortenerhosts = set(host.lower() for host in shortenerhosts)
+        self.maxhops = maxhops
+        self.requesttimeout = requesttimeout
+        self.perhostlimit = perhostlimit
+        self.maxconnections = maxconnections
+        self.cache = cache
+        # Used instead of the network e.g. httpx.MockTransport in tests
+        self.transport = transport
+        # Created on first use as it belongs to the running event loop
+        self.client: Union[httpx.AsyncClient, None] = None
+        # Shortener host -> Semaphore, only hosts in shortenerhosts are ever requested so this can't grow beyond them
+        self.hostsemaphores: Dict[str, asyncio.Semaphore] = {}
+        # Shortlink -> Task expanding it
+        self.pending: Dict[str, asyncio.Task] = {}
+
+    def isShortlink(self, url: str) -> bool:
+        try:
+            parsedurl = urlparse(url)
+        except ValueError:
+            return False
+        hostname = parsedurl.hostname
+        if parsedurl.scheme not in ("http", "https") or hostname is None:
+            return False
+        return hostname.removeprefix("www.") in self.shortenerhosts
+
+    def getClient(self) -> httpx.AsyncClient:
+        if self.client is None:
+            self.client = httpx.AsyncClient(follow_redirects=False, timeout=self.requesttimeout, headers={"User-Agent": USER_AGENT},
+                                            limits=httpx.Limits(max_connections=self.maxconnections, max_keepalive_connections=self.maxconnections),
+                                            transport=self.transport)
+        return self.client
+
+    async def expandURLs(self, urls: List[str], deadline: float) -> List[str]:
+        """ Returns given URLs with all shortlinks replaced by the URL they redirect to.
+         Shortlinks which could not be expanded within deadline seconds stay unchanged, their expansion continues in the background so the result
+         ends up in the cache.
+         """
+        expandedurls = list(urls)
+        # Index -> Shortlink
+        shortlinks = {}
+        for index, url in enumerate(urls):
+            # Telegram also finds links without scheme e.g. 'amzn.to/abc'
+            url = addMissingScheme(url)
+            if self.isShortlink(url):
+                shortlinks[index] = url
+        if len(shortlinks) == 0:
+            return expandedurls
+        cachedurls = {}
+        if self.cache is not None:
+            cachedurls = await asyncio.to_thread(self.cache.getMany, list(shortlinks.values()))
+        tasks = {}
+        for index, url in shortlinks.items():
+            if url in cachedurls:
+                if cachedurls[url] is not None:
+                    expandedurls[index] = cachedurls[url]
+                continue
+            task = self.pending.get(url)
+            if task is None:
+                task = asyncio.create_task(self.expandURL(url))
+                self.pending[url] = task
+                task.add_done_callback(lambda finishedtask, url=url: self.pending.pop(url, None))
+            tasks[index] = task
+        if len(tasks) == 0:
+            return expandedurls
+        # Waiting must not cancel the tasks as other messages may be waiting for the same shortlinks
+        await asyncio.wait(set(tasks.values()), timeout=deadline)
+        for index, task in tasks.items():
+            if task.done() and not task.cancelled() and task.exception() is None and task.result() is not None:
+                expandedurls[index] = task.result()
+        return expandedurls
+
+    async def expandURLSpans(self, urlspans: List[Tuple[int, int, str]], deadline: float) -> List[Tuple[int, int, str]]:
+        """ Like expandURLs for (start, end, url) spans as used by URLCleaner.cleanText. """
+        expandedurls = await self.expandURLs([url for _, _, url in urlspans], deadline)
+        return [(start, end, expandedurl) for (start, end, _), expandedurl in zip(urlspans, expandedurls)]
+
+    async def expandURL(self, url: str) -> Union[str, None]:
+        """ Returns the last URL of the redirect chain which is not a shortlink or None if it could not be expanded. """
+        currenturl = url
+        expandedurl = None
+        try:
+            for _ in range(self.maxhops):
+                location = await self.getRedirectTarget(currenturl)
+                if location is None:
+                    break
+                currenturl = location
+                if not self.isShortlink(currenturl):
+                    expandedurl = currenturl
+                    break
+        except (httpx.HTTPError, httpx.InvalidURL, ValueError) as error:
+            # URLs of users are not logged
+            print(f"Failed to expand shortlink of {urlparse(url).hostname}: {error!r}")
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.put, url, expandedurl)
+        return expandedurl
+
+    async def getRedirectTarget(self, url: str) -> Union[str, None]:
+        """ Returns the absolute URL given URL redirects to or None if it does not redirect to another http(s) URL. """
+        if not self.isShortlink(url):
+            return None
+        hostname = urlparse(url).hostname.removeprefix("www.")
+        semaphore = self.hostsemaphores.get(hostname)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.perhostlimit)
+            self.hostsemaphores[hostname] = semaphore
+        client = self.getClient()
+        async with semaphore:
+            response = await client.head(url)
+            if response.status_code in HEAD_NOT_SUPPORTED_STATUS_CODES:
+                # Only the headers are needed, the body is never read
+                async with client.stream("GET", url) as response:
+                    pass
+        if response.status_code not in REDIRECT_STATUS_CODES or "location" not in response.headers:
+            return None
+        location = urljoin(url, response.headers["location"])
+        if urlparse(location).scheme not in ("http", "https"):
+            return None
+        return location
+
+    async def close(self):
+        for task in list(self.pending.values()):
+            task.cancel()
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+        if self.cache is not None:
+            self.cache.close()
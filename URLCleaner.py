@@ -3,47 +3,242 @@ import os.path
 import random
 import re
 import string
-from typing import List, Union
-from urllib.parse import urlparse, parse_qs, urlencode, unquote
+import threading
+import time
+from typing import List, Union, Dict, KeysView, Tuple, Iterable, Iterator, Set
+from urllib.parse import urlparse, unquote
 
-from pydantic.json import pydantic_encoder
+from pydantic import ValidationError
 
-from CleaningRule import CleaningRule
+from CleanedURLCache import CleanedURLCache, CleanedURLSnapshot
+from CleaningRule import CleaningRule, encodeCleaningRules
+from CleaningMetrics import CleaningMetrics, MERGED_GLOBAL_BLACKLISTS_NAME
+from CleaningProfiler import CleaningProfiler, environmentprofiler, redactURL
+from CompiledRuleset import CompiledRuleset, RuntimeRule, isDomainWhitelisted
+
+
+class URLQuery:
+    """ Query of a URL which keeps all parameters in their original order and encoding.
+     Only parameters which were removed are missing when the query gets re-built, everything else stays untouched byte by byte.
+     Parameter names are decoded the same way urllib.parse.parse_qs does.
+     """
+
+    def __init__(self, query: str):
+        # Raw 'key=value' segments, None = removed
+        self.segments: List[Union[str, None]] = []
+        # Decoded key -> Indices of all segments with this key
+        self.keyindices: Dict[str, List[int]] = {}
+        if len(query) == 0:
+            return
+        for segment in query.split('&'):
+            if len(segment) == 0:
+                continue
+            position = segment.find('=')
+            key = segment if position == -1 else segment[:position]
+            if '+' in key:
+                key = key.replace('+', ' ')
+            if '%' in key:
+                key = unquote(key)
+            self.keyindices.setdefault(key, []).append(len(self.segments))
+            self.segments.append(segment)
+
+    def keys(self) -> KeysView:
+        return self.keyindices.keys()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keyindices
+
+    def __len__(self) -> int:
+        return len(self.keyindices)
+
+    def get(self, key: str) -> Union[str, None]:
+        """ Returns decoded value of the first parameter with given key. """
+        indices = self.keyindices.get(key)
+        if indices is None:
+            return None
+        segment = self.segments[indices[0]]
+        position = segment.find('=')
+        if position == -1:
+            return ''
+        return unquote(segment[position + 1:].replace('+', ' '))
+
+    def pop(self, key: str, default=None) -> Union[List[int], None]:
+        """ Removes all parameters with given key. Returns indices of the removed segments or default if there was no such parameter. """
+        indices = self.keyindices.pop(key, None)
+        if indices is None:
+            return default
+        for index in indices:
+            self.segments[index] = None
+        return indices
+
+    def clear(self):
+        self.keyindices.clear()
+        self.segments.clear()
+
+    def toString(self) -> str:
+        return '&'.join([segment for segment in self.segments if segment is not None])
 
 
 class CleanedURL:
     """ Represents a URL which will be cleaned.
      Keeps track of all changes that were made to this URL.
+     Applied rules are stored as indices into the rules of the ruleset which was used, removed parameters as tuples which are only allocated if anything was removed.
      """
+    __slots__ = ("originalurl", "cleanedurl", "newurl_regex", "newurl_urlparam", "newurl", "parsedquery", "rules", "appliedruleindices",
+                 "removedparams_affiliate", "removedparams_tracking", "isException", "span")
 
-    def __init__(self, url: str):
+    def __init__(self, url: str, rules: Tuple[CleaningRule, ...] = ()):
         self.originalurl = url
         self.cleanedurl = urlparse(url)
         self.newurl_regex = None
         self.newurl_urlparam = None
         self.newurl = None
-        self.query = parse_qs(self.cleanedurl.query, keep_blank_values=True)
-        self.appliedrules = []
-        self.removedparams_affiliate = []
-        self.removedparams_tracking = []
+        # Parsed lazily, see query property
+        self.parsedquery: Union[URLQuery, None] = None
+        # Rules of the ruleset used to clean this URL, see CompiledRuleset.rules
+        self.rules = rules
+        self.appliedruleindices: Tuple[int, ...] = ()
+        self.removedparams_affiliate: Tuple[str, ...] = ()
+        self.removedparams_tracking: Tuple[str, ...] = ()
         self.isException = False
+        # (start, end) position of this URL inside the text it was found in
+        self.span: Union[Tuple[int, int], None] = None
+
+    def __getstate__(self) -> dict:
+        # Only pass the applied rules instead of all rules of the ruleset e.g. from worker processes back to the main process
+        state = {name: getattr(self, name) for name in self.__slots__}
+        state['rules'] = tuple(self.rules[index] for index in self.appliedruleindices)
+        state['appliedruleindices'] = tuple(range(len(self.appliedruleindices)))
+        return state
+
+    def __setstate__(self, state: dict):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    @property
+    def appliedrules(self) -> List[CleaningRule]:
+        return [self.rules[index] for index in self.appliedruleindices]
+
+    @property
+    def query(self) -> URLQuery:
+        """ Query of the current state of the cleaned URL. Only gets parsed if a rule needs it. """
+        if self.parsedquery is None:
+            self.parsedquery = URLQuery(self.cleanedurl.query)
+        return self.parsedquery
+
+    def setURL(self, newurl: str):
+        """ Replaces the current state of the cleaned URL e.g. after a redirect was resolved. """
+        self.cleanedurl = urlparse(newurl)
+        self.parsedquery = None
+
+    def updateQuery(self):
+        """ Needs to be called after parameters have been removed from self.query. """
+        self.cleanedurl = self.cleanedurl._replace(query=self.query.toString())
+
+    def getURL(self) -> str:
+        """ Returns the cleaned URL. URLs which were not changed by any rule are returned exactly as they were given. """
+        if len(self.appliedruleindices) == 0:
+            return self.originalurl
+        return self.cleanedurl.geturl()
+
+    @classmethod
+    def fromSnapshot(cls, url: str, snapshot: CleanedURLSnapshot, rules: Tuple[CleaningRule, ...]):
+        """ Re-creates a CleanedURL from a cached result without applying any rules. The tuples of the snapshot are shared as they are immutable. """
+        cleanedurl = cls.__new__(cls)
+        cleanedurl.originalurl = url
+        cleanedurl.cleanedurl = snapshot.cleanedurl
+        cleanedurl.newurl_regex = snapshot.newurl_regex
+        cleanedurl.newurl_urlparam = snapshot.newurl_urlparam
+        cleanedurl.newurl = snapshot.newurl
+        cleanedurl.parsedquery = None
+        cleanedurl.rules = rules
+        cleanedurl.appliedruleindices = snapshot.appliedruleindices
+        cleanedurl.removedparams_affiliate = snapshot.removedparams_affiliate
+        cleanedurl.removedparams_tracking = snapshot.removedparams_tracking
+        cleanedurl.isException = snapshot.isException
+        cleanedurl.span = None
+        return cleanedurl
 
 
 class CleanResult:
     """ Represents the result of a text string which was cleaned. """
+    __slots__ = ("originaltext", "cleanedtext", "cleanedurls", "isIncomplete")
 
-    def __init__(self, text: str, cleanedtext: str, cleanedurls: List[CleanedURL]):
+    def __init__(self, text: str, cleanedtext: str, cleanedurls: List[CleanedURL], isIncomplete: bool = False):
         self.originaltext = text
         self.cleanedtext = cleanedtext
         self.cleanedurls = cleanedurls
+        # True if not all URLs were cleaned because of the limits given to URLCleaner.cleanText
+        self.isIncomplete = isIncomplete
 
 
 # Very cheap regex to find URLs inside a text
 URL_REGEX = re.compile(r'(?i)(https?://\S+)')
+# Characters which are usually not part of a URL if they are found at its end e.g. 'See https://example.com/test.'
+URL_TRAILING_CHARS = ".,;:!?'\"»”’"
+# Closing bracket -> Opening bracket, closing brackets at the end of URLs are only removed if they are not balanced e.g. Wikipedia URLs
+URL_TRAILING_BRACKETS = {')': '(', ']': '[', '}': '{', '>': '<'}
+
+
+def findURLs(text: str, urlregex: re.Pattern = URL_REGEX) -> List[Tuple[int, int]]:
+    """ Returns (start, end) positions of all URLs inside given text without trailing punctuation and brackets.
+     urlregex: Pattern which finds URLs including possible trailing characters e.g. one which also stops at quotes for HTML.
+     """
+    spans = []
+    for match in urlregex.finditer(text):
+        start, end = match.span()
+        while end > start:
+            lastchar = text[end - 1]
+            if lastchar in URL_TRAILING_CHARS:
+                end -= 1
+                continue
+            openingbracket = URL_TRAILING_BRACKETS.get(lastchar)
+            if openingbracket is not None and text.count(openingbracket, start, end) < text.count(lastchar, start, end):
+                end -= 1
+                continue
+            break
+        spans.append((start, end))
+    return spans
+
+
+def addMissingScheme(url: str) -> str:
+    """ Returns given URL with 'https://' in front of it if it does not contain any scheme e.g. 'amazon.de/dp/123' as found by Telegram. """
+    if '://' in url or url.startswith(("mailto:", "tg:")):
+        return url
+    return "https://" + url
+
+
+class RuleList(list):
+    """ List of CleaningRules which counts its modifications so URLCleaner knows when its compiled ruleset is outdated. """
+
+    def __init__(self, rules: Iterable[CleaningRule] = ()):
+        super().__init__(rules)
+        self.generation = 0
+
+    def onModified(self):
+        self.generation += 1
+
+    def __reduce__(self):
+        # Default pickling would add the rules via append before the generation is restored
+        return RuleList, (list(self),), self.__dict__
+
+
+def countModification(method):
+    def modify(self: RuleList, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        self.onModified()
+        return result
+
+    modify.__name__ = method.__name__
+    return modify
+
+
+for methodname in ("append", "extend", "insert", "remove", "pop", "clear", "sort", "reverse", "__setitem__", "__delitem__", "__iadd__", "__imul__"):
+    setattr(RuleList, methodname, countModification(getattr(list, methodname)))
 
 
 class URLCleaner:
-    def __init__(self):
+    def __init__(self, cleaningrules: Union[List[CleaningRule], None] = None):
         """ CleaningRules are based on infos I stole from various other projects:
          https://github.com/newhouse/url-tracking-stripper/blob/master/assets/js/trackers.js
 
@@ -56,10 +251,73 @@ class URLCleaner:
          TODO: Add tests similar to this: https://github.com/inframanufaktur/clean-urls/blob/main/__tests__/removeTrackingParamsFromLinks.spec.js
 
          """
-        self.cleaningrules = getDefaultCleaningRules()
+        if cleaningrules is None:
+            cleaningrules = getDefaultCleaningRules()
+        # See cleaningrules, its generation is incremented whenever the rules change so the compiled ruleset gets re-built
+        self.rulelist = RuleList(cleaningrules)
+        self.ruleset: Union[CompiledRuleset, None] = None
+        # Generation of self.rulelist self.ruleset was built from
+        self.rulesetGeneration = -1
+        self.rulesetVersion = 0
         self.removeTracking = True
         # TODO: Add functionality
         self.removeAffiliate = False
+        """ Apply all rules which only remove a fixed list of parameters from any URL (see CompiledRuleset.isGlobalBlacklistRule) at once via a single lookup per parameter.
+         Difference to the default behavior: Those rules are all applied together at the position of the first of them so stopAfterThisRule of one of them
+         does not prevent the others from removing their parameters anymore e.g. '?fbclid=1&spm=2' -> Both parameters get removed instead of only 'fbclid'.
+         If any of the applied rules has stopAfterThisRule set, no further rules are processed afterwards, same as before.
+         """
+        self.mergeGlobalBlacklists = False
+        # Optional cache for results of single URLs, see enableCache
+        self.cache: Union[CleanedURLCache, None] = None
+        # Optional per rule counters and timings, None = disabled
+        self.metrics: Union[CleaningMetrics, None] = None
+        """ Protection against regular expressions with catastrophic backtracking (ReDoS), see RegexSafety.
+         Imported rules with such patterns are always executed by a linear time engine or quarantined if it is not available.
+         If guardRegexes is enabled, rules are not applied to URLs longer than maxURLLength, a rule which takes longer than regexRuleBudget seconds for a single URL
+         regexMaxOverruns times gets quarantined and no further rules are applied to a URL once regexURLBudget seconds have been spent on it.
+         All times are CPU times of the cleaning thread so waiting for the GIL or the scheduler is not blamed on a rule.
+         """
+        self.guardRegexes = False
+        self.maxURLLength = 4096
+        self.regexRuleBudget = 0.05
+        self.regexURLBudget = 0.1
+        self.regexMaxOverruns = 3
+        # Name of rule -> Reason why it is not used anymore
+        self.quarantinedrules: Dict[str, str] = {}
+        # Name of rule -> Number of times it took longer than regexRuleBudget
+        self.ruleoverruns: Dict[str, int] = {}
+        # Names of quarantined rules which were too slow, they get another chance via clearSlowRuleQuarantines e.g. with the next reload
+        self.slowrules: Set[str] = set()
+        # Only taken by threads which build or swap the compiled ruleset
+        self.rulesetlock = threading.RLock()
+        # Optional slow URL log and sampled profiles, see CleaningProfiler. Enabled via environment variables by default.
+        self.profiler: Union[CleaningProfiler, None] = environmentprofiler
+
+    @property
+    def cleaningrules(self) -> List[CleaningRule]:
+        """ Rules used for cleaning. Adding, removing or replacing rules is detected automatically, call invalidateRuleset after modifying a rule itself.
+         Lists assigned to this are copied into a RuleList so changes to the original list are not seen.
+         """
+        return self.rulelist
+
+    @cleaningrules.setter
+    def cleaningrules(self, cleaningrules: List[CleaningRule]):
+        rulelist = cleaningrules if isinstance(cleaningrules, RuleList) else RuleList(cleaningrules)
+        # Never go back to a generation an older ruleset was built from
+        rulelist.generation = max(rulelist.generation, self.rulelist.generation) + 1
+        self.rulelist = rulelist
+
+    def __getstate__(self) -> dict:
+        # Locks cannot be passed to worker processes, workers collect metrics on their own, see CleaningBackend.initWorker
+        state = self.__dict__.copy()
+        del state['rulesetlock']
+        state['metrics'] = None
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self.rulesetlock = threading.RLock()
 
     def importCleaningRules(self, path: str) -> List[CleaningRule]:
         """ TODO: Add functionality
@@ -96,91 +354,340 @@ class URLCleaner:
                         rawRules = providermap.get("rawRules")
                         exceptions = providermap.get("exceptions")
                         referralMarketing = providermap.get("referralMarketing")
-                        newrule = CleaningRule(name=rulename, description="Rule imported from 'github.com/ClearURLs/Addon'",
-                                               paramsblacklist_regex=paramsblacklist_regex)
-                        newrule.urlPattern = providermap["urlPattern"]
-                        newrule.forceRedirection = providermap.get("forceRedirection")
-                        if exceptions is not None:
-                            newrule.exceptionsregexlist = exceptions
-                        if referralMarketing is not None:
-                            newrule.paramsblacklist_affiliate = referralMarketing
-                        if redirections is not None:
-                            newrule.redirectsregexlist = redirections
-
+                        try:
+                            # Pass everything to the constructor so that all regular expressions get validated and compiled right away
+                            newrule = CleaningRule(name=rulename, description="Rule imported from 'github.com/ClearURLs/Addon'",
+                                                   urlPattern=providermap["urlPattern"], paramsblacklist_regex=paramsblacklist_regex,
+                                                   forceRedirection=providermap.get("forceRedirection"), exceptionsregexlist=exceptions,
+                                                   paramsblacklist_affiliate=referralMarketing, redirectsregexlist=redirections)
+                        except ValidationError as error:
+                            print(f"Skipping ClearURLs import of invalid rule: {rulename} | {error}")
+                            if self.metrics is not None:
+                                self.metrics.recordInvalidRule()
+                            continue
                         newrules.append(newrule)
 
                 else:
                     raise Exception("Invalid import data")
+        # Rules from files can contain anything -> Make sure that none of them can block a CPU core for a long time
+        saferules = []
+        for rule in newrules:
+            try:
+                saferules.append(rule.getSafeCopy())
+            except ValueError as error:
+                self.quarantineRule(rule, str(error))
+        newrules = saferules
         print(f"New rules loaded: {len(newrules)}")
+        # Compare hashes instead of rules to avoid comparing every new rule with every existing rule
+        knownrules = set(rule.getContentHash() for rule in self.cleaningrules)
         for rule in newrules:
-            if rule not in self.cleaningrules:
+            contenthash = rule.getContentHash()
+            if contenthash not in knownrules:
+                knownrules.add(contenthash)
                 self.cleaningrules.append(rule)
+        self.invalidateRuleset()
         return newrules
 
+    def invalidateRuleset(self):
+        """ Needs to be called after the list of cleaning rules or any of its rules has been modified. """
+        with self.rulesetlock:
+            self.rulelist.generation += 1
+            self.ruleset = None
+
+    def setRuleset(self, ruleset: CompiledRuleset):
+        """ Replaces all rules by the ones of given, already compiled ruleset.
+         The swap is atomic: Texts which are being cleaned right now finish with the ruleset they started with, all following calls use the new one.
+         """
+        with self.rulesetlock:
+            self.rulesetVersion = max(self.rulesetVersion + 1, ruleset.version)
+            ruleset.version = self.rulesetVersion
+            self.cleaningrules = list(ruleset.rules)
+            self.ruleset = ruleset
+            self.rulesetGeneration = self.rulelist.generation
+            if self.cache is not None:
+                self.cache.clear()
+
+    def getRuleset(self) -> CompiledRuleset:
+        """ Returns indexed version of the current list of cleaning rules.
+         Gets re-built automatically if self.cleaningrules has been changed or invalidateRuleset has been called.
+         """
+        ruleset = self.ruleset
+        if ruleset is not None and self.rulesetGeneration == self.rulelist.generation:
+            # Fast path without any locking, a compiled ruleset is never modified after it has been built
+            return ruleset
+        with self.rulesetlock:
+            # Another thread might have built or swapped in a ruleset in the meantime
+            ruleset = self.ruleset
+            if ruleset is None or self.rulesetGeneration != self.rulelist.generation:
+                self.rulesetVersion += 1
+                generation = self.rulelist.generation
+                ruleset = CompiledRuleset(self.cleaningrules, version=self.rulesetVersion)
+                self.ruleset = ruleset
+                self.rulesetGeneration = generation
+                if self.cache is not None:
+                    # Results of the old ruleset will never be used again
+                    self.cache.clear()
+            return ruleset
+
+    def enableCache(self, maxentries: int = 10000, maxbytes: int = 16 * 1024 * 1024):
+        """ Enables caching of results of single URLs. Useful as the same URLs are often cleaned over and over again.
+         Results of rules using '<randomchar>' in their rewriteURLScheme e.g. MyDealz are never cached so every call still gets a new random character.
+         """
+        self.cache = CleanedURLCache(maxentries=maxentries, maxbytes=maxbytes)
+
+    def disableCache(self):
+        self.cache = None
+
     def saveCleaningRules(self, path: Union[str, None]):
         """
          Stores all loaded rules into json file to desired path, default as "cleaningrules.json".
          """
         if path is None:
             path = "cleaningrules.json"
-        bigger_data_json = json.dumps(self.cleaningrules, default=pydantic_encoder)
+        bigger_data_json = json.dumps(self.cleaningrules, default=encodeCleaningRules)
         print("Writing json to file:")
         print(bigger_data_json)
         f = open(path, "w")
         f.write(bigger_data_json)
 
-    def cleanText(self, text: str) -> CleanResult:
+    def cleanText(self, text: str, maxurls: Union[int, None] = None, timebudget: Union[float, None] = None,
+                  urlspans: Union[List[Tuple[int, int, str]], None] = None) -> CleanResult:
+        """ Cleans all URLs inside given text.
+         maxurls: Do not clean anything if the text contains more URLs than this.
+         timebudget: Stop cleaning further URLs once this much CPU time in seconds has been used. The remaining URLs are left untouched.
+         urlspans: Already known (start, end, url) of all URLs inside the text sorted by position e.g. from Telegram message entities, None = Find URLs via findURLs.
+         The url can differ from the text at that position: URLs without scheme get cleaned as https URLs. Links hidden behind other text get cleaned but
+         are not replaced inside the text.
+         """
+        profiler = self.profiler
+        if profiler is not None and profiler.shouldProfile():
+            with profiler.profile():
+                return self.cleanTextUnprofiled(text, maxurls, timebudget, urlspans)
+        return self.cleanTextUnprofiled(text, maxurls, timebudget, urlspans)
+
+    def cleanTextUnprofiled(self, text: str, maxurls: Union[int, None], timebudget: Union[float, None],
+                            urlspans: Union[List[Tuple[int, int, str]], None]) -> CleanResult:
         cleanedurls = []
-        urls = URL_REGEX.findall(text)
-        for url in urls:
-            try:
-                cleanedurl = CleanedURL(url)
-            except:
-                # We are not validating those URLs before so errors during parsing may happen
+        ruleset = self.getRuleset()
+        if urlspans is None:
+            urlspans = [(start, end, text[start:end]) for start, end in findURLs(text)]
+        if maxurls is not None and len(urlspans) > maxurls:
+            return CleanResult(text=text, cleanedtext=text, cleanedurls=cleanedurls, isIncomplete=True)
+        if timebudget is not None:
+            deadline = time.thread_time() + timebudget
+        isIncomplete = False
+        # Build new text in one go instead of replacing every URL inside the complete text
+        textparts = []
+        position = 0
+        for start, end, url in urlspans:
+            if timebudget is not None and time.thread_time() > deadline:
+                isIncomplete = True
+                break
+            schemeurl = addMissingScheme(url)
+            cleanedurl = self.cleanSingleURL(schemeurl, ruleset)
+            if cleanedurl is None:
                 continue
-            for cleaningrule in self.cleaningrules:
-                if cleaningrule.enabled is False:
-                    # Skip disabled rules
-                    continue
-                ruleApplicationStatus = self.cleanURL(cleanedurl, cleaningrule)
-                if ruleApplicationStatus is True and cleaningrule.stopAfterThisRule:
-                    break
+            cleanedurl.span = (start, end)
             cleanedurls.append(cleanedurl)
-        cleanedtext = text
-        for cleanedurl in cleanedurls:
-            cleanedtext = cleanedtext.replace(cleanedurl.originalurl, cleanedurl.cleanedurl.geturl())
-        result = CleanResult(text=text, cleanedtext=cleanedtext, cleanedurls=cleanedurls)
+            # Unchanged URLs stay as they were written e.g. without scheme
+            if cleanedurl.getURL() != schemeurl and text.startswith(url, start) and end - start == len(url):
+                textparts.append(text[position:start])
+                textparts.append(cleanedurl.getURL())
+                position = end
+        textparts.append(text[position:])
+        result = CleanResult(text=text, cleanedtext="".join(textparts), cleanedurls=cleanedurls, isIncomplete=isIncomplete)
         return result
 
-    def cleanURL(self, cleanedurl: CleanedURL, rule: CleaningRule) -> bool:
-        """ Check for exceptions by regex. """
-        if rule.urlPattern is not None:
-            if re.search(rule.urlPattern, cleanedurl.originalurl) is None:
+    def cleanTexts(self, texts: Iterable[str]) -> Iterator[CleanResult]:
+        """ Cleans given texts one by one. Can be used on huge inputs e.g. lines of a file as texts are only read when needed. """
+        for text in texts:
+            yield self.cleanText(text)
+
+    def iterCleanURLs(self, texts: Iterable[str]) -> Iterator[CleanedURL]:
+        """ Returns all URLs found in given texts cleaned without building cleaned versions of the texts. """
+        for text in texts:
+            ruleset = self.getRuleset()
+            for start, end in findURLs(text):
+                cleanedurl = self.cleanSingleURL(text[start:end], ruleset)
+                if cleanedurl is not None:
+                    cleanedurl.span = (start, end)
+                    yield cleanedurl
+
+    def cleanSingleURL(self, url: str, ruleset: CompiledRuleset) -> Union[CleanedURL, None]:
+        """ Applies all matching rules of given ruleset to given URL. Returns None if the URL could not be parsed. """
+        cache = self.cache
+        if cache is not None:
+            cachekey = (url, ruleset.version, self.removeAffiliate, self.mergeGlobalBlacklists)
+            snapshot = cache.get(cachekey)
+            if snapshot is not None:
+                return CleanedURL.fromSnapshot(url, snapshot, ruleset.rules)
+        try:
+            cleanedurl = CleanedURL(url, ruleset.rules)
+        except:
+            # We are not validating those URLs before so errors during parsing may happen
+            return None
+        isComplete = True
+        if self.guardRegexes:
+            if len(url) > self.maxURLLength:
+                # Leave huge URLs untouched instead of running hundreds of regular expressions on them. Not cached as this is no real result.
+                return cleanedurl
+            isComplete = self.applyRulesTimed(cleanedurl, ruleset)
+        elif self.metrics is not None or (self.profiler is not None and self.profiler.isTracing()):
+            self.applyRulesTimed(cleanedurl, ruleset)
+        else:
+            self.applyRules(cleanedurl, ruleset)
+        if cache is not None and isComplete:
+            # Results containing random characters are not cached
+            runtimerules = ruleset.runtimerules
+            for index in cleanedurl.appliedruleindices:
+                if runtimerules[index].hasRandomChar:
+                    break
+            else:
+                cache.put(cachekey, url, cleanedurl)
+        return cleanedurl
+
+    def applyRules(self, cleanedurl: CleanedURL, ruleset: CompiledRuleset):
+        mergeGlobalBlacklists = self.mergeGlobalBlacklists and len(ruleset.globalblacklistrules) > 0
+        # Only check rules which are allowed to run on the domain of this URL and whose urlPattern matches
+        for ruleindex in ruleset.getCandidateRuleIndices(cleanedurl.originalurl, cleanedurl.cleanedurl.hostname, mergeGlobalBlacklists=mergeGlobalBlacklists):
+            if mergeGlobalBlacklists and ruleindex == ruleset.globalblacklistrules[0]:
+                if self.removeGlobalBlacklistedParameters(cleanedurl, ruleset):
+                    break
+                continue
+            cleaningrule = ruleset.runtimerules[ruleindex]
+            if not cleaningrule.enabled:
+                # Skip disabled rules
+                continue
+            ruleApplicationStatus = self.cleanURL(cleanedurl, cleaningrule, prechecked=True)
+            if ruleApplicationStatus is True and cleaningrule.stopAfterThisRule:
+                break
+
+    def applyRulesTimed(self, cleanedurl: CleanedURL, ruleset: CompiledRuleset) -> bool:
+        """ Same as applyRules but measures every single rule for metrics, guardRegexes and the slow URL log of the profiler.
+         Kept separate so that the default mode does not pay for it.
+         Rules are measured via CPU time of the current thread as other threads holding the GIL must not make a rule look slow.
+         Returns False if guardRegexes skipped any rule of the ruleset e.g. because the time budget of the URL was used up so the result must not be cached.
+         """
+        metrics = self.metrics
+        guardRegexes = self.guardRegexes
+        evaluations = []
+        mergeGlobalBlacklists = self.mergeGlobalBlacklists and len(ruleset.globalblacklistrules) > 0
+        timestart = time.thread_time()
+        candidates = ruleset.getCandidateRuleIndices(cleanedurl.originalurl, cleanedurl.cleanedurl.hostname, mergeGlobalBlacklists=mergeGlobalBlacklists)
+        urltime = time.thread_time() - timestart
+        isComplete = True
+        if guardRegexes and urltime > self.regexRuleBudget:
+            self.quarantineSlowURLPatterns(cleanedurl.originalurl, ruleset)
+        try:
+            for ruleindex in candidates:
+                if guardRegexes and urltime > self.regexURLBudget:
+                    # URLs of users are never logged as they are
+                    print(f"Stopped cleaning URL after {urltime:.3f}s: {redactURL(cleanedurl.originalurl)[:100]}")
+                    isComplete = False
+                    break
+                if mergeGlobalBlacklists and ruleindex == ruleset.globalblacklistrules[0]:
+                    numappliedrules = len(cleanedurl.appliedruleindices)
+                    timestart = time.thread_time()
+                    stopAfterThisRule = self.removeGlobalBlacklistedParameters(cleanedurl, ruleset)
+                    ruletime = time.thread_time() - timestart
+                    urltime += ruletime
+                    evaluations.append((MERGED_GLOBAL_BLACKLISTS_NAME, ruletime, False))
+                    for index in cleanedurl.appliedruleindices[numappliedrules:]:
+                        evaluations.append((ruleset.runtimerules[index].name, 0.0, True))
+                    if stopAfterThisRule:
+                        break
+                    continue
+                cleaningrule = ruleset.runtimerules[ruleindex]
+                if not cleaningrule.enabled:
+                    continue
+                if guardRegexes and cleaningrule.name in self.quarantinedrules:
+                    # Ruleset has been replaced by one without this rule in the meantime
+                    isComplete = False
+                    continue
+                timestart = time.thread_time()
+                try:
+                    ruleApplicationStatus = self.cleanURL(cleanedurl, cleaningrule, prechecked=True)
+                except Exception:
+                    if metrics is not None:
+                        metrics.recordRuleException(cleaningrule.name)
+                    raise
+                ruletime = time.thread_time() - timestart
+                urltime += ruletime
+                evaluations.append((cleaningrule.name, ruletime, ruleApplicationStatus))
+                if guardRegexes and ruletime > self.regexRuleBudget:
+                    self.recordSlowRule(cleaningrule, f"Took {ruletime:.3f}s for a single URL")
+                if ruleApplicationStatus is True and cleaningrule.stopAfterThisRule:
+                    break
+        finally:
+            if metrics is not None:
+                metrics.recordURL(evaluations)
+            profiler = self.profiler
+            if profiler is not None and urltime > profiler.slowurlthreshold and profiler.isTracing():
+                profiler.logSlowURL(cleanedurl.originalurl, cleanedurl.getURL(), evaluations, urltime)
+        return isComplete
+
+    def quarantineSlowURLPatterns(self, url: str, ruleset: CompiledRuleset):
+        """ Finding the rules matching a URL took too long -> Check which urlPattern is responsible. """
+        for index in ruleset.patternrules:
+            rule = ruleset.runtimerules[index]
+            timestart = time.thread_time()
+            rule.urlPattern.search(url)
+            searchtime = time.thread_time() - timestart
+            if searchtime > self.regexRuleBudget:
+                self.recordSlowRule(rule, f"urlPattern took {searchtime:.3f}s for a single URL")
+
+    def recordSlowRule(self, rule: Union[CleaningRule, RuntimeRule], reason: str):
+        """ Quarantines given rule once it has been too slow regexMaxOverruns times so a single unlucky measurement doesn't remove a rule. """
+        with self.rulesetlock:
+            if rule.name in self.quarantinedrules:
+                return
+            overruns = self.ruleoverruns.get(rule.name, 0) + 1
+            self.ruleoverruns[rule.name] = overruns
+            if overruns < self.regexMaxOverruns:
+                print(f"Rule {rule.name} was too slow ({overruns}/{self.regexMaxOverruns}): {reason}")
+                return
+            self.slowrules.add(rule.name)
+        self.quarantineRule(rule, reason)
+
+    def clearSlowRuleQuarantines(self):
+        """ Forgets rules which were quarantined because they were too slow. Rules with unsafe patterns stay quarantined.
+         Does not add them back to the current ruleset, that happens with the next ruleset which gets built e.g. by RulesetReloader.
+         """
+        with self.rulesetlock:
+            for rulename in self.slowrules:
+                self.quarantinedrules.pop(rulename, None)
+            self.slowrules.clear()
+            self.ruleoverruns.clear()
+
+    def quarantineRule(self, rule: Union[CleaningRule, RuntimeRule], reason: str):
+        """ Stops using the given rule. Rules already in use are removed from the ruleset which is swapped in atomically, see setRuleset. """
+        with self.rulesetlock:
+            if rule.name in self.quarantinedrules:
+                return
+            self.quarantinedrules[rule.name] = reason
+            print(f"Quarantined rule {rule.name}: {reason}")
+            ruleset = self.ruleset
+            if ruleset is not None and any(otherrule.name == rule.name for otherrule in ruleset.rules):
+                self.setRuleset(CompiledRuleset([otherrule for otherrule in ruleset.rules if otherrule.name not in self.quarantinedrules]))
+        if self.metrics is not None:
+            self.metrics.recordQuarantinedRule(rule.name)
+
+    def cleanURL(self, cleanedurl: CleanedURL, rule: RuntimeRule, prechecked: bool = False) -> bool:
+        """ Applies given rule to given URL. The rule needs to be part of the ruleset whose rules were given to the CleanedURL.
+         prechecked: Set this to True if urlPattern and domainwhitelist of this rule have already been checked via CompiledRuleset.getCandidateRules.
+         """
+        if not prechecked:
+            if rule.urlPattern is not None and rule.urlPattern.search(cleanedurl.originalurl) is None:
                 # URL does not match pattern of this rule
                 return False
+            if not isDomainWhitelisted(rule, cleanedurl.cleanedurl.hostname):
+                # Rule has domain-whitelist and domain of given URL is not on that whitelist so we cannot apply the rule.
+                return False
+        # Check for exceptions by regex
         for exceptionregex in rule.exceptionsregexlist:
-            if re.search(exceptionregex, cleanedurl.originalurl):
+            if exceptionregex.search(cleanedurl.originalurl):
                 cleanedurl.isException = True
                 return False
-
-        if len(rule.domainwhitelist) > 0:
-            # Check if rule-execution is allowed by whitelist if we got a whitelist
-            domain = cleanedurl.cleanedurl.hostname
-            if rule.domainwhitelistIgnoreSubdomains:
-                domainAllowed = False
-                for whitelisteddomain in rule.domainwhitelist:
-                    if domain.endswith(whitelisteddomain):
-                        domainAllowed = True
-                        break
-                if not domainAllowed:
-                    return False
-            else:
-                domainToCompare = domain
-                if rule.domainwhitelistIgnoreWWW:
-                    domainToCompare = domain.replace('www.', '')
-                if domainToCompare not in rule.domainwhitelist:
-                    # Rule has domain-whitelist and domain of given URL is not on that whitelist so we cannot apply the rule.
-                    return False
         newurl = None
         newurl_regex = None
         newurl_urlparam = None
@@ -190,7 +697,7 @@ class URLCleaner:
             # if newurl is None:
             #     # Default: Use first match
             #     newurl = "<regexmatch:0>"
-            matches = re.finditer(rule.rewriteURLSourcePattern, cleanedurl.originalurl)
+            matches = rule.rewriteURLSourcePattern.finditer(cleanedurl.originalurl)
             for match in matches:
                 for index in range(0, match.lastindex + 1):
                     matchText = match.group(index)
@@ -198,16 +705,15 @@ class URLCleaner:
             randomletter = random.choice(string.ascii_lowercase)
             # Execute other replacements
             newurl = newurl.replace(f"<randomchar>", randomletter)
-            newurl_regex = str(rule.rewriteURLSourcePattern)
-        if len(rule.redirectsregexlist) is not None:
-            for pattern_str in rule.redirectsregexlist:
-                regex = re.search(pattern_str, cleanedurl.originalurl)
-                if regex:
-                    # Hit
-                    newurl = regex.group(1)
-                    newurl_regex = pattern_str
-                    break
-        if newurl is None and len(rule.redirectparameterlist) > 0:
+            newurl_regex = rule.rewriteURLSourcePattern.pattern
+        for pattern in rule.redirectsregexlist:
+            regex = pattern.search(cleanedurl.originalurl)
+            if regex:
+                # Hit
+                newurl = regex.group(1)
+                newurl_regex = pattern.pattern
+                break
+        if newurl is None and rule.redirectparameterlist:
             for urlparam in rule.redirectparameterlist:
                 newurl = cleanedurl.query.get(urlparam)
                 if newurl is not None:
@@ -225,10 +731,12 @@ class URLCleaner:
             cleanedurl.newurl_urlparam = newurl_urlparam
             if newurl != cleanedurl.originalurl:
                 try:
-                    cleanedurl.cleanedurl = urlparse(newurl)
+                    cleanedurl.setURL(newurl)
                 except Exception as error:
                     # This means tat whoever created that rule f*cked up
                     print(f"Warning: Rule '{rule.name}' would result in invalid URL -> {newurl}")
+                    if self.metrics is not None:
+                        self.metrics.recordInvalidResult(rule.name)
             else:
                 # Rule created the same URL that put in -> Rule doesn't make any sense
                 # TODO: Use logging vs print statment
@@ -236,42 +744,70 @@ class URLCleaner:
             appendedRule = True
         else:
             # Collect tracking parameters which should be removed
-            removeParamsTracking = []
+            removeParamsTracking = ()
             if rule.removeAllParameters:
-                # TODO: Add performance optimization for this e.g. remove by substring lastindexof('?')
                 # Remove all parameters from given URL RE: https://github.com/svenjacobs/leon/issues/70
-                for key in cleanedurl.query.keys():
-                    removeParamsTracking.append(key)
-                # cleanedurl.parsedURL = cleanedurl.parsedURL._replace(query=None)
-                # cleanedurl.query = None
+                # This is handled below by cutting off the complete query
+                pass
             elif rule.paramswhitelist is not None:
-                for key in cleanedurl.query.keys():
-                    if key not in rule.paramswhitelist:
-                        removeParamsTracking.append(key)
-                # cleanedurl.parsedURL = cleanedurl.parsedURL._replace(query=None)
-                # cleanedurl.query = None
-            elif rule.paramsblacklist is not None:
+                removeParamsTracking = [key for key in cleanedurl.query.keys() if key not in rule.paramswhitelist]
+            else:
                 removeParamsTracking = rule.paramsblacklist
             removedParams = []
             # Only remove affiliate related stuff if we are allowed to
-            if self.removeAffiliate and len(rule.paramsblacklist_affiliate) > 0:
+            if self.removeAffiliate and rule.paramsblacklist_affiliate:
                 removedParamsAffiliate = self.removeUrlParameters(cleanedurl, rule.paramsblacklist_affiliate, None)
                 removedParams += removedParamsAffiliate
-                cleanedurl.removedparams_affiliate += removedParamsAffiliate
-            if len(removeParamsTracking) > 0 or (rule.paramsblacklist_regex is not None and len(rule.paramsblacklist_regex) > 0):
+                cleanedurl.removedparams_affiliate += tuple(removedParamsAffiliate)
+            if removeParamsTracking or rule.paramsblacklist_regex:
                 removedParamsTracking = self.removeUrlParameters(cleanedurl, removeParamsTracking, rule.paramsblacklist_regex)
                 removedParams += removedParamsTracking
-                cleanedurl.removedparams_tracking += removedParamsTracking
-            # Replace query inside URL as we've changed the query
-            if len(removedParams) > 0:
-                cleanedurl.cleanedurl = cleanedurl.cleanedurl._replace(query=urlencode(cleanedurl.query, True))
+                cleanedurl.removedparams_tracking += tuple(removedParamsTracking)
+            if rule.removeAllParameters and len(cleanedurl.cleanedurl.query) > 0:
+                # No need to remove parameters one by one, just cut off the query
+                removedParamsTracking = list(cleanedurl.query.keys())
+                removedParams += removedParamsTracking
+                cleanedurl.removedparams_tracking += tuple(removedParamsTracking)
+                cleanedurl.query.clear()
+                cleanedurl.cleanedurl = cleanedurl.cleanedurl._replace(query='')
+                appendedRule = len(removedParams) > 0
+            elif len(removedParams) > 0:
+                # Replace query inside URL as we've changed the query
+                cleanedurl.updateQuery()
                 appendedRule = True
 
         if appendedRule:
-            cleanedurl.appliedrules.append(rule)
+            cleanedurl.appliedruleindices += (rule.index,)
         return appendedRule
 
-    def removeUrlParameters(self, cleanedurl: CleanedURL, paramsblacklist: Union[list, None], paramsblacklistRegex: Union[list, None]):
+    def removeGlobalBlacklistedParameters(self, cleanedurl: CleanedURL, ruleset: CompiledRuleset) -> bool:
+        """ Applies all global blacklist rules of given ruleset at once, see self.mergeGlobalBlacklists.
+         Applied rules and removed parameters are added in the same order as if those rules had been applied one by one.
+         Returns True if no further rules should be processed.
+         """
+        if ruleset.globalblacklist.isdisjoint(cleanedurl.query.keys()):
+            # Most common case: Nothing to do
+            return False
+        removals = []
+        for key in cleanedurl.query.keys():
+            owner = ruleset.globalblacklistowners.get(key)
+            if owner is not None:
+                removals.append((owner, key))
+        removals.sort()
+        stopAfterThisRule = False
+        appliedruleindices = list(cleanedurl.appliedruleindices)
+        for (ruleindex, position), key in removals:
+            cleanedurl.query.pop(key)
+            if len(appliedruleindices) == 0 or appliedruleindices[-1] != ruleindex:
+                appliedruleindices.append(ruleindex)
+            if ruleset.runtimerules[ruleindex].stopAfterThisRule:
+                stopAfterThisRule = True
+        cleanedurl.removedparams_tracking += tuple(key for _, key in removals)
+        cleanedurl.appliedruleindices = tuple(appliedruleindices)
+        cleanedurl.updateQuery()
+        return stopAfterThisRule
+
+    def removeUrlParameters(self, cleanedurl: CleanedURL, paramsblacklist: Union[Iterable[str], None], paramsblacklistRegex: Union[Iterable[re.Pattern], None]):
         if paramsblacklist is None:
             paramsblacklist = []
         if paramsblacklistRegex is None:
@@ -283,14 +819,10 @@ class URLCleaner:
         for paramRegex in paramsblacklistRegex:
             # Remove parameters via regular expression
             for paramkey in list(cleanedurl.query.keys()):
-                try:
-                    if re.search(paramRegex, paramkey) is not None:
-                        cleanedurl.query.pop(paramkey)
-                        removedParams.append(paramkey)
-                        break
-                except:
-                    print(f"Invalid regular expression added by user: {paramRegex}")
-                    pass
+                if paramRegex.search(paramkey) is not None:
+                    cleanedurl.query.pop(paramkey)
+                    removedParams.append(paramkey)
+                    break
         return removedParams
 
 
@@ -301,14 +833,14 @@ def getDefaultCleaningRules() -> List[CleaningRule]:
     cleaningrules = [CleaningRule(name="Google's Urchin Tracking Module",
                                   paramsblacklist=["_ga", "utm_id", "utm_source", "utm_medium", "utm_term", "utm_campaign", "utm_content", "utm_name", "utm_cid",
                                                    "utm_reader", "utm_viz_id",
-                                                   "utm_pubreferrer", "utm_swu", "_ga", "gclsrc", "dclid", "adposition", "campaignid", "adgroupid", "feeditemid",
+                                                   "utm_pubreferrer", "utm_swu", "gclsrc", "dclid", "adposition", "campaignid", "adgroupid", "feeditemid",
                                                    "targetid"], stopAfterThisRule=False),
                      CleaningRule(name="Google Click Identifier", paramsblacklist=["gclid"], stopAfterThisRule=False),
                      CleaningRule(name="Adobe Omniture SiteCatalyst", paramsblacklist=["IC_ID"]),
                      CleaningRule(name="Adobe misc", paramsblacklist=["s_cid", "s_kwcid"]),
                      CleaningRule(name="Hubspot",
-                                  paramsblacklist=["_hs_enc", "_hs_mi", "hsa_cam", "hsa_grp", "hsa_mt", "hsa_src", "hsa_ad", "hsa_acc", "hsa_net", "hsa_cam", "hsa_grp",
-                                                   "hsa_mt", "hsa_src", "hsa_ad", "hsa_acc", "hsa_net", "hsa_kw", "hsa_tgt", "hsa_ver"], stopAfterThisRule=False),
+                                  paramsblacklist=["_hs_enc", "_hs_mi", "hsa_cam", "hsa_grp", "hsa_mt", "hsa_src", "hsa_ad", "hsa_acc", "hsa_net", "hsa_kw", "hsa_tgt",
+                                                   "hsa_ver"], stopAfterThisRule=False),
                      CleaningRule(name="Marketo", paramsblacklist=["mkt_tok"]),
                      # https://mailchimp.com/developer/marketing/docs/e-commerce/
                      CleaningRule(name="MailChimp", paramsblacklist=["mc_cid", "mc_eid"]),
@@ -339,7 +871,7 @@ def getDefaultCleaningRules() -> List[CleaningRule]:
 
                      CleaningRule(name="Amazon remove all parameters test",
                                   description="Removes all parameters from any amazon URLs since usually people are sending roduct URLs where only the product-ID matters and that is part of the path and not a parameter.",
-                                  domainwhitelist=["amazon.com", "amazon.co.uk", "amazon.ca", "amazon.de", "amazon.es""amazon.fr", "amazon.it", "amazon.co.jp",
+                                  domainwhitelist=["amazon.com", "amazon.co.uk", "amazon.ca", "amazon.de", "amazon.es", "amazon.fr", "amazon.it", "amazon.co.jp",
                                                    "amazon.in", "amazon.cn", "amazon.com.sg", "amazon.com.mx", "amazon.ae", "amazon.com.br", "amazon.nl", "amazon.com.au",
                                                    "amazon.com.tr", "amazon.sa", "amazon.se", "amazon.pl"], paramsblacklist_affiliate=["tag", "ascsubtag"], removeAllParameters=True),
                      CleaningRule(name="fastcompany.com remove all parameters test",
@@ -0,0 +1,247 @@
+import argparse
+import contextlib
+import io
+import json
+import os.path
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from typing import List, Dict, Callable, Union
+
+from CleaningRule import CleaningRule
+from URLCleaner import URLCleaner, getDefaultCleaningRules
+
+# Measures performance of URLCleaner and writes the results as JSON.
+# Example:
+#  python3 URLCleanerBenchmark.py -o before.json
+#  python3 URLCleanerBenchmark.py -o after.json
+#  python3 URLCleanerBenchmark.py --compare before.json after.json
+
+BENCHMARK_FORMAT_VERSION = 1
+
+# Domains used to generate the mixed traffic corpus, all of them are covered by default rules
+MIXED_DOMAINS = ["www.amazon.de", "www.amazon.com", "www.youtube.com", "youtu.be", "x.com", "twitter.com", "www.ebay.de", "www.ebay.com", "www.mydealz.de",
+                 "github.com", "www.google.com", "open.spotify.com", "www.instagram.com", "www.spiegel.de", "www.theguardian.com", "www.aliexpress.com",
+                 "noagreements.bandcamp.com", "www.bloomberg.com", "example.com", "www.wikipedia.org", "news.ycombinator.com", "www.reddit.com"]
+MIXED_TRACKING_PARAMS = ["utm_source", "utm_medium", "utm_campaign", "gclid", "fbclid", "si", "igshid", "mc_cid", "spm", "_hsenc", "msclkid", "ref_", "tag", "s", "t"]
+MIXED_NORMAL_PARAMS = ["q", "id", "page", "v", "lang", "sort", "_nkw", "list", "index", "th"]
+SYNTHETIC_RULES_COUNT = 5000
+# Relative changes above this are reported as regressions by --compare
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+
+
+def percentile(sortedvalues: List[float], percent: float) -> float:
+    if len(sortedvalues) == 0:
+        return 0
+    index = min(len(sortedvalues) - 1, int(round(percent / 100 * (len(sortedvalues) - 1))))
+    return sortedvalues[index]
+
+
+def getSyntheticCleaningRules(count: int) -> List[CleaningRule]:
+    """ Returns default rules plus given number of generated rules: Mostly domain specific rules, some rules with urlPattern and a few global ones. """
+    rules = getDefaultCleaningRules()
+    for index in range(count):
+        kind = index % 20
+        if kind < 14:
+            rules.append(CleaningRule(name=f"Synthetic domain rule {index}", domainwhitelist=[f"shop{index}.example"], paramsblacklist=[f"trk{index}", "ref"]))
+        elif kind < 19:
+            rules.append(CleaningRule(name=f"Synthetic pattern rule {index}", urlPattern=f"^https?:\\/\\/(?:[a-z0-9-]+\\.)*?brand{index}\\.example\\/",
+                                      paramsblacklist_regex=[f"^x{index}_"]))
+        else:
+            rules.append(CleaningRule(name=f"Synthetic global rule {index}", paramsblacklist=[f"gp{index}"], stopAfterThisRule=False))
+    return rules
+
+
+def getMixedCorpus(count: int, seed: int = 1) -> List[str]:
+    """ Generates URLs which look like real traffic: Known and unknown domains, with and without tracking parameters. """
+    randomizer = random.Random(seed)
+    urls = []
+    for index in range(count):
+        if randomizer.random() < 0.2:
+            domain = f"shop{randomizer.randrange(SYNTHETIC_RULES_COUNT)}.example"
+        else:
+            domain = randomizer.choice(MIXED_DOMAINS)
+        path = "/".join(randomizer.choice(["item", "dp", "watch", "track", "deals", "p", "status"]) + str(randomizer.randrange(10 ** 6)) for _ in range(randomizer.randint(1, 3)))
+        params = []
+        for _ in range(randomizer.choice([0, 0, 1, 2, 3, 5, 8])):
+            key = randomizer.choice(MIXED_TRACKING_PARAMS if randomizer.random() < 0.6 else MIXED_NORMAL_PARAMS)
+            params.append(f"{key}={randomizer.randrange(10 ** 9):x}")
+        url = f"https://{domain}/{path}"
+        if len(params) > 0:
+            url += "?" + "&".join(params)
+        urls.append(url)
+    return urls
+
+
+def getMessagesCorpus(urls: List[str], count: int, urlspermessage: int, seed: int = 1) -> List[str]:
+    """ Generates long messages e.g. forwarded newsletters containing many URLs. """
+    randomizer = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        parts = []
+        for url in randomizer.sample(urls, min(urlspermessage, len(urls))):
+            parts.append(randomizer.choice(["Check this out:", "Deal of the day", "See", "via", "->", "Source:"]))
+            parts.append(url + randomizer.choice(["", "", ".", ",", ")"]))
+        messages.append(" ".join(parts))
+    return messages
+
+
+def getTestURLsCorpus() -> List[str]:
+    urls = []
+    for rule in getDefaultCleaningRules():
+        if rule.testurls is not None:
+            urls += rule.testurls
+    return urls
+
+
+def getTestlinksCorpus(path: str = "Testlinks.txt") -> List[str]:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as infile:
+        return [line.strip() for line in infile if len(line.strip()) > 0]
+
+
+def measureLatencies(function: Callable[[str], object], items: List[str], repeat: int) -> Dict[str, float]:
+    """ Calls given function for every item and returns throughput and latency percentiles in microseconds. """
+    latencies = []
+    numurls = 0
+    for _ in range(repeat):
+        for item in items:
+            start = time.perf_counter_ns()
+            result = function(item)
+            latencies.append((time.perf_counter_ns() - start) / 1000)
+            numurls += len(result.cleanedurls) if hasattr(result, "cleanedurls") else 1
+    latencies.sort()
+    totalseconds = sum(latencies) / 1000000
+    return dict(items=len(items), urls=numurls, urls_per_sec=numurls / totalseconds if totalseconds > 0 else 0, p50_us=percentile(latencies, 50),
+                p99_us=percentile(latencies, 99), mean_us=statistics.fmean(latencies) if len(latencies) > 0 else 0)
+
+
+def measureMemoryPerCleanedURL(cleaner: URLCleaner, urls: List[str]) -> float:
+    """ Returns average number of bytes allocated for a single CleanedURL which is kept alive. """
+    if len(urls) == 0:
+        return 0
+    ruleset = cleaner.getRuleset()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        results = [cleaner.cleanSingleURL(url, ruleset) for url in urls]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del results
+    return (after - before) / len(urls)
+
+
+def buildCleaner(rulesetname: str, clearurlspath: str) -> Union[URLCleaner, None]:
+    cleaner = URLCleaner()
+    if rulesetname == "defaults+clearurls":
+        if not os.path.exists(clearurlspath):
+            return None
+        cleaner.importCleaningRules(clearurlspath)
+    elif rulesetname == "synthetic":
+        cleaner.cleaningrules = getSyntheticCleaningRules(SYNTHETIC_RULES_COUNT)
+    cleaner.getRuleset()
+    return cleaner
+
+
+def runBenchmark(args) -> dict:
+    results = dict(format=BENCHMARK_FORMAT_VERSION, python=platform.python_version(), platform=platform.platform(), startup={}, runs={}, skipped=[])
+    # Startup
+    start = time.perf_counter()
+    cleaner = URLCleaner()
+    cleaner.getRuleset()
+    results["startup"]["construct_urlcleaner_s"] = time.perf_counter() - start
+    if os.path.exists(args.clearurls):
+        start = time.perf_counter()
+        cleaner.importCleaningRules(args.clearurls)
+        cleaner.getRuleset()
+        results["startup"]["import_clearurls_s"] = time.perf_counter() - start
+    mixed = getMixedCorpus(args.urls)
+    corpora = dict(testlinks=getTestlinksCorpus(), testurls=getTestURLsCorpus(), mixed=mixed, messages=getMessagesCorpus(mixed, count=args.messages, urlspermessage=100))
+    for rulesetname in ["defaults", "defaults+clearurls", "synthetic"]:
+        cleaner = buildCleaner(rulesetname, args.clearurls)
+        if cleaner is None:
+            results["skipped"].append(f"{rulesetname}: File does not exist: {args.clearurls}")
+            continue
+        cleaner.mergeGlobalBlacklists = args.merge_global_blacklists
+        ruleset = cleaner.getRuleset()
+        rulesetresults = dict(rules=len(ruleset.rules))
+        for corpusname, items in corpora.items():
+            if len(items) == 0:
+                results["skipped"].append(f"{rulesetname}/{corpusname}: Empty corpus")
+                continue
+            rulesetresults[f"{corpusname}/cleanText"] = measureLatencies(cleaner.cleanText, items, args.repeat)
+            if corpusname != "messages":
+                # Messages contain many URLs, single URLs are already covered by the other corpora
+                rulesetresults[f"{corpusname}/cleanURL"] = measureLatencies(lambda url: cleaner.cleanSingleURL(url, ruleset), items, args.repeat)
+        rulesetresults["bytes_per_cleanedurl"] = measureMemoryPerCleanedURL(cleaner, mixed)
+        results["runs"][rulesetname] = rulesetresults
+    return results
+
+
+def compareResults(old: dict, new: dict, threshold: float) -> List[str]:
+    """ Returns human readable descriptions of all values which got worse by more than given relative threshold. """
+    regressions = []
+
+    def check(name: str, oldvalue: float, newvalue: float, higherisbetter: bool):
+        if oldvalue is None or newvalue is None or oldvalue <= 0:
+            return
+        change = (newvalue - oldvalue) / oldvalue
+        if (higherisbetter and change < -threshold) or (not higherisbetter and change > threshold):
+            regressions.append(f"{name}: {oldvalue:.2f} -> {newvalue:.2f} ({change:+.1%})")
+
+    for key, oldvalue in old.get("startup", {}).items():
+        check(f"startup/{key}", oldvalue, new.get("startup", {}).get(key), higherisbetter=False)
+    for rulesetname, oldruns in old.get("runs", {}).items():
+        newruns = new.get("runs", {}).get(rulesetname)
+        if newruns is None:
+            continue
+        for key, oldrun in oldruns.items():
+            newrun = newruns.get(key)
+            if newrun is None:
+                continue
+            if key == "bytes_per_cleanedurl":
+                check(f"{rulesetname}/{key}", oldrun, newrun, higherisbetter=False)
+            elif isinstance(oldrun, dict):
+                check(f"{rulesetname}/{key}/urls_per_sec", oldrun["urls_per_sec"], newrun["urls_per_sec"], higherisbetter=True)
+                check(f"{rulesetname}/{key}/p50_us", oldrun["p50_us"], newrun["p50_us"], higherisbetter=False)
+                check(f"{rulesetname}/{key}/p99_us", oldrun["p99_us"], newrun["p99_us"], higherisbetter=False)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark for URLCleaner")
+    parser.add_argument("-o", "--output", default='-', help="Write results as JSON into this file, default: stdout")
+    parser.add_argument("--clearurls", default="data.minify.json", help="Rules of the ClearURLs addon")
+    parser.add_argument("--urls", type=int, default=5000, help="Number of URLs of the generated mixed traffic corpus")
+    parser.add_argument("--messages", type=int, default=50, help="Number of generated long messages containing 100 URLs each")
+    parser.add_argument("--repeat", type=int, default=3, help="How often every corpus is cleaned")
+    parser.add_argument("--merge-global-blacklists", action='store_true', help="See URLCleaner.mergeGlobalBlacklists")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files instead of running the benchmark")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD, help="Relative change which is reported as regression by --compare")
+    args = parser.parse_args()
+    if args.compare is not None:
+        with open(args.compare[0], encoding='utf-8') as infile:
+            old = json.load(infile)
+        with open(args.compare[1], encoding='utf-8') as infile:
+            new = json.load(infile)
+        regressions = compareResults(old, new, args.threshold)
+        print(json.dumps(dict(regressions=regressions), indent=2))
+        sys.exit(1 if len(regressions) > 0 else 0)
+    # URLCleaner prints messages which must not end up inside the results
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = runBenchmark(args)
+    resultjson = json.dumps(results, indent=2)
+    if args.output == '-':
+        print(resultjson)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as outfile:
+            outfile.write(resultjson)
+
+
+if __name__ == '__main__':
+    main()
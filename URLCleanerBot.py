@@ -1,18 +1,129 @@
+import asyncio
+import html
 import json
-import os.path
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Literal, Union, List, Tuple, Sequence, Dict, AsyncIterator
 
+import httpx
 import pydantic
-from telegram import Update, User
-from telegram.ext import CommandHandler, CallbackContext, Application, filters, MessageHandler
+from telegram import Update, User, MessageEntity, InlineQueryResultArticle, InputTextMessageContent
+from telegram.constants import ChatMemberStatus
+from telegram.error import TelegramError
+from telegram.ext import CommandHandler, CallbackContext, Application, filters, MessageHandler, InlineQueryHandler
 import logging
 
 
-from URLCleaner import URLCleaner
+from AutoClean import ChatSettingsStore, RecentURLs
+from CleaningBackend import CleaningBackend, CleaningBackendBusyError
+from CleaningMetrics import CleaningMetrics, MetricsServer
+from CleaningProfiler import CleaningProfiler
+from DocumentCleaner import DocumentStats, DocumentTooLargeError, cleanDocumentLines, getDocumentFormat, getTopEntries, iterLineBatches
+from MessageSender import MessageSender, splitMessage, MAX_MESSAGE_LENGTH
+from RulesetReloader import RulesetReloader
+from RulesetSnapshot import loadURLCleaner
+from ShortlinkExpander import ShortlinkExpander, ShortlinkCache, DEFAULT_SHORTENER_HOSTS
+from URLCleaner import CleanedURL, CleanResult, findURLs, addMissingScheme
 
 
 class Config(pydantic.BaseModel):
     bot_token: str
     bot_name: str
+    # How the bot receives updates: Long polling or webhook requests sent by Telegram
+    bot_mode: Literal["polling", "webhook"] = "polling"
+    # Address the built-in webhook server listens on, usually behind a local reverse proxy which terminates TLS
+    webhook_listen: str = "127.0.0.1"
+    webhook_port: int = 8443
+    webhook_url_path: str = "webhook"
+    # Public URL of the reverse proxy which forwards to webhook_listen:webhook_port/webhook_url_path, required in webhook mode
+    webhook_url: Union[str, None] = None
+    # Sent by Telegram in the header X-Telegram-Bot-Api-Secret-Token, requests without it are rejected
+    webhook_secret_token: Union[str, None] = None
+    # Max number of simultaneous connections Telegram uses to deliver updates
+    webhook_max_connections: int = 40
+    # Where URLs get cleaned, see CleaningBackend
+    cleaning_backend: Literal["inline", "thread", "process"] = "thread"
+    cleaning_workers: int = 2
+    cleaning_max_inflight: int = 8
+    cleaning_max_queued: int = 32
+    # Max CPU time in seconds used to clean the URLs of a single message
+    cleaning_time_budget: Union[float, None] = 2.0
+    cleaning_max_urls_per_message: Union[int, None] = 100
+    # Protection against slow regular expressions of imported rules, see URLCleaner.guardRegexes
+    cleaning_guard_regexes: bool = True
+    cleaning_max_url_length: int = 4096
+    # Number of updates which are processed at the same time
+    concurrent_updates: int = 16
+    # Compiled rules are stored in this file for faster startup, None = disabled
+    rules_snapshot_path: Union[str, None] = "cleaningrules.snapshot"
+    # Rule files which get imported in addition to the default rules
+    rules_import_paths: List[str] = ["data.minify.json"]
+    # Seconds between checks for modified rule files, None = Rules only get reloaded via /reloadrules
+    rules_reload_interval: Union[float, None] = 60
+    # Telegram user IDs which are allowed to use admin commands like /reloadrules
+    admin_user_ids: List[int] = []
+    # Collect per rule and per message metrics, see /metrics
+    metrics_enabled: bool = False
+    # Serve metrics in the Prometheus text format via http://metrics_host:metrics_port/metrics, None = disabled
+    metrics_host: str = "127.0.0.1"
+    metrics_port: Union[int, None] = None
+    # Log URLs which take longer than profiling_slow_url_threshold seconds including the time spent on every rule, see CleaningProfiler
+    # False = Only while tracing was enabled via /trace
+    profiling_log_slow_urls: bool = False
+    profiling_slow_url_threshold: float = 0.05
+    profiling_slow_url_log: str = "slowurls.log"
+    # Only store domain, path lengths and parameter names of logged URLs
+    profiling_redact_urls: bool = True
+    # Share of messages which get profiled via cProfile, 0 = disabled
+    profiling_sample_rate: float = 0.0
+    profiling_dir: str = "profiles"
+    profiling_max_files: int = 20
+    # Max size in bytes of uploaded .txt/.csv/.html documents, the Bot API does not allow bots to download files bigger than 20MB
+    documents_max_size: int = 5 * 1024 * 1024
+    # Inline mode: Seconds to wait for further keystrokes before an inline query gets cleaned
+    inline_debounce: float = 0.3
+    # Seconds Telegram may cache answers to inline queries
+    inline_cache_time: int = 300
+    # Number of answers to inline queries which are kept locally
+    inline_cache_size: int = 1000
+    # Limits for sending messages, see MessageSender
+    sending_global_rate: float = 30
+    sending_chat_rate: float = 1
+    sending_group_rate: float = 20 / 60
+    # Resolve shortlinks like t.co or amzn.to via HTTP requests before cleaning them, see ShortlinkExpander
+    shortlinks_expand: bool = False
+    shortlinks_hosts: List[str] = DEFAULT_SHORTENER_HOSTS
+    # Max seconds a message waits for its shortlinks to be expanded, slower shortlinks are cleaned unexpanded
+    shortlinks_deadline: float = 3.0
+    shortlinks_max_hops: int = 5
+    shortlinks_per_host_limit: int = 4
+    # Expanded shortlinks are stored in this SQLite database, None = Only remember shortlinks which are being expanded right now
+    shortlinks_cache_path: Union[str, None] = "shortlinks.sqlite"
+    shortlinks_cache_ttl: float = 30 * 24 * 3600
+    shortlinks_cache_negative_ttl: float = 3600
+    # Groups and channels which enabled auto-cleaning via /autoclean
+    autoclean_settings_path: str = "chatsettings.json"
+    # Links which are posted again in the same chat within this many seconds are ignored
+    autoclean_dedup_window: float = 3600
+    autoclean_dedup_max_urls: int = 1000
+    # Documents of one user which are cleaned at the same time
+    documents_max_per_user: int = 1
+    # Lines cleaned per worker task, other messages can be cleaned between two batches
+    documents_batch_lines: int = 500
+    # Limits per document, URLs after them are left unchanged. None = Unlimited.
+    documents_max_urls: Union[int, None] = 10000
+    # CPU time in seconds
+    documents_time_budget: Union[float, None] = 20.0
+
+
+# Max length of captions of documents sent by bots
+MAX_CAPTION_LENGTH = 1024
+DOCUMENT_CHUNK_SIZE = 64 * 1024
+MAX_INLINE_TITLE_LENGTH = 200
+# Max length of the HTML for a single URL of a reply so it fits into one message together with the header
+MAX_REPLY_BLOCK_LENGTH = MAX_MESSAGE_LENGTH - 200
 
 
 def loadConfig() -> Config:
@@ -29,7 +140,23 @@ langDE = dict(
     text_cleaned_urls_success_snippet_applied_rules="Angewendete Regeln: {0}",
     text_cleaned_urls_success_removed_parameters="Entfernte Parameter: {0}",
     text_none="Keine",
-    text_url_is_already_clean_questionmark="URL ist bereits sauber?"
+    text_url_is_already_clean_questionmark="URL ist bereits sauber?",
+    text_too_many_links="❌Zu viele Links in einer Nachricht. Bitte sende weniger Links auf einmal.",
+    text_bot_busy="❌Der Bot ist gerade ausgelastet. Bitte versuche es später erneut.",
+    text_rules_reloaded="✅{numrules:.0f} Regeln geladen | Version: {version:.0f}",
+    text_rules_reload_failed="❌Regeln konnten nicht geladen werden, die alten Regeln bleiben aktiv:\n{0}",
+    text_metrics_disabled="Metriken sind deaktiviert, siehe metrics_enabled in config.json",
+    text_tracing_enabled="Langsame URLs werden für {minutes:.0f} Minuten in {path} protokolliert.",
+    text_tracing_disabled="Protokollierung langsamer URLs deaktiviert.",
+    text_document_cleaned="✅{numurls:.0f} URL(s) in {numlines:.0f} Zeilen gefunden, {numcleanedurls:.0f} davon bereinigt.",
+    text_document_too_large="❌Die Datei ist zu groß. Maximale Größe: {maxsize}",
+    text_document_too_many="❌Bitte warte, bis deine anderen Dateien bereinigt wurden.",
+    text_document_failed="❌Die Datei konnte nicht geladen werden.",
+    text_document_incomplete="⚠️Die Datei enthält zu viele Links. Nur die ersten {numurls:.0f} URL(s) wurden bereinigt, der Rest ist unverändert.",
+    text_autoclean_enabled="✅Links in diesem Chat werden automatisch bereinigt. Deaktivieren: /autoclean off",
+    text_autoclean_disabled="Links in diesem Chat werden nicht mehr automatisch bereinigt.",
+    text_autoclean_admins_only="❌Nur Admins können das automatische Bereinigen ändern.",
+    text_autoclean_reply="🧹Links ohne Tracking:"
 )
 
 langEN = dict(
@@ -40,7 +167,23 @@ langEN = dict(
     text_cleaned_urls_success_snippet_applied_rules="Applied rules: {0}",
     text_cleaned_urls_success_removed_parameters="Removed parameters: {0}",
     text_none="None",
-    text_url_is_already_clean_questionmark="URL is already clean?"
+    text_url_is_already_clean_questionmark="URL is already clean?",
+    text_too_many_links="❌Too many links in one message. Please send fewer links at once.",
+    text_bot_busy="❌The bot is busy right now. Please try again later.",
+    text_rules_reloaded="✅Loaded {numrules:.0f} rules | Version: {version:.0f}",
+    text_rules_reload_failed="❌Failed to load rules, old rules stay active:\n{0}",
+    text_metrics_disabled="Metrics are disabled, see metrics_enabled in config.json",
+    text_tracing_enabled="Slow URLs are logged to {path} for {minutes:.0f} minutes.",
+    text_tracing_disabled="Logging of slow URLs disabled.",
+    text_document_cleaned="✅Detected {numurls:.0f} URL(s) in {numlines:.0f} lines, cleaned {numcleanedurls:.0f} of them.",
+    text_document_too_large="❌This file is too large. Max size: {maxsize}",
+    text_document_too_many="❌Please wait until your other files have been cleaned.",
+    text_document_failed="❌Failed to download this file.",
+    text_document_incomplete="⚠️This file contains too many links. Only the first {numurls:.0f} URL(s) were cleaned, the rest is unchanged.",
+    text_autoclean_enabled="✅Links in this chat are cleaned automatically. Disable: /autoclean off",
+    text_autoclean_disabled="Links in this chat are no longer cleaned automatically.",
+    text_autoclean_admins_only="❌Only admins can change auto-cleaning.",
+    text_autoclean_reply="🧹Links without tracking:"
 )
 
 allLangsDict = dict(
@@ -51,84 +194,522 @@ allLangsDict = dict(
 
 def translate(key: str, lang: str) -> str:
     """ Returns translated text """
-    langdict = allLangsDict.get(lang, "en")
-    resultText = langdict.get(key, key)
+    langdict = allLangsDict.get(lang, langEN)
+    resultText = langdict.get(key)
+    if resultText is None:
+        resultText = langEN.get(key)
     if resultText is None:
         logging.warning(f"Failed to find any translation for key {key}")
         resultText = key
     return resultText
 
 
+class ReplyTemplates:
+    """ Texts of one language needed to answer messages with URLs. They get resolved and HTML escaped once at startup instead of for every single URL.
+     Replies which are too long for one message are split between two URLs.
+     """
+
+    def __init__(self, lang: str):
+        self.success = html.escape(translate("text_cleaned_urls_success", lang), quote=False)
+        self.clickablelink = html.escape(translate("text_cleaned_urls_success_snippet_clickable_link", lang), quote=False)
+        self.appliedrules = html.escape(translate("text_cleaned_urls_success_snippet_applied_rules", lang), quote=False)
+        self.removedparameters = html.escape(translate("text_cleaned_urls_success_removed_parameters", lang), quote=False)
+        self.none = html.escape(translate("text_none", lang), quote=False)
+        self.autoclean = html.escape(translate("text_autoclean_reply", lang), quote=False)
+        self.alreadyclean = self.appliedrules.format(self.none + " -&gt; " + html.escape(translate("text_url_is_already_clean_questionmark", lang), quote=False))
+
+    def renderCleanedURLs(self, cleanedurls: List[CleanedURL]) -> List[str]:
+        """ Returns one or more HTML messages listing the given URLs. """
+        blocks = [self.renderCleanedURL(cleanedurl, position if len(cleanedurls) > 1 else None) for position, cleanedurl in enumerate(cleanedurls, start=1)]
+        blocks[0] = self.success.format(numlinks=len(cleanedurls)) + "\n" + blocks[0]
+        return splitMessage(blocks, separator="\n---\n")
+
+    def renderAutoCleanReply(self, cleanedurls: List[CleanedURL]) -> List[str]:
+        """ Returns the short reply to a message in a group or channel which only lists the cleaned URLs.
+         URLs which do not fit into one message are left out as a shortened URL would be a broken link. Returns no message at all if none is left.
+         """
+        blocks = [block for block in (html.escape(cleanedurl.getURL(), quote=False) for cleanedurl in cleanedurls) if len(block) <= MAX_REPLY_BLOCK_LENGTH]
+        if len(blocks) == 0:
+            return []
+        blocks[0] = self.autoclean + "\n" + blocks[0]
+        return splitMessage(blocks)
+
+    def renderCleanedURL(self, cleanedurl: CleanedURL, position: Union[int, None]) -> str:
+        newlink = cleanedurl.getURL()
+        escapedlink = html.escape(newlink, quote=False)
+        lines = []
+        if position is not None:
+            lines.append(f"<b>URL {position}</b>")
+        lines.append(f"Code:\n<pre>{escapedlink}</pre>")
+        lines.append(self.clickablelink.format(escapedlink))
+        appliedrules = cleanedurl.appliedrules
+        if len(appliedrules) > 0:
+            lines.append(self.appliedrules.format(html.escape(", ".join(rule.name for rule in appliedrules), quote=False)))
+            if len(cleanedurl.removedparams_tracking) > 0:
+                lines.append(self.removedparameters.format(html.escape(", ".join(cleanedurl.removedparams_tracking), quote=False)))
+            else:
+                lines.append(self.removedparameters.format(self.none))
+        else:
+            lines.append(self.alreadyclean)
+        block = "\n".join(lines)
+        if len(block) > MAX_REPLY_BLOCK_LENGTH:
+            # Extremely long URL: Only send it once and cut it if it still does not fit
+            length = len(newlink)
+            while len(html.escape(newlink[:length], quote=False)) > MAX_REPLY_BLOCK_LENGTH - 50:
+                length -= 100
+            block = f"<pre>{html.escape(newlink[:length], quote=False)}</pre>"
+        return block
+
+
+def getEntityURLs(text: str, entities: Sequence[MessageEntity]) -> List[Tuple[int, int, str]]:
+    """ Returns (start, end, url) of all links Telegram detected inside given text, see URLCleaner.cleanText.
+     Offsets of Telegram entities are counted in UTF-16 code units so they differ from Python string positions as soon as the text contains e.g. emojis.
+     text_link entities return the hidden URL instead of the text they are attached to.
+     """
+    urlentities = sorted((entity for entity in entities if entity.type in (MessageEntity.URL, MessageEntity.TEXT_LINK)), key=lambda entity: entity.offset)
+    if len(urlentities) == 0:
+        return []
+    positions = None
+    if any(ord(char) > 0xFFFF for char in text):
+        # UTF-16 offset -> Position inside Python string, characters outside of the BMP need two UTF-16 code units
+        positions = []
+        for position, char in enumerate(text):
+            positions.append(position)
+            if ord(char) > 0xFFFF:
+                positions.append(position)
+        positions.append(len(text))
+    urlspans = []
+    for entity in urlentities:
+        start = entity.offset
+        end = entity.offset + entity.length
+        if positions is not None:
+            start = positions[start]
+            end = positions[end]
+        if entity.type == MessageEntity.TEXT_LINK:
+            urlspans.append((start, end, entity.url))
+        else:
+            urlspans.append((start, end, text[start:end]))
+    return urlspans
+
+
+def getInlineQueryResults(cleanresult: CleanResult) -> List[InlineQueryResultArticle]:
+    """ Returns the cleaned text followed by every single cleaned URL as results of an inline query. Titles and descriptions are not translated
+     so the same results can be used for all users.
+     """
+    results = []
+    if len(cleanresult.cleanedurls) == 0:
+        return results
+    if cleanresult.cleanedtext.strip() != cleanresult.cleanedurls[0].getURL() or len(cleanresult.cleanedurls) > 1:
+        results.append(InlineQueryResultArticle(id="text", title=cleanresult.cleanedtext[:MAX_INLINE_TITLE_LENGTH],
+                                                input_message_content=InputTextMessageContent(cleanresult.cleanedtext, disable_web_page_preview=True)))
+    # Telegram allows up to 50 results
+    for index, cleanedurl in enumerate(cleanresult.cleanedurls[:49]):
+        newlink = cleanedurl.getURL()
+        description = ", ".join(rule.name for rule in cleanedurl.appliedrules) or "-"
+        results.append(InlineQueryResultArticle(id=str(index), title=newlink[:MAX_INLINE_TITLE_LENGTH], description=description[:MAX_INLINE_TITLE_LENGTH],
+                                                input_message_content=InputTextMessageContent(newlink)))
+    return results
+
+
+def formatFileSize(numbytes: int) -> str:
+    if numbytes >= 1024 * 1024:
+        return f"{numbytes / (1024 * 1024):.1f}MB"
+    return f"{numbytes / 1024:.0f}KB"
+
+
 class URLCleanerBot:
     def __init__(self):
         self.cfg = loadConfig()
-        self.application = Application.builder().token(self.cfg.bot_token).read_timeout(30).write_timeout(30).build()
+        self.application = Application.builder().token(self.cfg.bot_token).read_timeout(30).write_timeout(30).concurrent_updates(
+            self.cfg.concurrent_updates).post_shutdown(self.onShutdown).build()
         self.initHandlers()
-        self.urlcleaner = URLCleaner()
-        if os.path.exists("data.minify.json"):
-            self.urlcleaner.importCleaningRules(path="data.minify.json")
+        self.sender = MessageSender(self.application.bot, globalrate=self.cfg.sending_global_rate, chatrate=self.cfg.sending_chat_rate,
+                                    grouprate=self.cfg.sending_group_rate)
+        # Language code -> Templates, unknown languages use English
+        self.replytemplates = {lang: ReplyTemplates(lang) for lang in allLangsDict}
+        # Telegram user ID -> Number of documents which are being cleaned right now
+        self.activedocuments: Dict[int, int] = {}
+        self.chatsettings = ChatSettingsStore(self.cfg.autoclean_settings_path)
+        # Chat ID -> Links posted recently, only for chats with auto-cleaning
+        self.recenturls: Dict[int, RecentURLs] = {}
+        # Telegram user ID -> Task answering the latest inline query of this user
+        self.inlinetasks: Dict[int, asyncio.Task] = {}
+        # (Query, ruleset version) -> Results
+        self.inlinecache: "OrderedDict[Tuple[str, int], List[InlineQueryResultArticle]]" = OrderedDict()
+        self.metrics = CleaningMetrics() if self.cfg.metrics_enabled else None
+        self.metricsserver = None
+        if self.metrics is not None and self.cfg.metrics_port is not None:
+            self.metricsserver = MetricsServer(self.metrics, host=self.cfg.metrics_host, port=self.cfg.metrics_port)
+            self.metricsserver.start()
+        self.urlcleaner = loadURLCleaner(importpaths=self.cfg.rules_import_paths, snapshotpath=self.cfg.rules_snapshot_path, metrics=self.metrics)
+        self.urlcleaner.guardRegexes = self.cfg.cleaning_guard_regexes
+        self.urlcleaner.maxURLLength = self.cfg.cleaning_max_url_length
+        if self.urlcleaner.profiler is None:
+            # Profiling configured via environment variables takes precedence
+            self.urlcleaner.profiler = CleaningProfiler(slowurlthreshold=self.cfg.profiling_slow_url_threshold, slowurllogpath=self.cfg.profiling_slow_url_log,
+                                                        alwaysTrace=self.cfg.profiling_log_slow_urls, redactURLs=self.cfg.profiling_redact_urls,
+                                                        samplerate=self.cfg.profiling_sample_rate, profiledir=self.cfg.profiling_dir,
+                                                        maxprofiles=self.cfg.profiling_max_files)
+        self.cleaningbackend = CleaningBackend(self.urlcleaner, mode=self.cfg.cleaning_backend, workers=self.cfg.cleaning_workers,
+                                               maxinflight=self.cfg.cleaning_max_inflight, maxqueued=self.cfg.cleaning_max_queued,
+                                               maxurls=self.cfg.cleaning_max_urls_per_message, timebudget=self.cfg.cleaning_time_budget)
+        self.rulesreloader = RulesetReloader(self.urlcleaner, importpaths=self.cfg.rules_import_paths, snapshotpath=self.cfg.rules_snapshot_path,
+                                             interval=self.cfg.rules_reload_interval or 60, onReload=lambda ruleset: self.cleaningbackend.onRulesetChanged())
+        if self.cfg.rules_reload_interval is not None:
+            self.rulesreloader.start()
+        self.shortlinkexpander = None
+        if self.cfg.shortlinks_expand:
+            shortlinkcache = None
+            if self.cfg.shortlinks_cache_path is not None:
+                shortlinkcache = ShortlinkCache(self.cfg.shortlinks_cache_path, positivettl=self.cfg.shortlinks_cache_ttl,
+                                                negativettl=self.cfg.shortlinks_cache_negative_ttl)
+            self.shortlinkexpander = ShortlinkExpander(shortenerhosts=self.cfg.shortlinks_hosts, maxhops=self.cfg.shortlinks_max_hops,
+                                                       perhostlimit=self.cfg.shortlinks_per_host_limit, cache=shortlinkcache)
 
     def initHandlers(self):
         """ Adds all handlers to dispatcher (not error_handlers!!) """
         self.application.add_handler(CommandHandler('start', self.botDisplayMenuMain))
         self.application.add_handler(CommandHandler('help', self.botDisplayMenuMain))
-        self.application.add_handler(MessageHandler(filters=filters.TEXT and (~filters.COMMAND), callback=self.botCleanURLs))
+        self.application.add_handler(CommandHandler('reloadrules', self.botReloadRules))
+        self.application.add_handler(CommandHandler('metrics', self.botSendMetrics))
+        self.application.add_handler(CommandHandler('trace', self.botTrace))
+        self.application.add_handler(CommandHandler('autoclean', self.botAutoClean, filters=filters.ChatType.GROUPS | filters.ChatType.CHANNEL))
+        # Messages in groups and channels are only handled at all if Telegram found a link inside them
+        linkfilter = filters.Entity(MessageEntity.URL) | filters.Entity(MessageEntity.TEXT_LINK) | filters.CaptionEntity(
+            MessageEntity.URL) | filters.CaptionEntity(MessageEntity.TEXT_LINK)
+        self.application.add_handler(MessageHandler(filters=(filters.ChatType.GROUPS | filters.ChatType.CHANNEL) & linkfilter & (~filters.UpdateType.EDITED) & (
+            ~filters.COMMAND), callback=self.botAutoCleanMessage))
+        documentfilter = filters.Document.FileExtension("txt") | filters.Document.FileExtension("csv") | filters.Document.FileExtension(
+            "html") | filters.Document.FileExtension("htm")
+        self.application.add_handler(InlineQueryHandler(self.botInlineQuery))
+        self.application.add_handler(MessageHandler(filters=filters.ChatType.PRIVATE & documentfilter, callback=self.botCleanDocument))
+        self.application.add_handler(MessageHandler(filters=filters.ChatType.PRIVATE & (filters.TEXT | filters.CAPTION) & (~filters.COMMAND),
+                                                    callback=self.botCleanURLs))
 
     async def botDisplayMenuMain(self, update: Update, context: CallbackContext):
         text = "<b>URLCleaner 0.3</b>"
         text += f"\n{self.translate('command_start_bot_info', update.effective_user)}"
-        return await self.application.updater.bot.send_message(chat_id=update.effective_user.id, text=text, parse_mode="HTML",
-                                                               disable_web_page_preview=True)
+        return await self.sender.sendMessage(update.effective_user.id, text=text, parse_mode="HTML", disable_web_page_preview=True)
+
+    async def botReloadRules(self, update: Update, context: CallbackContext):
+        """ Admin command: Loads modified rule files without restarting the bot. """
+        user = update.effective_user
+        if not self.isAdmin(user):
+            return None
+        # Building and validating the rules takes some time -> Do not block the event loop
+        if await asyncio.to_thread(self.rulesreloader.reload):
+            ruleset = self.urlcleaner.getRuleset()
+            text = self.translate("text_rules_reloaded", user).format(numrules=len(ruleset.rules), version=ruleset.version)
+        else:
+            text = self.translate("text_rules_reload_failed", user).format(self.rulesreloader.lastError)
+        return await self.sender.sendMessage(user.id, text=text, disable_web_page_preview=True)
+
+    async def botSendMetrics(self, update: Update, context: CallbackContext):
+        """ Admin command: Sends current metrics as text file in the Prometheus text format. """
+        user = update.effective_user
+        if not self.isAdmin(user):
+            return None
+        if self.metrics is None:
+            return await self.sender.sendMessage(user.id, text=self.translate("text_metrics_disabled", user))
+        return await self.sender.sendDocument(user.id, document=self.metrics.toPrometheus().encode('utf-8'), filename="metrics.txt")
+
+    async def botTrace(self, update: Update, context: CallbackContext):
+        """ Admin command: '/trace <minutes>' logs slow URLs for the given time (default: 10 minutes), '/trace off' stops that. """
+        user = update.effective_user
+        if not self.isAdmin(user):
+            return None
+        profiler = self.urlcleaner.profiler
+        if len(context.args) > 0 and context.args[0].lower() == "off":
+            profiler.traceFor(0)
+            return await self.sender.sendMessage(user.id, text=self.translate("text_tracing_disabled", user))
+        try:
+            minutes = float(context.args[0]) if len(context.args) > 0 else 10
+        except ValueError:
+            minutes = 10
+        profiler.traceFor(minutes * 60)
+        text = self.translate("text_tracing_enabled", user).format(minutes=minutes, path=profiler.slowurllogpath)
+        return await self.sender.sendMessage(user.id, text=text)
 
     async def botCleanURLs(self, update: Update, context: CallbackContext):
-        userInput = update.message.text
+        message = update.effective_message
+        if message.text is not None:
+            userInput = message.text
+            entities = message.entities
+        else:
+            # Media with caption
+            userInput = message.caption
+            entities = message.caption_entities
+        # Use the links Telegram already found, search for them ourselves only if Telegram did not find any
+        urlspans = getEntityURLs(userInput, entities) or None
         user = update.effective_user
-        cleanresult = self.urlcleaner.cleanText(text=userInput)
-        cleanedurls = cleanresult.cleanedurls
-        if len(cleanedurls) == 0:
-            return await self.application.updater.bot.send_message(chat_id=user.id, text=self.translate("text_cleaned_urls_fail", user), parse_mode="HTML",
-                                                                   disable_web_page_preview=True)
-
-        text = self.translate("text_cleaned_urls_success", user).format(numlinks=len(cleanedurls))
-
-        position = 1
-        for cleanedurl in cleanedurls:
-            newlink = cleanedurl.cleanedurl.geturl()
-            if len(cleanedurls) > 1:
-                text += f"\n<b>URL {position}</b>"
-            text += f"\nCode:\n<pre>{newlink}</pre>"
-            text += f"\n" + self.translate("text_cleaned_urls_success_snippet_clickable_link", user).format(newlink)
-            appliedRulesText = ""
-            removedParametersText = None
-            if len(cleanedurl.appliedrules) > 0:
-                index = 0
-                for rule in cleanedurl.appliedrules:
-                    appliedRulesText += rule.name
-                    if index < len(cleanedurl.appliedrules) - 1:
-                        appliedRulesText += ", "
-                    index += 1
-                if len(cleanedurl.removedparams_tracking) > 0:
-                    removedParametersText = ", ".join(cleanedurl.removedparams_tracking)
-                else:
-                    removedParametersText = self.translate("text_none", user)
-            else:
-                appliedRulesText = self.translate("text_none", user) + " -> " + self.translate("text_url_is_already_clean_questionmark", user)
-            text += "\n" + self.translate("text_cleaned_urls_success_snippet_applied_rules", user).format(appliedRulesText)
-            if removedParametersText is not None:
-                text += "\n" + self.translate("text_cleaned_urls_success_removed_parameters", user).format(removedParametersText)
-            if position < len(cleanedurls) - 1:
-                # Not the last entry -> Add separator
-                text += "\n---"
-            position += 1
-        return await self.application.updater.bot.send_message(chat_id=update.effective_user.id, text=text, parse_mode="HTML",
-                                                               disable_web_page_preview=True)
-
-    def translate(self, key, user: User):
-        lang = user.language_code
+        timestart = time.perf_counter()
+        if self.shortlinkexpander is not None:
+            if urlspans is None:
+                urlspans = [(start, end, userInput[start:end]) for start, end in findURLs(userInput)]
+            maxurls = self.cfg.cleaning_max_urls_per_message
+            if maxurls is None or len(urlspans) <= maxurls:
+                urlspans = await self.shortlinkexpander.expandURLSpans(urlspans, deadline=self.cfg.shortlinks_deadline)
+        try:
+            cleanresult = await self.cleaningbackend.cleanText(userInput, urlspans=urlspans)
+        except CleaningBackendBusyError:
+            if self.metrics is not None:
+                self.metrics.recordMessageRejected()
+            return await self.sender.sendMessage(user.id, text=self.translate("text_bot_busy", user), parse_mode="HTML", disable_web_page_preview=True)
+        cleaningtime = time.perf_counter() - timestart
+        if cleanresult.isIncomplete:
+            text = self.translate("text_too_many_links", user)
+        elif len(cleanresult.cleanedurls) == 0:
+            text = self.translate("text_cleaned_urls_fail", user)
+        else:
+            text = None
+        timestart = time.perf_counter()
+        if text is not None:
+            reply = await self.sender.sendMessage(user.id, text, parse_mode="HTML", disable_web_page_preview=True)
+        else:
+            texts = self.getReplyTemplates(user).renderCleanedURLs(cleanresult.cleanedurls)
+            reply = await self.sender.sendMessages(user.id, texts, parse_mode="HTML", disable_web_page_preview=True)
+        if self.metrics is not None:
+            self.metrics.recordMessage(numurls=len(cleanresult.cleanedurls), cleaningtime=cleaningtime, sendingtime=time.perf_counter() - timestart,
+                                       isIncomplete=cleanresult.isIncomplete)
+        return reply
+
+    async def botAutoClean(self, update: Update, context: CallbackContext):
+        """ Group/channel admins: '/autoclean on|off' enables/disables replying to messages with links with their cleaned versions. """
+        message = update.effective_message
+        chat = update.effective_chat
+        user = update.effective_user
+        if not await self.isChatAdmin(update):
+            return await self.sender.sendMessage(chat.id, text=self.translate("text_autoclean_admins_only", user), reply_to_message_id=message.message_id)
+        enabled = len(context.args) == 0 or context.args[0].lower() != "off"
+        self.chatsettings.setEnabled(chat.id, enabled)
+        if not enabled:
+            self.recenturls.pop(chat.id, None)
+        text = self.translate("text_autoclean_enabled" if enabled else "text_autoclean_disabled", user)
+        return await self.sender.sendMessage(chat.id, text=text, reply_to_message_id=message.message_id)
+
+    async def isChatAdmin(self, update: Update) -> bool:
+        chat = update.effective_chat
+        message = update.effective_message
+        # Only admins can post in channels, anonymous group admins post as the group itself
+        if chat.type == chat.CHANNEL or (message.sender_chat is not None and message.sender_chat.id == chat.id):
+            return True
+        user = update.effective_user
+        if user is None:
+            return False
+        member = await chat.get_member(user.id)
+        return member.status in (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+    async def botAutoCleanMessage(self, update: Update, context: CallbackContext):
+        """ Replies to messages in groups and channels with auto-cleaning enabled with cleaned versions of their links.
+         Most messages contain no links or only clean ones so this does as little work as possible before knowing that something needs to be cleaned:
+         Only messages containing link entities reach this handler, links already cleaned within autoclean_dedup_window seconds are ignored and
+         nothing is sent if no link was changed.
+         """
+        chat = update.effective_chat
+        if not self.chatsettings.isEnabled(chat.id):
+            return None
+        message = update.effective_message
+        if message.text is not None:
+            text = message.text
+            entities = message.entities
+        else:
+            text = message.caption
+            entities = message.caption_entities
+        recenturls = self.recenturls.get(chat.id)
+        if recenturls is None:
+            recenturls = RecentURLs(window=self.cfg.autoclean_dedup_window, maxentries=self.cfg.autoclean_dedup_max_urls)
+            self.recenturls[chat.id] = recenturls
+        urlspans = []
+        for urlspan in getEntityURLs(text, entities):
+            url = urlspan[2]
+            if not recenturls.isRecent(url) and all(url != otherurl for _, _, otherurl in urlspans):
+                urlspans.append(urlspan)
+        if len(urlspans) == 0:
+            return None
+        # Position -> URL as posted
+        postedurls = {(start, end): url for start, end, url in urlspans}
+        if self.shortlinkexpander is not None:
+            urlspans = await self.shortlinkexpander.expandURLSpans(urlspans, deadline=self.cfg.shortlinks_deadline)
+        try:
+            cleanresult = await self.cleaningbackend.cleanText(text, urlspans=urlspans)
+        except CleaningBackendBusyError:
+            # Nobody asked for an answer so it is not worth an error message
+            if self.metrics is not None:
+                self.metrics.recordMessageRejected()
+            return None
+        # Links which could not be cleaned e.g. because the bot was busy are tried again when they are posted the next time
+        for cleanedurl in cleanresult.cleanedurls:
+            recenturls.addURL(postedurls[cleanedurl.span])
+        changedurls = [cleanedurl for cleanedurl in cleanresult.cleanedurls if cleanedurl.getURL() != addMissingScheme(postedurls[cleanedurl.span])]
+        if len(changedurls) == 0:
+            return None
+        user = update.effective_user
+        templates = self.getReplyTemplates(user) if user is not None else self.replytemplates["en"]
+        return await self.sender.sendMessages(chat.id, templates.renderAutoCleanReply(changedurls), parse_mode="HTML", disable_web_page_preview=True,
+                                              disable_notification=True, reply_to_message_id=message.message_id)
+
+    async def botInlineQuery(self, update: Update, context: CallbackContext):
+        """ '@bot <text>' in any chat: Answers with the cleaned text and every single cleaned URL as results which can be sent directly.
+         Telegram sends a new query for every keystroke. Each query waits inline_debounce seconds before it gets cleaned and is cancelled as soon as a newer
+         query of the same user arrives. Cancelling drops queries which are still waiting or queued by the cleaning backend, a text which a thread or process
+         has already started to clean is cleaned completely but the result is not used.
+         The query is answered by a task of its own so waiting for further keystrokes does not block one of the concurrent_updates slots.
+         The task is created via the Application so it is finished like all other updates when the bot stops.
+         """
+        inlinequery = update.inline_query
+        user = update.effective_user
+        previoustask = self.inlinetasks.get(user.id)
+        if previoustask is not None:
+            previoustask.cancel()
+        task = self.application.create_task(self.answerInlineQuery(inlinequery.id, inlinequery.query.strip()))
+        self.inlinetasks[user.id] = task
+        task.add_done_callback(lambda finishedtask: self.onInlineQueryAnswered(user.id, finishedtask))
+
+    def onInlineQueryAnswered(self, userid: int, task: asyncio.Task):
+        # Errors are logged by the Application, cancelled = Replaced by a newer query of the same user
+        if self.inlinetasks.get(userid) is task:
+            del self.inlinetasks[userid]
+
+    async def answerInlineQuery(self, inlinequeryid: str, query: str):
+        if len(query) == 0:
+            return await self.application.updater.bot.answer_inline_query(inlinequeryid, results=[], cache_time=self.cfg.inline_cache_time)
+        cachekey = (query, self.urlcleaner.getRuleset().version)
+        results = self.inlinecache.get(cachekey)
+        if results is not None:
+            self.inlinecache.move_to_end(cachekey)
+        else:
+            await asyncio.sleep(self.cfg.inline_debounce)
+            try:
+                cleanresult = await self.cleaningbackend.cleanText(query)
+            except CleaningBackendBusyError:
+                # Telegram shows the loading indicator until the user types again
+                if self.metrics is not None:
+                    self.metrics.recordMessageRejected()
+                return None
+            results = getInlineQueryResults(cleanresult)
+            if not cleanresult.isIncomplete:
+                self.inlinecache[cachekey] = results
+                if len(self.inlinecache) > self.cfg.inline_cache_size:
+                    self.inlinecache.popitem(last=False)
+        # Results do not depend on the user so Telegram can answer identical queries of other users from its own cache
+        # Not sent via MessageSender on purpose: Answers to inline queries do not count towards the message limits and would time out if they had to wait
+        # behind queued messages
+        return await self.application.updater.bot.answer_inline_query(inlinequeryid, results=results, cache_time=self.cfg.inline_cache_time,
+                                                                      is_personal=False)
+
+    async def botCleanDocument(self, update: Update, context: CallbackContext):
+        """ Cleans all URLs inside an uploaded text document and sends it back.
+         The document is downloaded and cleaned in batches of lines so it never has to be kept in memory completely and messages of other users
+         can be cleaned in between.
+         """
+        message = update.effective_message
+        document = message.document
+        user = update.effective_user
+        maxsize = self.cfg.documents_max_size
+        if document.file_size is not None and document.file_size > maxsize:
+            return await self.sender.sendMessage(user.id, text=self.translate("text_document_too_large", user).format(
+                maxsize=formatFileSize(maxsize)))
+        if self.activedocuments.get(user.id, 0) >= self.cfg.documents_max_per_user:
+            return await self.sender.sendMessage(user.id, text=self.translate("text_document_too_many", user))
+        self.activedocuments[user.id] = self.activedocuments.get(user.id, 0) + 1
+        try:
+            documentformat = getDocumentFormat(document.file_name)
+            stats = DocumentStats()
+            with tempfile.TemporaryFile() as outfile:
+                try:
+                    file = await document.get_file()
+                    maxurls = self.cfg.documents_max_urls
+                    timebudget = self.cfg.documents_time_budget
+                    async for lines in iterLineBatches(self.iterFileChunks(file.file_path), batchsize=self.cfg.documents_batch_lines, maxsize=maxsize):
+                        if stats.isIncomplete:
+                            # Budget of this document is used up -> Send the rest back unchanged
+                            stats.lines += len(lines)
+                            outfile.write("".join(lines).encode('utf-8'))
+                            continue
+                        cleanedlines, batchstats = await self.cleaningbackend.run(cleanDocumentLines, lines, documentformat,
+                                                                                  None if maxurls is None else maxurls - stats.urls,
+                                                                                  None if timebudget is None else timebudget - stats.cputime)
+                        stats.update(batchstats)
+                        outfile.write("".join(cleanedlines).encode('utf-8'))
+                except DocumentTooLargeError:
+                    return await self.sender.sendMessage(user.id, text=self.translate("text_document_too_large", user).format(
+                        maxsize=formatFileSize(maxsize)))
+                except CleaningBackendBusyError:
+                    return await self.sender.sendMessage(user.id, text=self.translate("text_bot_busy", user))
+                except (TelegramError, httpx.HTTPError, OSError) as error:
+                    logging.warning(f"Failed to download document: {error}")
+                    return await self.sender.sendMessage(user.id, text=self.translate("text_document_failed", user))
+                outfile.seek(0)
+                return await self.sender.sendDocument(user.id, document=outfile, filename=document.file_name, caption=self.getDocumentSummaryText(stats, user))
+        finally:
+            self.activedocuments[user.id] -= 1
+            if self.activedocuments[user.id] == 0:
+                del self.activedocuments[user.id]
+
+    async def iterFileChunks(self, filepath: str) -> AsyncIterator[bytes]:
+        """ Streams a file returned by getFile. The path is a local one if the bot uses a local Bot API server. """
+        if os.path.isfile(filepath):
+            with open(filepath, 'rb') as infile:
+                while True:
+                    chunk = infile.read(DOCUMENT_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            return
+        async with httpx.AsyncClient(timeout=30) as client:
+            async with client.stream("GET", filepath) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(DOCUMENT_CHUNK_SIZE):
+                    yield chunk
+
+    def getDocumentSummaryText(self, stats: DocumentStats, user: User) -> str:
+        text = self.translate("text_document_cleaned", user).format(numurls=stats.urls, numlines=stats.lines, numcleanedurls=stats.cleanedurls)
+        if stats.isIncomplete:
+            text += "\n" + self.translate("text_document_incomplete", user).format(numurls=stats.urls)
+        if len(stats.rules) > 0:
+            rulestext = ", ".join(f"{rulename} ({count})" for rulename, count in getTopEntries(stats.rules, 10))
+            text += "\n" + self.translate("text_cleaned_urls_success_snippet_applied_rules", user).format(rulestext)
+        if len(stats.removedparams) > 0:
+            paramstext = ", ".join(f"{param} ({count})" for param, count in getTopEntries(stats.removedparams, 20))
+            text += "\n" + self.translate("text_cleaned_urls_success_removed_parameters", user).format(paramstext)
+        if len(text) > MAX_CAPTION_LENGTH:
+            text = text[:MAX_CAPTION_LENGTH - 1] + "…"
+        return text
+
+    def getReplyTemplates(self, user: User) -> ReplyTemplates:
+        return self.replytemplates.get(user.language_code) or self.replytemplates["en"]
+
+    def isAdmin(self, user: User) -> bool:
+        return user is not None and user.id in self.cfg.admin_user_ids
+
+    def translate(self, key, user: Union[User, None]):
+        # Posts in channels do not have a user
+        lang = user.language_code if user is not None else None
         return translate(key, lang)
 
+    async def onShutdown(self, application: Application):
+        for task in list(self.inlinetasks.values()):
+            task.cancel()
+        self.rulesreloader.stop()
+        if self.metricsserver is not None:
+            self.metricsserver.stop()
+        self.cleaningbackend.shutdown()
+        if self.shortlinkexpander is not None:
+            await self.shortlinkexpander.close()
+
     def startBot(self):
-        self.application.run_polling(timeout=300, read_timeout=300, write_timeout=300, connect_timeout=300)
+        """ Runs the bot until SIGINT/SIGTERM. Updates which are already being processed get finished before the bot stops.
+         In webhook mode the webhook server is stopped first so no further updates are accepted, then Application.stop waits for all updates Telegram
+         has already delivered and for tasks created via Application.create_task e.g. inline queries. onShutdown runs afterwards.
+         """
+        if self.cfg.bot_mode == "webhook":
+            if self.cfg.webhook_url is None:
+                raise ValueError("webhook_url is required if bot_mode is webhook")
+            self.application.run_webhook(listen=self.cfg.webhook_listen, port=self.cfg.webhook_port, url_path=self.cfg.webhook_url_path,
+                                         webhook_url=self.cfg.webhook_url, secret_token=self.cfg.webhook_secret_token,
+                                         max_connections=self.cfg.webhook_max_connections)
+        else:
+            self.application.run_polling(timeout=300, read_timeout=300, write_timeout=300, connect_timeout=300)
 
     def stopBot(self):
         self.application.stop()
@@ -0,0 +1,103 @@
+import argparse
+import json
+import multiprocessing
+import sys
+from collections import deque
+from itertools import islice
+from typing import List, Tuple, Iterable, Iterator, TextIO, Union
+
+from URLCleaner import URLCleaner, CleanedURL
+
+# Cleans all URLs found in a file or stdin line by line and writes one JSON object per URL (NDJSON).
+# Example: python3 URLCleanerCLI.py links.txt --workers 4 -o cleaned.ndjson
+
+# URLCleaner used inside worker processes
+workercleaner: Union[URLCleaner, None] = None
+
+
+def toJSON(linenumber: int, cleanedurl: CleanedURL) -> str:
+    return json.dumps(dict(line=linenumber, original=cleanedurl.originalurl, cleaned=cleanedurl.getURL(), appliedrules=[rule.name for rule in cleanedurl.appliedrules],
+                           removedparams=cleanedurl.removedparams_tracking, removedparams_affiliate=cleanedurl.removedparams_affiliate), ensure_ascii=False)
+
+
+def cleanLines(cleaner: URLCleaner, lines: Iterable[Tuple[int, str]]) -> List[str]:
+    """ Returns NDJSON lines for all URLs inside given (line number, line) tuples. """
+    results = []
+    for linenumber, line in lines:
+        for cleanedurl in cleaner.iterCleanURLs((line,)):
+            results.append(toJSON(linenumber, cleanedurl))
+    return results
+
+
+def initWorker(cleaner: URLCleaner):
+    """ Worker processes get the URLCleaner of the main process including its already compiled ruleset. """
+    global workercleaner
+    workercleaner = cleaner
+    # Keep messages printed by URLCleaner out of the results
+    sys.stdout = sys.stderr
+
+
+def cleanChunk(chunk: List[Tuple[int, str]]) -> List[str]:
+    return cleanLines(workercleaner, chunk)
+
+
+def readChunks(infile: TextIO, chunksize: int) -> Iterator[List[Tuple[int, str]]]:
+    lines = enumerate((line.rstrip('\r\n') for line in infile), start=1)
+    while True:
+        chunk = list(islice(lines, chunksize))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def cleanFile(cleaner: URLCleaner, infile: TextIO, outfile: TextIO, workers: int = 0, chunksize: int = 1000):
+    """ Cleans given input line by line. Memory usage does not depend on the size of the input as only a limited number of chunks is processed at the same time. """
+    if workers <= 0:
+        for chunk in readChunks(infile, chunksize):
+            for result in cleanLines(cleaner, chunk):
+                outfile.write(result + '\n')
+        return
+    # Make sure that rules are compiled only once before they get passed to the workers
+    cleaner.getRuleset()
+    maxpendingchunks = 2 * workers
+    with multiprocessing.Pool(processes=workers, initializer=initWorker, initargs=(cleaner,)) as pool:
+        pendingchunks = deque()
+        for chunk in readChunks(infile, chunksize):
+            if len(pendingchunks) >= maxpendingchunks:
+                for result in pendingchunks.popleft().get():
+                    outfile.write(result + '\n')
+            pendingchunks.append(pool.apply_async(cleanChunk, (chunk,)))
+        while len(pendingchunks) > 0:
+            for result in pendingchunks.popleft().get():
+                outfile.write(result + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Removes tracking parameters from all URLs found in a file. Writes one JSON object per URL (NDJSON).")
+    parser.add_argument("input", nargs='?', default='-', help="Input file, default: stdin")
+    parser.add_argument("-o", "--output", default='-', help="Output file, default: stdout")
+    parser.add_argument("--rules", action='append', default=[], help="Additional rules to import e.g. data.minify.json, can be used multiple times")
+    parser.add_argument("--workers", type=int, default=0, help="Number of worker processes, 0 = clean inside main process")
+    parser.add_argument("--chunksize", type=int, default=1000, help="Number of lines sent to a worker at once")
+    args = parser.parse_args()
+    if args.chunksize < 1:
+        parser.error("--chunksize must be greater than 0")
+    outfile = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8')
+    # Messages printed by URLCleaner must not end up inside the results
+    sys.stdout = sys.stderr
+    cleaner = URLCleaner()
+    for path in args.rules:
+        cleaner.importCleaningRules(path)
+    infile = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8', errors='replace')
+    try:
+        cleanFile(cleaner, infile, outfile, workers=args.workers, chunksize=args.chunksize)
+    finally:
+        if infile is not sys.stdin:
+            infile.close()
+        outfile.flush()
+        if outfile is not sys.__stdout__:
+            outfile.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+import argparse
+import asyncio
+import gzip
+import json
+import signal
+import zlib
+from collections import deque
+from http import HTTPStatus
+from typing import Dict, List, Union
+
+from CleaningBackend import CleaningBackend, CleaningBackendBusyError
+from RulesetSnapshot import loadURLCleaner
+from URLCleaner import CleanResult
+
+# HTTP service which cleans texts for other programs so they do not have to load the rules themselves.
+# Example: python3 URLCleanerService.py --port 8080 --rules data.minify.json --backend process --workers 4
+# POST /clean with {"text": "..."} -> {"cleanedtext": "...", "urls": [...], "incomplete": false}
+# POST /clean/batch with a JSON array or NDJSON of texts or {"text": "..."} objects -> One result per line (NDJSON) in the same order
+
+# Max size of the request line plus all headers
+MAX_HEADER_SIZE = 16 * 1024
+
+
+class HTTPError(Exception):
+    def __init__(self, status: HTTPStatus, message: Union[str, None] = None):
+        super().__init__(message or status.phrase)
+        self.status = status
+        self.message = message or status.phrase
+
+
+class HTTPRequest:
+    def __init__(self, method: str, path: str, version: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def isKeepAlive(self) -> bool:
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+    def supportsChunked(self) -> bool:
+        """ HTTP/1.0 clients don't know chunked transfer encoding. """
+        return self.version != "HTTP/1.0"
+
+    def acceptsGzip(self) -> bool:
+        return "gzip" in self.headers.get("accept-encoding", "").lower()
+
+
+def toDict(result: CleanResult) -> dict:
+    urls = []
+    for cleanedurl in result.cleanedurls:
+        urls.append(dict(original=cleanedurl.originalurl, cleaned=cleanedurl.getURL(), appliedrules=[rule.name for rule in cleanedurl.appliedrules],
+                         removedparams=cleanedurl.removedparams_tracking, removedparams_affiliate=cleanedurl.removedparams_affiliate, span=cleanedurl.span))
+    return dict(cleanedtext=result.cleanedtext, urls=urls, incomplete=result.isIncomplete)
+
+
+def getText(item) -> str:
+    """ Returns the text of a single input which can be a string or an object with field 'text'. """
+    if isinstance(item, dict):
+        item = item.get("text")
+    if not isinstance(item, str):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "Expected a string or an object with field 'text'")
+    return item
+
+
+def parseBatch(request: HTTPRequest) -> List[str]:
+    """ Returns all texts of a batch request which is either a JSON array or NDJSON with one input per line. """
+    try:
+        body = request.body.decode('utf-8')
+        if body.lstrip().startswith('['):
+            items = json.loads(body)
+        else:
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+    except (UnicodeDecodeError, json.JSONDecodeError) as error:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"Invalid JSON: {error}")
+    return [getText(item) for item in items]
+
+
+class URLCleanerService:
+    """ Minimal HTTP/1.1 server on top of asyncio streams so no web framework is needed.
+     Supports keep-alive, gzip compressed requests and responses and streams results of big batches while they are being cleaned.
+     """
+
+    def __init__(self, backend: CleaningBackend, maxbodysize: int = 1024 * 1024, batchchunksize: int = 100, keepalivetimeout: float = 30,
+                 enableGzip: bool = True):
+        self.backend = backend
+        self.maxbodysize = maxbodysize
+        # Number of texts of a batch request which are sent to a worker at once
+        self.batchchunksize = batchchunksize
+        self.keepalivetimeout = keepalivetimeout
+        self.enableGzip = enableGzip
+        self.server: Union[asyncio.AbstractServer, None] = None
+
+    async def start(self, host: str, port: int):
+        self.server = await asyncio.start_server(self.handleConnection, host, port, limit=MAX_HEADER_SIZE)
+
+    async def stop(self):
+        """ Stops accepting new connections. """
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handleConnection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await self.readRequest(reader)
+                except HTTPError as error:
+                    # Connection is in an unknown state -> Answer and close it
+                    await self.sendJSON(writer, error.status, dict(error=error.message), keepalive=False)
+                    break
+                if request is None:
+                    break
+                keepalive = request.isKeepAlive()
+                if request.path == "/clean/batch" and not request.supportsChunked():
+                    # Streamed response ends when the connection gets closed
+                    keepalive = False
+                try:
+                    await self.handleRequest(request, writer, keepalive)
+                except HTTPError as error:
+                    await self.sendJSON(writer, error.status, dict(error=error.message), keepalive=keepalive)
+                if not keepalive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def readRequest(self, reader: asyncio.StreamReader) -> Union[HTTPRequest, None]:
+        """ Returns None if the client closed the connection or did not send another request within the keep-alive timeout. """
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=self.keepalivetimeout)
+        except asyncio.IncompleteReadError as error:
+            if len(error.partial) == 0:
+                return None
+            raise
+        except asyncio.LimitOverrunError:
+            raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+        except asyncio.TimeoutError:
+            return None
+        lines = head.decode('latin-1').split("\r\n")
+        try:
+            method, path, version = lines[0].split(" ")
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid request line")
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if "transfer-encoding" in headers:
+            raise HTTPError(HTTPStatus.LENGTH_REQUIRED, "Chunked requests are not supported, send Content-Length")
+        try:
+            contentlength = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+        if contentlength < 0:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid Content-Length")
+        if contentlength > self.maxbodysize:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Max request size is {self.maxbodysize} bytes")
+        try:
+            body = await asyncio.wait_for(reader.readexactly(contentlength), timeout=self.keepalivetimeout)
+        except asyncio.TimeoutError:
+            raise HTTPError(HTTPStatus.REQUEST_TIMEOUT)
+        if headers.get("content-encoding", "").lower() == "gzip":
+            body = self.decompress(body)
+        return HTTPRequest(method=method, path=path.split('?')[0], version=version, headers=headers, body=body)
+
+    def decompress(self, body: bytes) -> bytes:
+        """ Unpacks gzip compressed request body, the size limit also applies to the unpacked body. """
+        decompressor = zlib.decompressobj(wbits=31)
+        try:
+            result = decompressor.decompress(body, self.maxbodysize + 1)
+        except zlib.error:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "Invalid gzip data")
+        if len(result) > self.maxbodysize:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Max request size is {self.maxbodysize} bytes")
+        return result
+
+    async def handleRequest(self, request: HTTPRequest, writer: asyncio.StreamWriter, keepalive: bool):
+        if request.path not in ("/clean", "/clean/batch"):
+            raise HTTPError(HTTPStatus.NOT_FOUND)
+        if request.method != "POST":
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED)
+        if request.path == "/clean":
+            try:
+                text = getText(json.loads(request.body.decode('utf-8')))
+            except (UnicodeDecodeError, json.JSONDecodeError) as error:
+                raise HTTPError(HTTPStatus.BAD_REQUEST, f"Invalid JSON: {error}")
+            try:
+                result = await self.backend.cleanText(text)
+            except CleaningBackendBusyError:
+                raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, "Too many requests are being processed")
+            await self.sendJSON(writer, HTTPStatus.OK, toDict(result), keepalive=keepalive, useGzip=request.acceptsGzip())
+        else:
+            await self.sendBatch(writer, parseBatch(request), keepalive=keepalive, useGzip=request.acceptsGzip(), useChunked=request.supportsChunked())
+
+    def getHeaders(self, status: HTTPStatus, contenttype: str, keepalive: bool, useGzip: bool, contentlength: Union[int, None],
+                   useChunked: bool = True) -> bytes:
+        """ contentlength: None = Length is not known in advance, the body is sent chunked or ends when the connection gets closed if useChunked is False. """
+        headers = [f"HTTP/1.1 {status.value} {status.phrase}", f"Content-Type: {contenttype}", f"Connection: {'keep-alive' if keepalive else 'close'}"]
+        if useGzip:
+            headers.append("Content-Encoding: gzip")
+            headers.append("Vary: Accept-Encoding")
+        if contentlength is None:
+            if useChunked:
+                headers.append("Transfer-Encoding: chunked")
+        else:
+            headers.append(f"Content-Length: {contentlength}")
+        return ("\r\n".join(headers) + "\r\n\r\n").encode('latin-1')
+
+    async def sendJSON(self, writer: asyncio.StreamWriter, status: HTTPStatus, data: dict, keepalive: bool, useGzip: bool = False):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        useGzip = useGzip and self.enableGzip
+        if useGzip:
+            body = gzip.compress(body, compresslevel=5)
+        writer.write(self.getHeaders(status, "application/json; charset=utf-8", keepalive, useGzip, len(body)) + body)
+        await writer.drain()
+
+    async def sendBatch(self, writer: asyncio.StreamWriter, texts: List[str], keepalive: bool, useGzip: bool, useChunked: bool = True):
+        """ Cleans texts in chunks and sends the results of each chunk as soon as it is done so the client does not have to wait for the complete batch.
+         The status code is sent before cleaning starts so texts which could not be cleaned because the service is busy get an error object instead of a result.
+         Without useChunked the results are sent as they are and the caller has to close the connection afterwards.
+         """
+        useGzip = useGzip and self.enableGzip
+        compressor = zlib.compressobj(5, zlib.DEFLATED, 31) if useGzip else None
+        writer.write(self.getHeaders(HTTPStatus.OK, "application/x-ndjson; charset=utf-8", keepalive, useGzip, None, useChunked=useChunked))
+
+        def writeData(data: bytes):
+            if useChunked:
+                writer.write(f"{len(data):x}\r\n".encode('latin-1') + data + b"\r\n")
+            else:
+                writer.write(data)
+
+        async def writeChunk(data: bytes):
+            if compressor is not None:
+                # Sync flush so the client can decode every chunk right away
+                data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                writeData(data)
+                await writer.drain()
+
+        # Keep some chunks in progress so all workers have something to do while results are being sent
+        maxpendingchunks = 2 * max(self.backend.workers, 1)
+        pendingchunks = deque()
+
+        async def sendOldestChunk():
+            start, end, task = pendingchunks.popleft()
+            try:
+                results = [toDict(result) for result in await task]
+            except CleaningBackendBusyError:
+                results = [dict(error="Too many requests are being processed")] * (end - start)
+            lines = [json.dumps(dict(index=index, **result), ensure_ascii=False) for index, result in enumerate(results, start=start)]
+            await writeChunk(("\n".join(lines) + "\n").encode('utf-8'))
+
+        try:
+            for start in range(0, len(texts), self.batchchunksize):
+                if len(pendingchunks) >= maxpendingchunks:
+                    await sendOldestChunk()
+                end = min(start + self.batchchunksize, len(texts))
+                pendingchunks.append((start, end, asyncio.create_task(self.backend.cleanTexts(texts[start:end]))))
+            while len(pendingchunks) > 0:
+                await sendOldestChunk()
+        finally:
+            # Client went away -> Do not clean the rest of the batch
+            for start, end, task in pendingchunks:
+                task.cancel()
+        if compressor is not None:
+            writeData(compressor.flush(zlib.Z_FINISH))
+        if useChunked:
+            writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+
+async def runService(args: argparse.Namespace):
+    cleaner = loadURLCleaner(importpaths=args.rules, snapshotpath=args.snapshot)
+    backend = CleaningBackend(cleaner, mode=args.backend, workers=args.workers, maxinflight=args.max_inflight, maxqueued=args.max_queued,
+                              maxurls=args.max_urls, timebudget=args.time_budget)
+    service = URLCleanerService(backend, maxbodysize=args.max_body_size, batchchunksize=args.chunksize, enableGzip=not args.no_gzip)
+    # Stop worker processes on SIGTERM too, otherwise they would keep running and block the port
+    stopevent = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopevent.set)
+    await service.start(args.host, args.port)
+    print(f"Listening on http://{args.host}:{args.port}")
+    try:
+        await stopevent.wait()
+    finally:
+        await service.stop()
+        backend.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP service which removes tracking parameters from URLs inside texts.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--rules", action='append', default=[], help="Additional rules to import e.g. data.minify.json, can be used multiple times")
+    parser.add_argument("--snapshot", default=None, help="File to store the compiled rules in for faster startup")
+    parser.add_argument("--backend", choices=["inline", "thread", "process"], default="process", help="Where texts get cleaned, see CleaningBackend")
+    parser.add_argument("--workers", type=int, default=2, help="Number of worker threads/processes")
+    parser.add_argument("--max-inflight", type=int, default=8, help="Max number of texts/batch chunks being cleaned at the same time")
+    parser.add_argument("--max-queued", type=int, default=64, help="Max number of texts/batch chunks waiting to be cleaned, further requests get status 503")
+    parser.add_argument("--max-urls", type=int, default=None, help="Do not clean texts containing more URLs than this")
+    parser.add_argument("--time-budget", type=float, default=None, help="Max CPU time in seconds used to clean a single text")
+    parser.add_argument("--max-body-size", type=int, default=1024 * 1024, help="Max size of a request in bytes")
+    parser.add_argument("--chunksize", type=int, default=100, help="Number of texts of a batch which are sent to a worker at once")
+    parser.add_argument("--no-gzip", action='store_true', help="Never compress responses")
+    args = parser.parse_args()
+    if args.chunksize < 1:
+        parser.error("--chunksize must be greater than 0")
+    asyncio.run(runService(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+import json
+import types
+
+import AutoClean
+from AutoClean import ChatSettingsStore, RecentURLs
+
+
+def test_chat_settings_are_stored_and_loaded(tmp_path):
+    path = str(tmp_path / "chatsettings.json")
+    store = ChatSettingsStore(path)
+    assert not store.isEnabled(-100)
+    store.setEnabled(-100, True)
+    store.setEnabled(-200, True)
+    store.setEnabled(-200, False)
+    # Chats without any flag are not stored
+    with open(path, encoding='utf-8') as infile:
+        assert json.load(infile) == {"-100": AutoClean.AUTOCLEAN}
+    loadedstore = ChatSettingsStore(path)
+    assert loadedstore.isEnabled(-100) and not loadedstore.isEnabled(-200)
+    assert loadedstore.flags == {-100: AutoClean.AUTOCLEAN}
+
+
+def test_unchanged_chat_settings_are_not_written(tmp_path):
+    path = tmp_path / "chatsettings.json"
+    store = ChatSettingsStore(str(path))
+    store.setEnabled(-100, False)
+    assert not path.exists()
+
+
+def test_recent_urls_expire_after_window(monkeypatch):
+    clock = types.SimpleNamespace(now=100.0)
+    monkeypatch.setattr(AutoClean, "time", types.SimpleNamespace(monotonic=lambda: clock.now))
+    recenturls = RecentURLs(window=60)
+    recenturls.addURL("https://example.com/a")
+    clock.now += 30
+    recenturls.addURL("https://example.com/b")
+    assert recenturls.isRecent("https://example.com/a") and recenturls.isRecent("https://example.com/b")
+    clock.now += 30
+    assert not recenturls.isRecent("https://example.com/a")
+    assert recenturls.isRecent("https://example.com/b")
+    # Posting a link again restarts its window
+    recenturls.addURL("https://example.com/b")
+    clock.now += 59
+    assert recenturls.isRecent("https://example.com/b")
+    assert list(recenturls.entries) == ["https://example.com/b"]
+
+
+def test_recent_urls_forget_oldest_entries_first():
+    recenturls = RecentURLs(maxentries=2)
+    for url in ("https://example.com/a", "https://example.com/b", "https://example.com/a", "https://example.com/c"):
+        recenturls.addURL(url)
+    assert not recenturls.isRecent("https://example.com/b")
+    assert recenturls.isRecent("https://example.com/a") and recenturls.isRecent("https://example.com/c")
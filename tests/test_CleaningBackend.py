@@ -0,0 +1,113 @@
+import asyncio
+import threading
+
+import pytest
+
+from CleaningBackend import CleaningBackend, CleaningBackendBusyError
+from CleaningMetrics import CleaningMetrics
+from CleaningRule import CleaningRule
+from URLCleaner import URLCleaner
+
+URL = "https://example.com/?utm_source=x&id=1"
+
+
+def createCleaner() -> URLCleaner:
+    return URLCleaner(cleaningrules=[CleaningRule(name="utm", paramsblacklist=["utm_source"])])
+
+
+def test_metrics_of_worker_processes_are_merged():
+    cleaner = createCleaner()
+    cleaner.metrics = CleaningMetrics()
+    backend = CleaningBackend(cleaner, mode="process", workers=1)
+
+    async def main():
+        await backend.cleanText(URL)
+        await backend.cleanTexts([URL, "https://example.com/clean"])
+
+    try:
+        asyncio.run(main())
+    finally:
+        backend.shutdown()
+    assert cleaner.metrics.urls == 3
+    rulemetrics = cleaner.metrics.rules["utm"]
+    assert (rulemetrics.evaluations, rulemetrics.matches, rulemetrics.time.count) == (3, 2, 3)
+
+
+def test_take_collected_metrics_starts_from_zero():
+    metrics = CleaningMetrics()
+    assert metrics.takeCollected() is None
+    metrics.recordURL([("utm", 0.001, True)])
+    metrics.recordMessage(1, 0.1, 0.1)
+    collected = metrics.takeCollected()
+    assert metrics.takeCollected() is None and metrics.messages == 1
+    othermetrics = CleaningMetrics()
+    othermetrics.recordURL([("utm", 0.002, False)])
+    othermetrics.merge(collected)
+    assert othermetrics.urls == 2 and othermetrics.messages == 0
+    assert (othermetrics.rules["utm"].evaluations, othermetrics.rules["utm"].matches, othermetrics.rules["utm"].time.sum) == (2, 1, 0.003)
+
+
+def test_texts_beyond_queue_limit_are_rejected():
+    backend = CleaningBackend(createCleaner(), mode="inline", maxinflight=1, maxqueued=1)
+
+    async def main():
+        # Occupy the only slot
+        await backend.inflight.acquire()
+        queued = asyncio.create_task(backend.cleanText(URL))
+        await asyncio.sleep(0)
+        assert backend.numqueued == 1
+        with pytest.raises(CleaningBackendBusyError):
+            await backend.cleanText(URL)
+        backend.inflight.release()
+        result = await queued
+        assert backend.numqueued == 0
+        # Free slot again
+        assert (await backend.cleanText(URL)).cleanedtext == result.cleanedtext
+        return result
+
+    assert asyncio.run(main()).cleanedtext == "https://example.com/?id=1"
+
+
+def test_cancelled_waiting_text_frees_queue_place():
+    backend = CleaningBackend(createCleaner(), mode="inline", maxinflight=1, maxqueued=1)
+
+    async def main():
+        await backend.inflight.acquire()
+        queued = asyncio.create_task(backend.cleanText(URL))
+        await asyncio.sleep(0)
+        queued.cancel()
+        await asyncio.gather(queued, return_exceptions=True)
+        assert backend.numqueued == 0
+        backend.inflight.release()
+        return await backend.cleanText(URL)
+
+    assert asyncio.run(main()).cleanedtext == "https://example.com/?id=1"
+
+
+def test_thread_backend_cleans_outside_of_event_loop():
+    cleaner = createCleaner()
+    threadnames = []
+    cleantext = cleaner.cleanText
+
+    def recordingCleanText(*args, **kwargs):
+        threadnames.append(threading.current_thread().name)
+        return cleantext(*args, **kwargs)
+
+    cleaner.cleanText = recordingCleanText
+    backend = CleaningBackend(cleaner, mode="thread", workers=2, maxurls=1)
+
+    async def main():
+        return await asyncio.gather(backend.cleanText(URL), backend.cleanText(f"{URL} {URL}"))
+
+    try:
+        results = asyncio.run(main())
+    finally:
+        backend.shutdown()
+    assert all(name.startswith("URLCleaner") for name in threadnames) and len(threadnames) == 2
+    # maxurls applies to every text
+    assert [result.isIncomplete for result in results] == [False, True]
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        CleaningBackend(createCleaner(), mode="fibers")
@@ -0,0 +1,75 @@
+import asyncio
+
+import pytest
+
+from CleaningRule import CleaningRule
+from DocumentCleaner import DocumentTooLargeError, cleanDocumentLines, findCSVURLs, iterLineBatches
+from URLCleaner import URLCleaner
+
+
+def createCleaner() -> URLCleaner:
+    return URLCleaner(cleaningrules=[CleaningRule(name="utm", paramsblacklist=["utm_source"])])
+
+
+def test_html_urls_are_unescaped_and_escaped_again():
+    lines = ['<a href="https://example.com/?a=1&amp;utm_source=x&amp;b=2">link</a>\n',
+             '<a href="https://example.com/?a=1&amp;b=2">clean</a> <img src="https://example.com/i.png?utm_source=y">\n']
+    cleanedlines, stats = cleanDocumentLines(createCleaner(), lines, "html")
+    assert cleanedlines == ['<a href="https://example.com/?a=1&amp;b=2">link</a>\n',
+                            '<a href="https://example.com/?a=1&amp;b=2">clean</a> <img src="https://example.com/i.png">\n']
+    assert (stats.lines, stats.urls, stats.cleanedurls) == (2, 3, 2)
+    assert stats.rules == {"utm": 2} and stats.removedparams == {"utm_source": 2}
+
+
+def test_unchanged_urls_are_kept_as_written():
+    # Would be changed by unescaping and escaping again
+    lines = ['<a href="https://example.com/?a=1&#38;b=2">x</a>\n', 'https://example.com/?b=1&a=2\n']
+    assert cleanDocumentLines(createCleaner(), lines, "html")[0] == lines
+    assert cleanDocumentLines(createCleaner(), lines[1:], "txt")[0] == lines[1:]
+
+
+def test_url_budget_leaves_rest_of_document_unchanged():
+    lines = ["https://example.com/1?utm_source=x https://example.com/2?utm_source=x\n", "https://example.com/3?utm_source=x\n"]
+    cleanedlines, stats = cleanDocumentLines(createCleaner(), lines, "txt", maxurls=1)
+    assert cleanedlines == ["https://example.com/1 https://example.com/2?utm_source=x\n", lines[1]]
+    assert stats.isIncomplete and stats.urls == 1 and stats.lines == 2
+    cleanedlines, stats = cleanDocumentLines(createCleaner(), lines, "txt", timebudget=-1)
+    assert cleanedlines == lines and stats.isIncomplete and stats.urls == 0
+
+
+def test_csv_urls():
+    line = 'id;https://example.com/?utm_source=x;"https://example.com/?ids=1,2&utm_source=x","say ""hi"" https://example.com/?a=1;b&utm_source=x"\n'
+    assert [line[start:end] for start, end in findCSVURLs(line)] == ["https://example.com/?utm_source=x", "https://example.com/?ids=1,2&utm_source=x",
+                                                                      "https://example.com/?a=1;b&utm_source=x"]
+    cleanedlines, stats = cleanDocumentLines(createCleaner(), [line], "csv")
+    assert cleanedlines == ['id;https://example.com/;"https://example.com/?ids=1,2","say ""hi"" https://example.com/?a=1;b"\n']
+    # Unquoted fields end at the separator
+    line = "a,https://example.com/?a=1,b\n"
+    assert [line[start:end] for start, end in findCSVURLs(line)] == ["https://example.com/?a=1"]
+
+
+async def iterChunks(data: bytes, chunksize: int):
+    for position in range(0, len(data), chunksize):
+        yield data[position:position + chunksize]
+
+
+def readLineBatches(data: bytes, chunksize: int, batchsize: int = 2, maxsize: int = 1024):
+    async def main():
+        return [batch async for batch in iterLineBatches(iterChunks(data, chunksize), batchsize=batchsize, maxsize=maxsize)]
+
+    return asyncio.run(main())
+
+
+def test_utf8_characters_split_between_chunks():
+    text = "Ä https://example.com/ö?q=€\n😀 second line\r\n\nlast line without line break 🎉"
+    for chunksize in (1, 2, 3, 5):
+        batches = readLineBatches(text.encode('utf-8'), chunksize)
+        assert "".join(line for batch in batches for line in batch) == text
+        assert [line for batch in batches for line in batch][:2] == ["Ä https://example.com/ö?q=€\n", "😀 second line\r\n"]
+    # Invalid UTF-8 gets replaced instead of failing
+    assert readLineBatches(b"a\xff\n", 1) == [["a�\n"]]
+
+
+def test_document_size_limit():
+    with pytest.raises(DocumentTooLargeError):
+        readLineBatches(b"x" * 100, chunksize=10, maxsize=50)
@@ -0,0 +1,126 @@
+import asyncio
+import io
+import types
+
+import pytest
+from telegram.error import RetryAfter
+
+import MessageSender as MessageSenderModule
+from MessageSender import MessageSender, splitMessage, MAX_MESSAGE_LENGTH
+from URLCleaner import URLCleaner
+from URLCleanerBot import ReplyTemplates
+
+
+class FakeClock:
+    """ Replaces time.monotonic and asyncio.sleep inside MessageSender so rate limits can be tested without waiting. """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+    async def sleep(self, seconds: float):
+        self.now += seconds
+        # Let other tasks run like a real sleep would
+        await asyncio.sleep(0)
+
+
+@pytest.fixture
+def clock(monkeypatch) -> FakeClock:
+    clock = FakeClock()
+    monkeypatch.setattr(MessageSenderModule, "time", types.SimpleNamespace(monotonic=clock.monotonic))
+    monkeypatch.setattr(MessageSenderModule, "asyncio", types.SimpleNamespace(sleep=clock.sleep, Lock=asyncio.Lock))
+    return clock
+
+
+class FakeBot:
+    def __init__(self, clock: FakeClock, retryafter: dict = None):
+        self.clock = clock
+        # Call number -> Seconds Telegram asks to wait instead of sending
+        self.retryafter = retryafter or {}
+        self.calls = 0
+        # (Time, chat ID, text or document content)
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        return self.handleCall(chat_id, text)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        return self.handleCall(chat_id, document.read())
+
+    def handleCall(self, chatid, content):
+        self.calls += 1
+        if self.calls in self.retryafter:
+            raise RetryAfter(self.retryafter[self.calls])
+        self.sent.append((self.clock.now - 1000, chatid, content))
+        return content
+
+
+def test_split_message_keeps_blocks_together():
+    blocks = ["a" * 40, "b" * 40, "c" * 40, "d" * 100]
+    assert splitMessage(blocks, maxlength=90) == ["a" * 40 + "\n" + "b" * 40, "c" * 40, "d" * 100]
+    assert splitMessage([]) == []
+
+
+def test_long_reply_is_split_between_urls():
+    cleaner = URLCleaner()
+    urls = [f"https://example.com/{index}?q={'x' * 200}" for index in range(60)]
+    messages = ReplyTemplates("en").renderCleanedURLs(cleaner.cleanText(" ".join(urls)).cleanedurls)
+    assert len(messages) > 1
+    assert all(len(message) <= MAX_MESSAGE_LENGTH for message in messages)
+    # Every URL with its details is inside one single message
+    for message in messages:
+        assert message.count("<pre>") == message.count("</pre>") == message.count("<b>URL ")
+    assert sum(message.count("<pre>") for message in messages) == len(urls)
+
+
+def test_chat_rate_limit(clock):
+    bot = FakeBot(clock)
+    sender = MessageSender(bot, globalrate=30, chatrate=1, chatburst=3)
+
+    async def main():
+        await asyncio.gather(*[sender.sendMessage(1, f"private {index}") for index in range(5)], sender.sendMessage(2, "other chat"))
+
+    asyncio.run(main())
+    privatetimes = [round(sendtime, 3) for sendtime, chatid, text in bot.sent if chatid == 1]
+    # Burst of 3 followed by one message per second in the original order
+    assert privatetimes == [0, 0, 0, 1, 2]
+    assert [text for sendtime, chatid, text in bot.sent if chatid == 1] == [f"private {index}" for index in range(5)]
+    # Other chats are not queued behind the first one
+    assert [chatid for sendtime, chatid, text in bot.sent] == [1, 1, 1, 2, 1, 1]
+
+
+def test_group_rate_limit(clock):
+    bot = FakeBot(clock)
+    sender = MessageSender(bot, grouprate=20 / 60, groupburst=5)
+
+    async def main():
+        await sender.sendMessages(-100, [str(index) for index in range(6)])
+
+    asyncio.run(main())
+    assert [round(sendtime, 3) for sendtime, chatid, text in bot.sent] == [0, 0, 0, 0, 0, 3]
+
+
+def test_retry_after_resends_document_from_start(clock):
+    bot = FakeBot(clock, retryafter={1: 7})
+    sender = MessageSender(bot)
+    document = io.BytesIO(b"cleaned file")
+
+    async def main():
+        return await sender.sendDocument(1, document=document)
+
+    assert asyncio.run(main()) == b"cleaned file"
+    assert bot.sent == [(7, 1, b"cleaned file")]
+
+
+def test_retry_after_gives_up_after_max_retries(clock):
+    bot = FakeBot(clock, retryafter={1: 1, 2: 1, 3: 1})
+    sender = MessageSender(bot, maxretries=2)
+
+    async def main():
+        await sender.sendMessage(1, "text")
+
+    with pytest.raises(RetryAfter):
+        asyncio.run(main())
+    assert bot.calls == 3 and bot.sent == []
@@ -0,0 +1,59 @@
+import json
+import re
+
+import pytest
+
+import RegexSafety
+from CleaningRule import CleaningRule, encodeCleaningRules
+from RegexSafety import getCatastrophicConstructs, makePatternSafe
+
+
+@pytest.mark.parametrize("pattern", [
+    r'^(a|a)*$',
+    r'(ab|ab)*c',
+    r'(a+)+$',
+    r'(\w+\s?)*$',
+    r'(ab|a.)*$',
+    r'(\d*\w*x)*y',
+])
+def test_exponential_patterns_are_detected(pattern):
+    assert len(getCatastrophicConstructs(re.compile(pattern))) > 0
+
+
+@pytest.mark.parametrize("pattern", [
+    r'[a-z]+[0-9]+[a-z0-9]+$',
+    r'.*.*=.*',
+    r'\d*\w*x',
+    r'([a-z]+\.)*',
+    r'(?:www\.|m\.)?example\.com',
+    r'(a|ab)*c',
+    r'^https?://(?:[a-z0-9-]+\.)*amazon\.[a-z.]{2,6}/',
+])
+def test_safe_and_polynomial_patterns_are_not_reported(pattern):
+    assert getCatastrophicConstructs(re.compile(pattern)) == []
+
+
+def test_unsafe_pattern_is_rejected_without_re2(monkeypatch):
+    monkeypatch.setattr(RegexSafety, "re2", None)
+    with pytest.raises(ValueError):
+        makePatternSafe(re.compile(r'^(a|a)*$'))
+    safepattern = re.compile(r'.*.*=.*')
+    assert makePatternSafe(safepattern) is safepattern
+
+
+def test_flags_are_passed_to_re2():
+    assert RegexSafety.getRE2Pattern(re.compile(r'(a+)+$')) == r'(a+)+$'
+    assert RegexSafety.getRE2Pattern(re.compile(r'(a+)+$', re.IGNORECASE | re.DOTALL)) == r'(?is)(a+)+$'
+    # Inline flags are part of pattern.flags too
+    assert RegexSafety.getRE2Pattern(re.compile(r'(?i)(a+)+$')) == r'(?i)(?i)(a+)+$'
+    with pytest.raises(ValueError):
+        RegexSafety.getRE2Pattern(re.compile(r'(a+)+ $', re.VERBOSE))
+
+
+def test_rule_with_linear_pattern_is_stored_as_string():
+    # Stands in for a pattern compiled by re2 which is not installed here
+    linearpattern = RegexSafety.LinearPattern.__new__(RegexSafety.LinearPattern)
+    linearpattern.pattern = r'^https?://(a+)+\.example/'
+    rule = CleaningRule(name="test", urlPattern=r'^https?://example\.com/', paramsblacklist=["a"]).copy(update=dict(urlPattern=linearpattern))
+    assert json.loads(json.dumps([rule], default=encodeCleaningRules))[0]["urlPattern"] == r'^https?://(a+)+\.example/'
+    assert json.loads(rule.json())["urlPattern"] == r'^https?://(a+)+\.example/'
@@ -0,0 +1,44 @@
+import re
+
+from CleaningRule import CleaningRule
+from RulesetAnalyzer import FINDING_OVERLAPPING_RULE, FINDING_SHADOWED_RULE, getPatternHostScope, isScopeContained, minimizeRuleset, replayRulesets
+
+CLEARURLS_PATTERN = r'^https?:\/\/(?:[a-z0-9-]+\.)*?techcrunch(?:\.[a-z]{2,}){1,}'
+
+
+def test_host_scope_of_urlpatterns():
+    assert getPatternHostScope(re.compile(r'^https?://(?:www\.)?github\.com/')) == ("github.com", True, True)
+    assert getPatternHostScope(re.compile(r'^https?://github\.com(?:/|$)')) == ("github.com", False, True)
+    # Can also match 'github.com.example.org' or 'github.com:secret@example.org'
+    assert not getPatternHostScope(re.compile(r'^https?://github\.com')).isExact
+    assert not getPatternHostScope(re.compile(r'^https?://github\.com:')).isExact
+    assert getPatternHostScope(re.compile(r'^https?://(?:[^/]+\.)*github\.com/')) is None
+    assert getPatternHostScope(re.compile(r'github\.com')) is None
+
+
+def test_exact_urlpattern_is_contained_in_domain_rule():
+    builtin = CleaningRule(name="techcrunch.com", domainwhitelist=["techcrunch.com"], domainwhitelistIgnoreSubdomains=True, removeAllParameters=True)
+    imported = CleaningRule(name="imported", urlPattern=r'^https?:\/\/(?:[a-z0-9-]+\.)*?techcrunch\.com\/', paramsblacklist=["ncid"])
+    assert isScopeContained(imported, builtin)
+    newrules, findings, _ = minimizeRuleset([builtin, imported])
+    assert [rule.name for rule in newrules] == ["techcrunch.com"]
+    assert [finding.kind for finding in findings] == [FINDING_SHADOWED_RULE]
+
+
+def test_clearurls_rule_overlapping_builtin_rule_is_reported():
+    builtin = CleaningRule(name="techcrunch.com", domainwhitelist=["techcrunch.com"], domainwhitelistIgnoreSubdomains=True, removeAllParameters=True)
+    imported = CleaningRule(name="techcrunch", urlPattern=CLEARURLS_PATTERN, paramsblacklist=["ncid"])
+    assert not isScopeContained(imported, builtin)
+    newrules, findings, _ = minimizeRuleset([builtin, imported])
+    # Also matches e.g. techcrunch.de so it must be kept
+    assert len(newrules) == 2
+    assert [(finding.kind, finding.isFixable) for finding in findings] == [(FINDING_OVERLAPPING_RULE, False)]
+
+
+def test_replay_compares_applied_rule_names():
+    rules = [CleaningRule(name="a", paramsblacklist=["a"], stopAfterThisRule=False), CleaningRule(name="b", paramsblacklist=["b"], stopAfterThisRule=False)]
+    newrules, _, renamedrules = minimizeRuleset(rules)
+    assert renamedrules == {"a": "a + b", "b": "a + b"}
+    urls = ["https://example.com/?a=1&b=2&c=3", "https://example.com/?b=2"]
+    assert len(replayRulesets(rules, newrules, urls)) > 0
+    assert replayRulesets(rules, newrules, urls, renamedrules) == []
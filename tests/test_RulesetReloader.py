@@ -0,0 +1,63 @@
+import json
+import os
+
+from RulesetReloader import RulesetReloader
+from URLCleaner import URLCleaner
+
+URL = "https://example.com/?mytracker=1&id=2&u=https%3A%2F%2Fexample.org%2F"
+
+
+def writeRules(path, rules, mtime: float):
+    with open(path, 'w', encoding='utf-8') as outfile:
+        if isinstance(rules, str):
+            outfile.write(rules)
+        else:
+            json.dump(rules, outfile)
+    # Modification times of quick writes may be the same
+    os.utime(path, (mtime, mtime))
+
+
+def createReloader(tmp_path):
+    rulespath = tmp_path / "rules.json"
+    writeRules(rulespath, [dict(name="custom", paramsblacklist=["mytracker"])], 1000)
+    cleaner = URLCleaner()
+    cleaner.importCleaningRules(str(rulespath))
+    reloadedrulesets = []
+    reloader = RulesetReloader(cleaner, importpaths=[str(rulespath)], snapshotpath=str(tmp_path / "rules.snapshot"), onReload=reloadedrulesets.append)
+    return reloader, rulespath, reloadedrulesets
+
+
+def test_changed_rules_are_swapped_in(tmp_path):
+    reloader, rulespath, reloadedrulesets = createReloader(tmp_path)
+    cleaner = reloader.urlcleaner
+    oldruleset = cleaner.getRuleset()
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/?id=2&u=https%3A%2F%2Fexample.org%2F"
+    assert not reloader.reloadIfModified()
+    writeRules(rulespath, [dict(name="custom", paramsblacklist=["id"])], 2000)
+    assert reloader.reloadIfModified()
+    newruleset = cleaner.getRuleset()
+    assert newruleset is not oldruleset and newruleset.version != oldruleset.version
+    assert reloadedrulesets == [newruleset]
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/?mytracker=1&u=https%3A%2F%2Fexample.org%2F"
+    assert (tmp_path / "rules.snapshot").exists() and reloader.lastError is None
+    # Nothing changed since the last reload
+    assert not reloader.reloadIfModified()
+
+
+def test_old_rules_stay_active_if_new_ones_are_invalid(tmp_path):
+    reloader, rulespath, reloadedrulesets = createReloader(tmp_path)
+    cleaner = reloader.urlcleaner
+    oldruleset = cleaner.getRuleset()
+    writeRules(rulespath, "[{broken json", 2000)
+    assert not reloader.reload()
+    assert reloader.lastError.startswith("Failed to build ruleset")
+    # Builds fine but a testurl results in an invalid URL
+    writeRules(rulespath, [dict(name="redirect", redirectparameterlist=["u"], testurls=["https://example.com/?u=x"])], 3000)
+    assert not reloader.reloadIfModified()
+    assert "redirect: Cleaning testurl https://example.com/?u=x resulted in invalid URL x" in reloader.lastError
+    assert cleaner.getRuleset() is oldruleset and reloadedrulesets == []
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/?id=2&u=https%3A%2F%2Fexample.org%2F"
+    # Fixed rules get swapped in
+    writeRules(rulespath, [dict(name="redirect", redirectparameterlist=["u"], testurls=["https://example.com/?u=https%3A%2F%2Fexample.org%2F"])], 4000)
+    assert reloader.reloadIfModified() and reloader.lastError is None
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.org/"
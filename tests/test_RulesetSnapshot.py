@@ -0,0 +1,67 @@
+import json
+import pickle
+
+import RulesetSnapshot
+from RulesetSnapshot import getSourceChecksum, loadURLCleaner
+
+URL = "https://example.com/?mytracker=1&id=2"
+
+
+def writeRules(path, paramsblacklist):
+    with open(path, 'w', encoding='utf-8') as outfile:
+        json.dump([dict(name="custom", paramsblacklist=paramsblacklist)], outfile)
+
+
+def loadCleaner(rulespath, snapshotpath, capsys):
+    """ Returns URLCleaner and True if it was loaded from the snapshot. """
+    cleaner = loadURLCleaner(importpaths=[str(rulespath)], snapshotpath=str(snapshotpath))
+    return cleaner, "from snapshot" in capsys.readouterr().out
+
+
+def test_snapshot_is_used_until_rules_change(tmp_path, capsys):
+    rulespath = tmp_path / "rules.json"
+    snapshotpath = tmp_path / "rules.snapshot"
+    writeRules(rulespath, ["mytracker"])
+    cleaner, fromsnapshot = loadCleaner(rulespath, snapshotpath, capsys)
+    assert not fromsnapshot and snapshotpath.exists()
+    cleaner, fromsnapshot = loadCleaner(rulespath, snapshotpath, capsys)
+    assert fromsnapshot
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/?id=2"
+    writeRules(rulespath, ["id"])
+    cleaner, fromsnapshot = loadCleaner(rulespath, snapshotpath, capsys)
+    assert not fromsnapshot
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/?mytracker=1"
+    # Snapshot was re-built from the changed rules
+    cleaner, fromsnapshot = loadCleaner(rulespath, snapshotpath, capsys)
+    assert fromsnapshot
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/?mytracker=1"
+
+
+def test_checksum_covers_rule_files_and_format(tmp_path, monkeypatch):
+    rulespath = tmp_path / "rules.json"
+    writeRules(rulespath, ["mytracker"])
+    checksum = getSourceChecksum([str(rulespath)])
+    assert getSourceChecksum([str(rulespath)]) == checksum
+    assert getSourceChecksum([]) != checksum
+    monkeypatch.setattr(RulesetSnapshot, "SNAPSHOT_FORMAT_VERSION", RulesetSnapshot.SNAPSHOT_FORMAT_VERSION + 1)
+    assert getSourceChecksum([str(rulespath)]) != checksum
+
+
+def test_invalid_snapshots_are_rebuilt(tmp_path, capsys):
+    rulespath = tmp_path / "rules.json"
+    snapshotpath = tmp_path / "rules.snapshot"
+    writeRules(rulespath, ["mytracker"])
+    snapshotpath.write_bytes(b"no pickle")
+    cleaner, fromsnapshot = loadCleaner(rulespath, snapshotpath, capsys)
+    assert not fromsnapshot
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/?id=2"
+    # Snapshot of an older format with the right checksum
+    with open(snapshotpath, 'rb') as infile:
+        snapshot = pickle.load(infile)
+    snapshot["format"] -= 1
+    with open(snapshotpath, 'wb') as outfile:
+        pickle.dump(snapshot, outfile)
+    cleaner, fromsnapshot = loadCleaner(rulespath, snapshotpath, capsys)
+    assert not fromsnapshot
+    cleaner, fromsnapshot = loadCleaner(rulespath, snapshotpath, capsys)
+    assert fromsnapshot
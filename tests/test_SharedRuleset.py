@@ -0,0 +1,100 @@
+import asyncio
+import pickle
+import re
+from multiprocessing import shared_memory
+
+from CleaningBackend import CleaningBackend
+from CleaningRule import CleaningRule
+from CompiledRuleset import CompiledRuleset
+from SharedRuleset import LazyPattern, SharedRulesetPublisher, loadSharedRuleset
+from URLCleaner import URLCleaner
+
+
+def isCompiled(pattern: LazyPattern) -> bool:
+    # Plain attribute access would compile the pattern
+    try:
+        object.__getattribute__(pattern, "search")
+        return True
+    except AttributeError:
+        return False
+
+
+def test_worker_ruleset_compiles_patterns_on_first_use():
+    ruleset = CompiledRuleset([CleaningRule(name="amazon", urlPattern=r"https?://(www\.)?amazon\.de/.*", paramsblacklist=["tag"]),
+                               CleaningRule(name="ebay", urlPattern=r"https?://(www\.)?ebay\.de/.*", paramsblacklist=["hash"])])
+    publisher = SharedRulesetPublisher()
+    try:
+        loadedruleset = loadSharedRuleset(publisher.publish(ruleset))
+    finally:
+        publisher.close()
+    amazonpattern = loadedruleset.runtimerules[0].urlPattern
+    ebaypattern = loadedruleset.runtimerules[1].urlPattern
+    assert isinstance(amazonpattern, LazyPattern) and not isCompiled(amazonpattern)
+    # Rule and index refer to the same pattern object so it is compiled once
+    assert amazonpattern is loadedruleset.rules[0].urlPattern
+    cleaner = URLCleaner()
+    cleaner.setRuleset(loadedruleset)
+    assert cleaner.cleanText("https://www.amazon.de/dp/1?tag=x&id=2").cleanedtext == "https://www.amazon.de/dp/1?id=2"
+    assert isCompiled(amazonpattern)
+    # Index only searches patterns whose literal is part of the URL
+    assert not isCompiled(ebaypattern)
+
+
+def test_lazy_pattern_is_pickled_as_compiled_pattern():
+    pattern = LazyPattern(r"utm_.*", re.IGNORECASE)
+    assert pattern.search("UTM_source") is not None
+    assert pickle.loads(pickle.dumps(pattern)) == re.compile(r"utm_.*", re.IGNORECASE)
+
+
+def segmentExists(name: str) -> bool:
+    try:
+        shared_memory.SharedMemory(name=name).close()
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def test_segment_is_kept_until_last_task_released_it():
+    publisher = SharedRulesetPublisher()
+    try:
+        firstname = publisher.publish(CompiledRuleset([]))
+        assert publisher.acquire() == firstname
+        assert publisher.acquire() == firstname
+        secondname = publisher.publish(CompiledRuleset([CleaningRule(name="utm", paramsblacklist=["utm_source"])]))
+        # Quick reload while tasks are still queued
+        thirdname = publisher.publish(CompiledRuleset([]))
+        assert publisher.acquire() == thirdname
+        # Never used by any task
+        assert not segmentExists(secondname)
+        publisher.release(firstname)
+        assert segmentExists(firstname) and len(loadSharedRuleset(firstname).rules) == 0
+        publisher.release(firstname)
+        assert not segmentExists(firstname)
+        # Current segment stays
+        publisher.release(thirdname)
+        assert segmentExists(thirdname)
+    finally:
+        publisher.close()
+    assert not segmentExists(thirdname)
+    # Task finishing after shutdown
+    publisher.release(thirdname)
+
+
+def test_queued_process_tasks_survive_reloads():
+    cleaner = URLCleaner(cleaningrules=[CleaningRule(name="utm", paramsblacklist=["utm_source"])])
+    backend = CleaningBackend(cleaner, mode="process", workers=1)
+
+    async def main():
+        tasks = [asyncio.create_task(backend.cleanText(f"https://example.com/?utm_source={index}")) for index in range(20)]
+        await asyncio.sleep(0)
+        for _ in range(3):
+            backend.onRulesetChanged()
+        return await asyncio.gather(*tasks)
+
+    try:
+        results = asyncio.run(main())
+        assert [result.cleanedtext for result in results] == ["https://example.com/"] * 20
+        # Only the current segment is left
+        assert list(backend.sharedrulesets.references.values()) == [0]
+    finally:
+        backend.shutdown()
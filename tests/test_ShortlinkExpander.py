@@ -0,0 +1,87 @@
+import asyncio
+
+import httpx
+
+from ShortlinkExpander import ShortlinkCache, ShortlinkExpander
+
+SHORTENER_HOSTS = ["bit.ly", "t.co", "tinyurl.com"]
+
+
+def createExpander(handler, cache=None, maxhops: int = 5) -> ShortlinkExpander:
+    return ShortlinkExpander(shortenerhosts=SHORTENER_HOSTS, maxhops=maxhops, cache=cache, transport=httpx.MockTransport(handler))
+
+
+def expandURLs(expander: ShortlinkExpander, urls):
+    async def main():
+        try:
+            return await expander.expandURLs(urls, deadline=5)
+        finally:
+            await expander.close()
+
+    return asyncio.run(main())
+
+
+def test_redirect_chain_is_followed_until_target():
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append((request.method, str(request.url)))
+        if request.url.host == "t.co":
+            return httpx.Response(301, headers={"Location": "https://bit.ly/abc"})
+        if request.url.host == "bit.ly":
+            return httpx.Response(302, headers={"Location": "https://example.com/article?utm_source=twitter"})
+        raise AssertionError("Target website must never be requested")
+
+    expander = createExpander(handler)
+    assert expandURLs(expander, ["t.co/xyz", "https://example.com/"]) == ["https://example.com/article?utm_source=twitter", "https://example.com/"]
+    assert requests == [("HEAD", "https://t.co/xyz"), ("HEAD", "https://bit.ly/abc")]
+
+
+def test_hop_limit():
+    def handler(request: httpx.Request) -> httpx.Response:
+        # Shorteners redirecting to each other forever
+        nexthost = "bit.ly" if request.url.host == "t.co" else "t.co"
+        return httpx.Response(301, headers={"Location": f"https://{nexthost}/loop"})
+
+    expander = createExpander(handler, maxhops=3)
+    assert expandURLs(expander, ["https://t.co/loop"]) == ["https://t.co/loop"]
+
+
+def test_get_is_used_if_head_is_not_supported():
+    methods = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        methods.append(request.method)
+        if request.method == "HEAD":
+            return httpx.Response(405)
+        return httpx.Response(301, headers={"Location": "https://example.com/page"})
+
+    expander = createExpander(handler)
+    assert expandURLs(expander, ["https://tinyurl.com/abc"]) == ["https://example.com/page"]
+    assert methods == ["HEAD", "GET"]
+
+
+def test_failed_expansion_is_cached(tmp_path):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(str(request.url))
+        return httpx.Response(404)
+
+    cache = ShortlinkCache(str(tmp_path / "shortlinks.sqlite"), negativettl=3600)
+    assert expandURLs(createExpander(handler, cache=cache), ["https://bit.ly/gone"]) == ["https://bit.ly/gone"]
+    cache = ShortlinkCache(str(tmp_path / "shortlinks.sqlite"), negativettl=3600)
+    assert cache.get("https://bit.ly/gone") == (True, None)
+    assert expandURLs(createExpander(handler, cache=cache), ["https://bit.ly/gone"]) == ["https://bit.ly/gone"]
+    assert requests == ["https://bit.ly/gone"]
+
+
+def test_invalid_url_is_cached_as_failure(tmp_path):
+    def handler(request: httpx.Request) -> httpx.Response:
+        # httpx.InvalidURL is no httpx.HTTPError
+        raise httpx.InvalidURL("Invalid authority")
+
+    cache = ShortlinkCache(str(tmp_path / "shortlinks.sqlite"))
+    assert expandURLs(createExpander(handler, cache=cache), ["https://t.co/abc"]) == ["https://t.co/abc"]
+    cache = ShortlinkCache(str(tmp_path / "shortlinks.sqlite"))
+    assert cache.get("https://t.co/abc") == (True, None)
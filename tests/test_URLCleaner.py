@@ -0,0 +1,101 @@
+from CleaningRule import CleaningRule
+from URLCleaner import URLCleaner, findURLs
+
+URL = "https://example.com/page?utm_source=x&fbclid=y&id=1"
+
+
+def createCleaner() -> URLCleaner:
+    cleaner = URLCleaner(cleaningrules=[CleaningRule(name="utm", paramsblacklist=["utm_source"], stopAfterThisRule=False),
+                                        CleaningRule(name="fbclid", paramsblacklist=["fbclid"], stopAfterThisRule=False)])
+    cleaner.enableCache()
+    return cleaner
+
+
+def test_result_cut_short_by_time_budget_is_not_cached():
+    cleaner = createCleaner()
+    cleaner.guardRegexes = True
+    cleaner.regexURLBudget = -1
+    assert cleaner.cleanText(URL).cleanedtext == URL
+    cleaner.regexURLBudget = 10
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/page?id=1"
+
+
+def test_huge_url_is_not_cached():
+    cleaner = createCleaner()
+    cleaner.guardRegexes = True
+    cleaner.maxURLLength = 10
+    assert cleaner.cleanText(URL).cleanedtext == URL
+    cleaner.maxURLLength = 4096
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/page?id=1"
+
+
+def test_ruleset_is_rebuilt_after_rules_were_replaced():
+    cleaner = createCleaner()
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/page?id=1"
+    # Same number of rules as before
+    cleaner.cleaningrules = [CleaningRule(name="utm", paramsblacklist=["utm_source"], stopAfterThisRule=False),
+                             CleaningRule(name="id", paramsblacklist=["id"], stopAfterThisRule=False)]
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/page?fbclid=y"
+    cleaner.cleaningrules[1] = CleaningRule(name="fbclid", paramsblacklist=["fbclid"], stopAfterThisRule=False)
+    cleaner.invalidateRuleset()
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/page?id=1"
+
+
+def test_slow_rule_is_quarantined_after_repeated_overruns_until_reload():
+    cleaner = createCleaner()
+    cleaner.disableCache()
+    cleaner.guardRegexes = True
+    # Every rule is too slow
+    cleaner.regexRuleBudget = -1
+    for _ in range(cleaner.regexMaxOverruns - 1):
+        cleaner.cleanText(URL)
+        assert len(cleaner.quarantinedrules) == 0
+    cleaner.cleanText(URL)
+    assert set(cleaner.quarantinedrules) == {"utm", "fbclid"}
+    assert len(cleaner.getRuleset().rules) == 0
+    cleaner.clearSlowRuleQuarantines()
+    assert cleaner.quarantinedrules == {}
+
+
+def test_stopped_url_is_logged_redacted(capsys):
+    cleaner = createCleaner()
+    cleaner.guardRegexes = True
+    cleaner.regexURLBudget = -1
+    cleaner.cleanText("https://example.com/secret?utm_source=user123")
+    output = capsys.readouterr().out
+    assert "example.com" in output
+    assert "secret" not in output and "user123" not in output
+
+
+def test_ruleset_is_rebuilt_after_rule_list_was_modified_in_place():
+    cleaner = createCleaner()
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/page?id=1"
+    cleaner.cleaningrules.append(CleaningRule(name="id", paramsblacklist=["id"], stopAfterThisRule=False))
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/page"
+    del cleaner.cleaningrules[2]
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/page?id=1"
+    cleaner.cleaningrules[1] = CleaningRule(name="id", paramsblacklist=["id"], stopAfterThisRule=False)
+    assert cleaner.cleanText(URL).cleanedtext == "https://example.com/page?fbclid=y"
+    cleaner.cleaningrules.clear()
+    assert cleaner.cleanText(URL).cleanedtext == URL
+
+
+def getFoundURLs(text: str):
+    return [text[start:end] for start, end in findURLs(text)]
+
+
+def test_find_urls_trims_trailing_punctuation():
+    assert getFoundURLs("See https://example.com/test.") == ["https://example.com/test"]
+    assert getFoundURLs("https://example.com/a?b=1, https://example.com/c!") == ["https://example.com/a?b=1", "https://example.com/c"]
+    assert getFoundURLs("«https://example.com/x» \"https://example.com/y\"") == ["https://example.com/x", "https://example.com/y"]
+
+
+def test_find_urls_only_trims_unbalanced_brackets():
+    assert getFoundURLs("https://de.wikipedia.org/wiki/Foo_(Bar) and (https://example.com/a)") == ["https://de.wikipedia.org/wiki/Foo_(Bar)",
+                                                                                                   "https://example.com/a"]
+    assert getFoundURLs("x https://example.com/)). <https://example.com/b>") == ["https://example.com/", "https://example.com/b"]
+
+
+def test_cleaned_text_keeps_trimmed_characters():
+    cleaner = createCleaner()
+    assert cleaner.cleanText(f"({URL}).").cleanedtext == "(https://example.com/page?id=1)."
@@ -0,0 +1,307 @@
+import asyncio
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import types
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+
+import pytest
+from telegram import MessageEntity
+from telegram.ext import Application, MessageHandler, filters
+from telegram.request import BaseRequest
+
+from AutoClean import ChatSettingsStore
+from CleaningBackend import CleaningBackend
+from CleaningRule import CleaningRule
+from URLCleaner import URLCleaner
+from URLCleanerBot import URLCleanerBot, ReplyTemplates, getEntityURLs, MAX_REPLY_BLOCK_LENGTH
+
+
+def getUTF16Length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def createEntity(text: str, linktext: str, entitytype: str = MessageEntity.URL, url: str = None) -> MessageEntity:
+    """ Returns entity for the first occurrence of given linktext with offsets counted in UTF-16 code units like Telegram does. """
+    start = text.index(linktext)
+    return MessageEntity(type=entitytype, offset=getUTF16Length(text[:start]), length=getUTF16Length(linktext), url=url)
+
+
+def test_entity_offsets_without_emoji():
+    text = "see https://example.com/a and amazon.de/dp/1"
+    entities = [createEntity(text, "amazon.de/dp/1"), createEntity(text, "https://example.com/a")]
+    assert getEntityURLs(text, entities) == [(4, 25, "https://example.com/a"), (30, 44, "amazon.de/dp/1")]
+
+
+def test_entity_offsets_with_emoji_before_and_between_links():
+    text = "😀 https://example.com/a 👍🏽 x https://example.com/b 🎉"
+    entities = [createEntity(text, "https://example.com/a"), createEntity(text, "https://example.com/b")]
+    urlspans = getEntityURLs(text, entities)
+    assert [text[start:end] for start, end, url in urlspans] == ["https://example.com/a", "https://example.com/b"]
+    assert [url for start, end, url in urlspans] == ["https://example.com/a", "https://example.com/b"]
+
+
+def test_text_link_returns_hidden_url():
+    text = "🔥 click here and https://example.com/b"
+    entities = [createEntity(text, "click here", MessageEntity.TEXT_LINK, url="https://example.com/hidden?utm_source=x"),
+                createEntity(text, "https://example.com/b"), MessageEntity(type=MessageEntity.BOLD, offset=0, length=2)]
+    urlspans = getEntityURLs(text, entities)
+    assert urlspans[0] == (2, 12, "https://example.com/hidden?utm_source=x")
+    assert text[urlspans[1][0]:urlspans[1][1]] == "https://example.com/b"
+
+
+def test_only_changed_links_are_replaced_inside_text():
+    cleaner = URLCleaner(cleaningrules=[CleaningRule(name="utm", paramsblacklist=["utm_source"])])
+    text = "💡 amazon.de/dp/1 and example.com/a?utm_source=x and click"
+    entities = [createEntity(text, "amazon.de/dp/1"), createEntity(text, "example.com/a?utm_source=x"),
+                createEntity(text, "click", MessageEntity.TEXT_LINK, url="https://example.com/hidden?utm_source=y")]
+    cleanresult = cleaner.cleanText(text, urlspans=getEntityURLs(text, entities))
+    assert cleanresult.cleanedtext == "💡 amazon.de/dp/1 and https://example.com/a and click"
+    assert [cleanedurl.getURL() for cleanedurl in cleanresult.cleanedurls] == ["https://amazon.de/dp/1", "https://example.com/a",
+                                                                               "https://example.com/hidden"]
+
+
+class FakeInlineBot:
+    def __init__(self):
+        # (Inline query ID, Texts of results)
+        self.answers = []
+
+    async def answer_inline_query(self, inlinequeryid, results, cache_time=None, is_personal=None):
+        self.answers.append((inlinequeryid, [result.input_message_content.message_text for result in results]))
+
+
+class CountingURLCleaner(URLCleaner):
+    def __init__(self):
+        super().__init__(cleaningrules=[CleaningRule(name="utm", paramsblacklist=["utm_source"])])
+        self.cleanedtexts = []
+
+    def cleanText(self, text, *args, **kwargs):
+        self.cleanedtexts.append(text)
+        return super().cleanText(text, *args, **kwargs)
+
+
+def createInlineBot(mode: str = "inline") -> URLCleanerBot:
+    """ Returns bot with only the parts needed to answer inline queries, nothing is sent to Telegram. """
+    bot = object.__new__(URLCleanerBot)
+    bot.cfg = types.SimpleNamespace(inline_debounce=0.05, inline_cache_time=300, inline_cache_size=10)
+    bot.application = types.SimpleNamespace(updater=types.SimpleNamespace(bot=FakeInlineBot()), create_task=asyncio.create_task)
+    bot.urlcleaner = CountingURLCleaner()
+    bot.metrics = None
+    bot.cleaningbackend = CleaningBackend(bot.urlcleaner, mode=mode, workers=1)
+    bot.inlinetasks = {}
+    bot.inlinecache = OrderedDict()
+    return bot
+
+
+def createInlineUpdate(inlinequeryid: str, query: str, userid: int = 1):
+    return types.SimpleNamespace(inline_query=types.SimpleNamespace(id=inlinequeryid, query=query), effective_user=types.SimpleNamespace(id=userid))
+
+
+async def waitForInlineTasks(bot: URLCleanerBot):
+    while len(bot.inlinetasks) > 0:
+        await asyncio.sleep(0.01)
+
+
+def test_inline_query_is_debounced():
+    bot = createInlineBot()
+    url = "https://example.com/?utm_source=x"
+
+    async def main():
+        # Keystrokes faster than the debounce time
+        for length in range(len(url) - 5, len(url) + 1):
+            await bot.botInlineQuery(createInlineUpdate(str(length), url[:length]), None)
+            await asyncio.sleep(0.01)
+        await waitForInlineTasks(bot)
+
+    asyncio.run(main())
+    assert bot.urlcleaner.cleanedtexts == [url]
+    assert bot.application.updater.bot.answers == [(str(len(url)), ["https://example.com/"])]
+
+
+def test_inline_query_queued_in_thread_is_cancelled_before_cleaning():
+    bot = createInlineBot(mode="thread")
+    release = threading.Event()
+
+    async def main():
+        # Occupy the only thread so the query has to wait inside the executor queue
+        blocking = asyncio.get_running_loop().run_in_executor(bot.cleaningbackend.executor, release.wait)
+        await bot.botInlineQuery(createInlineUpdate("1", "https://example.com/a?utm_source=x"), None)
+        await asyncio.sleep(0.1)
+        await bot.botInlineQuery(createInlineUpdate("2", "https://example.com/b?utm_source=x"), None)
+        # Let the event loop pass the cancellation on to the executor
+        await asyncio.sleep(0.01)
+        release.set()
+        await blocking
+        await waitForInlineTasks(bot)
+
+    try:
+        asyncio.run(main())
+    finally:
+        bot.cleaningbackend.shutdown()
+    assert bot.urlcleaner.cleanedtexts == ["https://example.com/b?utm_source=x"]
+    assert [answer[0] for answer in bot.application.updater.bot.answers] == ["2"]
+
+
+def test_inline_answers_are_cached_for_all_users():
+    bot = createInlineBot()
+    query = "look https://example.com/?utm_source=x"
+
+    async def main():
+        await bot.botInlineQuery(createInlineUpdate("1", query, userid=1), None)
+        await waitForInlineTasks(bot)
+        await bot.botInlineQuery(createInlineUpdate("2", query, userid=2), None)
+        # Cached answers do not wait for the debounce time
+        await asyncio.sleep(0)
+        assert len(bot.application.updater.bot.answers) == 2
+        await waitForInlineTasks(bot)
+        # New ruleset version = New cache key
+        bot.urlcleaner.cleaningrules = [CleaningRule(name="utm", paramsblacklist=["utm_source"])]
+        await bot.botInlineQuery(createInlineUpdate("3", query, userid=1), None)
+        await waitForInlineTasks(bot)
+
+    asyncio.run(main())
+    assert bot.urlcleaner.cleanedtexts == [query, query]
+    answers = bot.application.updater.bot.answers
+    assert [answer[0] for answer in answers] == ["1", "2", "3"]
+    assert answers[0][1] == answers[1][1] == answers[2][1]
+
+
+class FakeBotAPIRequest(BaseRequest):
+    """ Answers Bot API calls locally so the Application can be started without a bot token. """
+
+    def __init__(self):
+        self.methods = []
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None):
+        apimethod = url.rsplit("/", 1)[-1]
+        self.methods.append(apimethod)
+        if apimethod == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Test", "username": "testbot"}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def getFreePort() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def postUpdate(port: int, update: dict, secrettoken: str) -> int:
+    request = urllib.request.Request(f"http://127.0.0.1:{port}/webhook", data=json.dumps(update).encode(),
+                                     headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secrettoken})
+    try:
+        with urllib.request.urlopen(request, timeout=5) as response:
+            return response.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+
+def test_webhook_finishes_updates_in_progress_on_sigterm():
+    # Webhook server of python-telegram-bot[webhooks]
+    pytest.importorskip("tornado")
+    port = getFreePort()
+    bot = object.__new__(URLCleanerBot)
+    bot.cfg = types.SimpleNamespace(bot_mode="webhook", webhook_listen="127.0.0.1", webhook_port=port, webhook_url_path="webhook",
+                                    webhook_url="https://example.com/webhook", webhook_secret_token="s3cret", webhook_max_connections=40)
+    request = FakeBotAPIRequest()
+    bot.application = Application.builder().token("123:TEST").request(request).concurrent_updates(True).build()
+    started = threading.Event()
+    handledtexts = []
+
+    async def slowHandler(update, context):
+        started.set()
+        await asyncio.sleep(0.5)
+        handledtexts.append(update.effective_message.text)
+
+    bot.application.add_handler(MessageHandler(filters.TEXT, slowHandler))
+    statuses = []
+
+    def sendUpdatesAndStop():
+        update = {"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 1, "type": "private"}, "text": "hello"}}
+        for _ in range(100):
+            try:
+                statuses.append(postUpdate(port, update, "wrong"))
+                break
+            except urllib.error.URLError:
+                # Server not started yet
+                time.sleep(0.05)
+        statuses.append(postUpdate(port, update, "s3cret"))
+        if started.wait(5):
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    sender = threading.Thread(target=sendUpdatesAndStop, daemon=True)
+    sender.start()
+    # run_webhook uses and closes the current event loop
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    bot.startBot()
+    sender.join()
+    assert "setWebhook" in request.methods
+    assert statuses == [403, 200]
+    assert handledtexts == ["hello"]
+
+
+class FakeSender:
+    def __init__(self):
+        # (Chat ID, Texts)
+        self.sent = []
+
+    async def sendMessages(self, chatid, texts, **kwargs):
+        self.sent.append((chatid, texts))
+
+
+def createAutoCleanBot(tmp_path) -> URLCleanerBot:
+    """ Returns bot with only the parts needed to auto-clean messages in groups. """
+    bot = object.__new__(URLCleanerBot)
+    bot.cfg = types.SimpleNamespace(autoclean_dedup_window=3600, autoclean_dedup_max_urls=100, shortlinks_deadline=1)
+    bot.chatsettings = ChatSettingsStore(str(tmp_path / "chatsettings.json"))
+    bot.chatsettings.setEnabled(-100, True)
+    bot.recenturls = {}
+    bot.shortlinkexpander = None
+    bot.metrics = None
+    bot.replytemplates = {"en": ReplyTemplates("en")}
+    bot.sender = FakeSender()
+    bot.urlcleaner = URLCleaner(cleaningrules=[CleaningRule(name="utm", paramsblacklist=["utm_source"])])
+    bot.cleaningbackend = CleaningBackend(bot.urlcleaner, mode="inline")
+    return bot
+
+
+def postGroupMessage(bot: URLCleanerBot, text: str, chatid: int = -100):
+    entities = [createEntity(text, word) for word in text.split() if "." in word]
+    message = types.SimpleNamespace(text=text, entities=entities, caption=None, caption_entities=[], message_id=1)
+    update = types.SimpleNamespace(effective_chat=types.SimpleNamespace(id=chatid), effective_message=message, effective_user=None)
+    asyncio.run(bot.botAutoCleanMessage(update, None))
+
+
+def test_auto_clean_only_replies_if_something_changed(tmp_path):
+    bot = createAutoCleanBot(tmp_path)
+    postGroupMessage(bot, "clean https://example.com/a and example.com/b")
+    assert bot.sender.sent == []
+    postGroupMessage(bot, "dirty https://example.com/c?utm_source=x and clean example.com/b")
+    assert bot.sender.sent == [(-100, [ReplyTemplates("en").autoclean + "\nhttps://example.com/c"])]
+    # Already cleaned within the dedup window
+    postGroupMessage(bot, "again https://example.com/c?utm_source=x")
+    # Chat without auto-cleaning
+    postGroupMessage(bot, "https://example.com/d?utm_source=x", chatid=-200)
+    assert len(bot.sender.sent) == 1
+
+
+def test_auto_clean_reply_leaves_out_too_long_urls():
+    templates = ReplyTemplates("en")
+    cleaner = URLCleaner()
+    longurl = "https://example.com/?q=" + "&" * MAX_REPLY_BLOCK_LENGTH
+    cleanedurls = cleaner.cleanText(f"{longurl} https://example.com/short").cleanedurls
+    assert templates.renderAutoCleanReply(cleanedurls) == [templates.autoclean + "\nhttps://example.com/short"]
+    assert templates.renderAutoCleanReply(cleanedurls[:1]) == []
@@ -0,0 +1,175 @@
+import asyncio
+import gzip
+import json
+from typing import Dict, Tuple, List
+
+from CleaningBackend import CleaningBackend
+from CleaningRule import CleaningRule
+from URLCleaner import URLCleaner
+from URLCleanerService import URLCleanerService
+
+TEXTS = [f"text {index} https://example.com/{index}?utm_source=x" for index in range(5)]
+
+
+def createBackend(maxqueued: int = 32) -> CleaningBackend:
+    return CleaningBackend(URLCleaner(cleaningrules=[CleaningRule(name="utm", paramsblacklist=["utm_source"])]), mode="inline", maxinflight=1,
+                           maxqueued=maxqueued)
+
+
+def runService(client, backend: CleaningBackend = None, **kwargs):
+    """ Starts the service on a free port and calls client(port). """
+
+    async def main():
+        service = URLCleanerService(backend or createBackend(), keepalivetimeout=2, **kwargs)
+        await service.start("127.0.0.1", 0)
+        try:
+            return await client(service.server.sockets[0].getsockname()[1])
+        finally:
+            await service.stop()
+
+    return asyncio.run(main())
+
+
+def buildRequest(path: str, body: bytes, version: str = "HTTP/1.1", headers: Dict[str, str] = None) -> bytes:
+    lines = [f"POST {path} {version}", f"Content-Length: {len(body)}"]
+    lines.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+    return ("\r\n".join(lines) + "\r\n\r\n").encode('latin-1') + body
+
+
+async def readResponse(reader: asyncio.StreamReader) -> Tuple[int, Dict[str, str], List[bytes]]:
+    """ Returns status, headers and the chunks of the body. Bodies without Content-Length and chunked encoding are read until the connection gets closed. """
+    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+    lines = head.decode('latin-1').split("\r\n")
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+    chunks = []
+    if "content-length" in headers:
+        chunks.append(await reader.readexactly(int(headers["content-length"])))
+    elif headers.get("transfer-encoding") == "chunked":
+        while True:
+            size = int((await reader.readuntil(b"\r\n")).strip(), 16)
+            data = await reader.readexactly(size + 2)
+            if size == 0:
+                break
+            chunks.append(data[:-2])
+    else:
+        chunks.append(await asyncio.wait_for(reader.read(), timeout=5))
+    return int(lines[0].split(" ")[1]), headers, chunks
+
+
+def test_keep_alive():
+    async def client(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        responses = []
+        for text in TEXTS[:2]:
+            writer.write(buildRequest("/clean", json.dumps({"text": text}).encode()))
+            responses.append(await readResponse(reader))
+        writer.write(buildRequest("/clean", json.dumps(TEXTS[2]).encode(), headers={"Connection": "close"}))
+        responses.append(await readResponse(reader))
+        # Server closes the connection after the last response
+        remaining = await asyncio.wait_for(reader.read(), timeout=5)
+        writer.close()
+        return responses, remaining
+
+    responses, remaining = runService(client)
+    assert [status for status, headers, chunks in responses] == [200, 200, 200]
+    assert [headers["connection"] for status, headers, chunks in responses] == ["keep-alive", "keep-alive", "close"]
+    assert [json.loads(chunks[0])["cleanedtext"] for status, headers, chunks in responses] == [f"text {index} https://example.com/{index}"
+                                                                                              for index in range(3)]
+    assert remaining == b""
+
+
+def test_content_length_limit():
+    async def client(port):
+        responses = []
+        for request in (buildRequest("/clean", b"x" * 101), buildRequest("/clean", gzip.compress(b" " * 1000), headers={"Content-Encoding": "gzip"})):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            responses.append(await readResponse(reader))
+            writer.close()
+        return responses
+
+    responses = runService(client, maxbodysize=100)
+    # Size limit also applies to the unpacked body
+    assert [status for status, headers, chunks in responses] == [413, 413]
+    assert [headers["connection"] for status, headers, chunks in responses] == ["close", "close"]
+
+
+def test_gzip_request_and_response():
+    async def client(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(buildRequest("/clean", gzip.compress(json.dumps({"text": TEXTS[0]}).encode()),
+                                  headers={"Content-Encoding": "gzip", "Accept-Encoding": "gzip, deflate"}))
+        response = await readResponse(reader)
+        writer.close()
+        return response
+
+    status, headers, chunks = runService(client)
+    assert status == 200 and headers["content-encoding"] == "gzip"
+    assert json.loads(gzip.decompress(chunks[0]))["cleanedtext"] == "text 0 https://example.com/0"
+
+
+def test_batch_is_streamed_as_chunked_ndjson():
+    async def client(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        ndjson = "\n".join(json.dumps({"text": text}) for text in TEXTS).encode()
+        writer.write(buildRequest("/clean/batch", ndjson))
+        plainresponse = await readResponse(reader)
+        # Same connection
+        writer.write(buildRequest("/clean/batch", json.dumps(TEXTS).encode(), headers={"Accept-Encoding": "gzip"}))
+        gzipresponse = await readResponse(reader)
+        writer.close()
+        return plainresponse, gzipresponse
+
+    plainresponse, gzipresponse = runService(client, batchchunksize=2)
+    status, headers, chunks = plainresponse
+    assert status == 200 and headers["transfer-encoding"] == "chunked" and headers["content-type"].startswith("application/x-ndjson")
+    # One chunk per batchchunksize texts
+    assert len(chunks) == 3
+    results = [json.loads(line) for line in b"".join(chunks).decode('utf-8').splitlines()]
+    assert [result["index"] for result in results] == [0, 1, 2, 3, 4]
+    assert [result["cleanedtext"] for result in results] == [f"text {index} https://example.com/{index}" for index in range(5)]
+    status, headers, chunks = gzipresponse
+    assert headers["content-encoding"] == "gzip"
+    assert [json.loads(line) for line in gzip.decompress(b"".join(chunks)).decode('utf-8').splitlines()] == results
+
+
+def test_batch_via_http_1_0_ends_with_connection():
+    async def client(port):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(buildRequest("/clean/batch", json.dumps(TEXTS).encode(), version="HTTP/1.0", headers={"Connection": "keep-alive"}))
+        response = await readResponse(reader)
+        writer.close()
+        return response
+
+    status, headers, chunks = runService(client, batchchunksize=2)
+    assert status == 200
+    assert "transfer-encoding" not in headers and "content-length" not in headers and headers["connection"] == "close"
+    assert [json.loads(line)["index"] for line in chunks[0].decode('utf-8').splitlines()] == [0, 1, 2, 3, 4]
+
+
+def test_busy_backend():
+    backend = createBackend(maxqueued=0)
+
+    async def client(port):
+        # Occupy the only slot, nothing may wait for it
+        await backend.inflight.acquire()
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(buildRequest("/clean", json.dumps(TEXTS[0]).encode()))
+        singleresponse = await readResponse(reader)
+        writer.write(buildRequest("/clean/batch", json.dumps(TEXTS[:2]).encode()))
+        batchresponse = await readResponse(reader)
+        writer.close()
+        return singleresponse, batchresponse
+
+    singleresponse, batchresponse = runService(client, backend=backend)
+    status, headers, chunks = singleresponse
+    assert status == 503 and "error" in json.loads(chunks[0])
+    # Status of streamed batches is sent before cleaning starts
+    status, headers, chunks = batchresponse
+    assert status == 200
+    assert [json.loads(line) for line in b"".join(chunks).decode('utf-8').splitlines()] == [
+        {"index": 0, "error": "Too many requests are being processed"}, {"index": 1, "error": "Too many requests are being processed"}]
@@ -0,0 +1,34 @@
+from urllib.parse import parse_qs
+
+from URLCleaner import URLQuery
+
+QUERIES = ["", "a=1", "a=1&b=2&a=3", "a", "a=&b", "q=hello+world&x=%20%2F", "%75tm_source=1&utm%5Fmedium=2", "a+b=1", "a=1=2&b=%ZZ", "ä=ö&emoji=😀",
+           "a=1;b=2"]
+
+
+def test_unchanged_query_is_kept_byte_by_byte():
+    for query in QUERIES:
+        assert URLQuery(query).toString() == query
+
+
+def test_keys_and_values_are_decoded_like_parse_qs():
+    for query in QUERIES:
+        expected = parse_qs(query, keep_blank_values=True)
+        urlquery = URLQuery(query)
+        assert set(urlquery.keys()) == set(expected.keys()), query
+        for key, values in expected.items():
+            assert urlquery.get(key) == values[0], query
+
+
+def test_removing_parameters_keeps_everything_else():
+    urlquery = URLQuery("utm_source=x&q=a+b&%75tm_source=y&page=2&ref")
+    assert urlquery.pop("utm_source") == [0, 2]
+    assert urlquery.pop("ref") == [4]
+    assert urlquery.pop("missing") is None
+    assert urlquery.toString() == "q=a+b&page=2"
+    assert "utm_source" not in urlquery
+    assert len(urlquery) == 2
+
+
+def test_empty_segments_are_dropped():
+    assert URLQuery("a=1&&b=2&").toString() == "a=1&b=2"